@@ -7,33 +7,24 @@
 """
 import dotenv
 import numpy as np
-from langchain.embeddings import CacheBackedEmbeddings
-from langchain.storage import LocalFileStore
 from langchain_openai import OpenAIEmbeddings
 from numpy.linalg import norm
 
-dotenv.load_dotenv()
-
-
-def cosine_similarity(vector1: list, vector2: list) -> float:
-    """计算传入两个向量的余弦相似度"""
-    # 1.计算内积/点积
-    dot_product = np.dot(vector1, vector2)
+from segment_file_store import SegmentFileStore
+from vector_codec import BinaryCacheBackedEmbeddings, VectorCodec
 
-    # 2.计算向量的范数/长度
-    norm_vec1 = norm(vector1)
-    norm_vec2 = norm(vector2)
-
-    # 3.计算余弦相似度
-    return dot_product / (norm_vec1 * norm_vec2)
+dotenv.load_dotenv()
 
 
 embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-embeddings_with_cache = CacheBackedEmbeddings.from_bytes_store(
+# LocalFileStore每条缓存一个文件，换成追加写的段文件存储，一批缓存一次顺序写入/读取
+# 向量按float32原始字节缓存(可选float16/zstd)，替代默认的JSON文本
+embeddings_with_cache = BinaryCacheBackedEmbeddings.from_bytes_store(
     embeddings,
-    LocalFileStore("./cache/"),
+    SegmentFileStore("./cache/"),
     namespace=embeddings.model,
     query_embedding_cache=True,
+    codec=VectorCodec(dtype="float32"),
 )
 
 query_vector = embeddings_with_cache.embed_query("你好，我是慕小课，我喜欢打篮球")
@@ -49,5 +40,8 @@ print(len(query_vector))
 print("============")
 
 print(len(documents_vector))
-print("vector1与vector2的余弦相似度:", cosine_similarity(documents_vector[0], documents_vector[1]))
-print("vector2与vector3的余弦相似度:", cosine_similarity(documents_vector[0], documents_vector[2]))
+# 每个向量只计算一次范数/长度并归一化，归一化后的内积/点积即余弦相似度，一次矩阵乘法算完全部组合
+normalized_vector = np.asarray(documents_vector) / norm(documents_vector, axis=1, keepdims=True)
+similarity = normalized_vector @ normalized_vector.T
+print("vector1与vector2的余弦相似度:", similarity[0][1])
+print("vector2与vector3的余弦相似度:", similarity[0][2])
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/6/25 15:10
+@Author  : thezehui@gmail.com
+@File    : segment_file_store.py
+"""
+import os
+import re
+import struct
+import threading
+import zlib
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, BinaryIO
+
+from langchain_core.stores import ByteStore
+
+RECORD_HEADER = struct.Struct("<IBII")  # crc32、记录类型、key长度、value长度
+PUT, DELETE = 0, 1
+SEGMENT_NAME = re.compile(r"segment-(\d+)\.log")
+
+
+class SegmentFileStore(ByteStore):
+    """追加写、日志结构的字节存储，所有键值对存放在少量段文件中，可替代LocalFileStore作为嵌入缓存
+
+    LocalFileStore每个key对应一个文件，百万级文本块就是百万个文件，每次mget/mset都是大量open/read/close系统调用。
+    这里每次mset把整批记录拼接后一次写入当前段文件的末尾，内存中的哈希表记录每个key所在的段与偏移，
+    mget时按(段, 偏移)排序，把相邻的记录合并成连续区间一次读出，同一批写入的缓存通常一次顺序读即可取回
+
+    记录格式为：头部(crc32, 类型, key长度, value长度) + key + value，删除与覆盖同样以追加记录的方式完成，
+    打开时顺序扫描段文件重建索引，写入中断留下的残缺记录会被截断，compact()可以清理被覆盖/删除的旧记录
+    """
+
+    def __init__(self, root_path: str, max_segment_bytes: int = 1 << 30, max_read_gap: int = 64 * 1024, sync: bool = False):
+        os.makedirs(root_path, exist_ok=True)
+        self.root_path = root_path
+        self.max_segment_bytes = max_segment_bytes  # 当前段超过该大小后，下一次写入新建段文件
+        self.max_read_gap = max_read_gap  # mget时两条记录之间的空隙不超过该值就合并为一次读取
+        self.sync = sync  # 每次写入后是否fsync
+        self._lock = threading.RLock()
+        self._index: Dict[str, Tuple[int, int, int]] = {}  # key -> (段号, value偏移, value长度)
+        self._readers: Dict[int, BinaryIO] = {}
+        self._writer: Optional[BinaryIO] = None
+
+        # 1.按段号顺序扫描已有的段文件重建索引，最后一个段继续作为写入段
+        segment_ids = self._segment_ids()
+        for segment_id in segment_ids:
+            self._load_segment(segment_id)
+        self._open_writer(segment_ids[-1] if segment_ids else 0)
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        """批量读取，按段和偏移排序后合并成连续区间读取，不存在的key返回None"""
+        results: List[Optional[bytes]] = [None] * len(keys)
+        with self._lock:
+            # 1.查索引并按(段号, 偏移)排序
+            locations = sorted(
+                (*self._index[key], position) for position, key in enumerate(keys) if key in self._index
+            )
+
+            # 2.合并相邻的记录为连续区间，每个区间一次seek+read
+            start = 0
+            while start < len(locations):
+                segment_id, run_start, length, _ = locations[start]
+                run_end, end = run_start + length, start + 1
+                while end < len(locations) and locations[end][0] == segment_id \
+                        and locations[end][1] - run_end <= self.max_read_gap:
+                    run_end = max(run_end, locations[end][1] + locations[end][2])
+                    end += 1
+                reader = self._reader(segment_id)
+                reader.seek(run_start)
+                data = reader.read(run_end - run_start)
+                for _, offset, length, position in locations[start:end]:
+                    results[position] = data[offset - run_start:offset - run_start + length]
+                start = end
+        return results
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        """批量写入，整批记录拼接后一次追加到当前段文件"""
+        with self._lock:
+            locations = self._append([(PUT, key, value) for key, value in key_value_pairs])
+            for (key, _), location in zip(key_value_pairs, locations):
+                self._index[key] = location
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        """批量删除，追加删除记录，空间在compact()时回收"""
+        with self._lock:
+            keys = [key for key in dict.fromkeys(keys) if key in self._index]
+            self._append([(DELETE, key, b"") for key in keys])
+            for key in keys:
+                del self._index[key]
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        """遍历全部key，传递prefix时只返回以prefix开头的key"""
+        with self._lock:
+            keys = list(self._index)
+        for key in keys:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+    def compact(self, batch_size: int = 10000) -> None:
+        """把存活的记录顺序重写到新的段文件中，并删除旧段文件，回收被覆盖/删除的记录占用的空间"""
+        with self._lock:
+            # 1.切换到新的写入段，之前的段全部作为待回收的旧段
+            old_segment_ids = self._segment_ids()
+            self._open_writer(self._writer_id + 1)
+
+            # 2.按原有的物理顺序分批读出存活记录并写入新段
+            keys = sorted(self._index, key=self._index.get)
+            for start in range(0, len(keys), batch_size):
+                batch = keys[start:start + batch_size]
+                self.mset(list(zip(batch, self.mget(batch))))
+
+            # 3.关闭并删除旧段文件
+            for segment_id in old_segment_ids:
+                reader = self._readers.pop(segment_id, None)
+                if reader is not None:
+                    reader.close()
+                os.remove(self._segment_path(segment_id))
+
+    def close(self) -> None:
+        """关闭全部文件句柄"""
+        with self._lock:
+            self._writer.close()
+            for reader in self._readers.values():
+                reader.close()
+            self._readers = {}
+
+    def _append(self, records: List[Tuple[int, str, bytes]]) -> List[Tuple[int, int, int]]:
+        """将一批记录编码后一次写入当前段文件，返回每条记录value的(段号, 偏移, 长度)"""
+        if self._writer_offset >= self.max_segment_bytes:
+            self._open_writer(self._writer_id + 1)
+
+        # 1.编码全部记录，计算每条value在文件中的偏移
+        chunks, locations, offset = [], [], self._writer_offset
+        for record_type, key, value in records:
+            key_bytes = key.encode("utf-8")
+            header_tail = RECORD_HEADER.pack(0, record_type, len(key_bytes), len(value))[4:]
+            crc = zlib.crc32(value, zlib.crc32(key_bytes, zlib.crc32(header_tail)))
+            chunks.extend([struct.pack("<I", crc), header_tail, key_bytes, value])
+            value_offset = offset + RECORD_HEADER.size + len(key_bytes)
+            locations.append((self._writer_id, value_offset, len(value)))
+            offset = value_offset + len(value)
+
+        # 2.一次顺序写入
+        self._writer.write(b"".join(chunks))
+        self._writer.flush()
+        if self.sync:
+            os.fsync(self._writer.fileno())
+        self._writer_offset = offset
+        return locations
+
+    def _load_segment(self, segment_id: int) -> None:
+        """顺序扫描一个段文件，重放写入/删除记录，遇到残缺或校验失败的记录时截断文件"""
+        path = self._segment_path(segment_id)
+        valid_end = 0
+        with open(path, "rb", buffering=1 << 20) as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                crc, record_type, key_length, value_length = RECORD_HEADER.unpack(header)
+                body = f.read(key_length + value_length)
+                if len(body) < key_length + value_length or zlib.crc32(body, zlib.crc32(header[4:])) != crc:
+                    break
+                key = body[:key_length].decode("utf-8")
+                if record_type == DELETE:
+                    self._index.pop(key, None)
+                else:
+                    self._index[key] = (segment_id, valid_end + RECORD_HEADER.size + key_length, value_length)
+                valid_end += RECORD_HEADER.size + key_length + value_length
+        if valid_end < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(valid_end)
+
+    def _open_writer(self, segment_id: int) -> None:
+        """打开(或新建)写入段"""
+        if self._writer is not None:
+            self._writer.close()
+        path = self._segment_path(segment_id)
+        self._writer = open(path, "ab")
+        self._writer_id = segment_id
+        self._writer_offset = os.path.getsize(path)
+
+    def _reader(self, segment_id: int) -> BinaryIO:
+        """获取段文件的只读句柄，无缓冲，每个连续区间只有一次read系统调用"""
+        reader = self._readers.get(segment_id)
+        if reader is None:
+            reader = self._readers[segment_id] = open(self._segment_path(segment_id), "rb", buffering=0)
+        return reader
+
+    def _segment_ids(self) -> List[int]:
+        """目录下已有的段号，升序"""
+        return sorted(int(match.group(1)) for match in map(SEGMENT_NAME.fullmatch, os.listdir(self.root_path)) if match)
+
+    def _segment_path(self, segment_id: int) -> str:
+        return os.path.join(self.root_path, f"segment-{segment_id:05d}.log")
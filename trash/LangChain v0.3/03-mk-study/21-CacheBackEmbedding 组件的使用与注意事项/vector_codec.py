@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/6/25 16:20
+@Author  : thezehui@gmail.com
+@File    : vector_codec.py
+"""
+import hashlib
+import uuid
+from typing import Callable, List, Optional, Union
+
+import numpy as np
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage.encoder_backed import EncoderBackedStore
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
+
+# 与CacheBackedEmbeddings相同的键命名空间，生成的键与其一致，已有缓存文件的键保持不变
+NAMESPACE_UUID = uuid.UUID(int=1985)
+
+
+def create_key_encoder(namespace: str) -> Callable[[str], str]:
+    """创建缓存键编码函数，键为namespace + 文本sha1摘要对应的uuid5"""
+
+    def key_encoder(text: str) -> str:
+        return namespace + str(uuid.uuid5(NAMESPACE_UUID, hashlib.sha1(text.encode("utf-8")).hexdigest()))
+
+    return key_encoder
+
+
+class VectorCodec:
+    """嵌入向量的二进制编解码器
+
+    CacheBackedEmbeddings默认把向量序列化成JSON文本，体积约为float32的3倍，读取时json.loads是主要耗时。
+    这里直接保存小端序的float32/float16原始字节，解码只需要一次np.frombuffer，compression="zstd"时再套一层zstd帧
+    """
+
+    def __init__(self, dtype: str = "float32", compression: Optional[str] = None, level: int = 3):
+        if dtype not in ("float32", "float16"):
+            raise ValueError("dtype只支持float32或float16")
+        if compression not in (None, "zstd"):
+            raise ValueError("compression只支持None或zstd")
+        self.dtype = np.dtype("<f4" if dtype == "float32" else "<f2")
+        self.name = dtype if compression is None else f"{dtype}+{compression}"
+        self._compressor, self._decompressor = None, None
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("使用zstd压缩需要安装zstandard：pip install zstandard")
+            self._compressor = zstandard.ZstdCompressor(level=level)
+            self._decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, vector: List[float]) -> bytes:
+        data = np.asarray(vector, dtype=self.dtype).tobytes()
+        return self._compressor.compress(data) if self._compressor is not None else data
+
+    def decode(self, data: bytes) -> List[float]:
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        return np.frombuffer(data, dtype=self.dtype).tolist()
+
+
+class BinaryCacheBackedEmbeddings(CacheBackedEmbeddings):
+    """使用VectorCodec保存向量的CacheBackedEmbeddings，用法与CacheBackedEmbeddings.from_bytes_store一致"""
+
+    @classmethod
+    def from_bytes_store(
+            cls,
+            underlying_embeddings: Embeddings,
+            document_embedding_cache: ByteStore,
+            *,
+            namespace: str = "",
+            batch_size: Optional[int] = None,
+            query_embedding_cache: Union[bool, ByteStore] = False,
+            codec: Optional[VectorCodec] = None,
+    ) -> "BinaryCacheBackedEmbeddings":
+        """codec默认为float32，编码方式会拼接到namespace中，避免与JSON或其他编码写入的缓存互相误读"""
+        codec = codec or VectorCodec()
+        key_encoder = create_key_encoder(f"{namespace}{codec.name}:")
+
+        def create_store(cache: ByteStore) -> EncoderBackedStore:
+            return EncoderBackedStore[str, List[float]](cache, key_encoder, codec.encode, codec.decode)
+
+        document_embedding_store = create_store(document_embedding_cache)
+        if query_embedding_cache is True:
+            query_embedding_store = document_embedding_store
+        elif query_embedding_cache is False:
+            query_embedding_store = None
+        else:
+            query_embedding_store = create_store(query_embedding_cache)
+
+        return cls(
+            underlying_embeddings,
+            document_embedding_store,
+            batch_size=batch_size,
+            query_embedding_store=query_embedding_store,
+        )
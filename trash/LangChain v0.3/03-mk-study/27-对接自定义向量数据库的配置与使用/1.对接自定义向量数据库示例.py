@@ -5,81 +5,10 @@
 @Author  : thezehui@gmail.com
 @File    : 1.对接自定义向量数据库示例.py
 """
-import uuid
-from typing import List, Optional, Any, Iterable, Type
-
 import dotenv
-import numpy as np
-from langchain_core.documents import Document
-from langchain_core.embeddings import Embeddings
-from langchain_core.vectorstores import VectorStore
 from langchain_openai import OpenAIEmbeddings
 
-
-class MemoryVectorStore(VectorStore):
-    """基于内存+欧几里得距离的向量数据库"""
-    store: dict = {}  # 存储向量的临时变量
-
-    def __init__(self, embedding: Embeddings):
-        self._embedding = embedding
-
-    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
-        """将数据添加到向量数据库中"""
-        # 1.检测metadata的数据格式
-        if metadatas is not None and len(metadatas) != len(texts):
-            raise ValueError("metadatas格式错误")
-
-        # 2.将数据转换成文本嵌入/向量和ids
-        embeddings = self._embedding.embed_documents(texts)
-        ids = [str(uuid.uuid4()) for _ in texts]
-
-        # 3.通过for循环组装数据记录
-        for idx, text in enumerate(texts):
-            self.store[ids[idx]] = {
-                "id": ids[idx],
-                "text": text,
-                "vector": embeddings[idx],
-                "metadata": metadatas[idx] if metadatas is not None else {},
-            }
-
-        return ids
-
-    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
-        """传入对应的query执行相似性搜索"""
-        # 1.将query转换成向量
-        embedding = self._embedding.embed_query(query)
-
-        # 2.循环和store中的每一个向量进行比较，计算欧几里得距离
-        result = []
-        for key, record in self.store.items():
-            distance = self._euclidean_distance(embedding, record["vector"])
-            result.append({"distance": distance, **record})
-
-        # 3.排序，欧几里得距离越小越靠前
-        sorted_result = sorted(result, key=lambda x: x["distance"])
-
-        # 4.取数据，取k条数据
-        result_k = sorted_result[:k]
-
-        return [
-            Document(page_content=item["text"], metadata={**item["metadata"], "score": item["distance"]})
-            for item in result_k
-        ]
-
-    @classmethod
-    def from_texts(cls: Type["MemoryVectorStore"], texts: List[str], embedding: Embeddings,
-                   metadatas: Optional[List[dict]] = None,
-                   **kwargs: Any) -> "MemoryVectorStore":
-        """从文本和元数据中去构建向量数据库"""
-        memory_vector_store = cls(embedding=embedding)
-        memory_vector_store.add_texts(texts, metadatas, **kwargs)
-        return memory_vector_store
-
-    @classmethod
-    def _euclidean_distance(cls, vec1: list, vec2: list) -> float:
-        """计算两个向量的欧几里得距离"""
-        return np.linalg.norm(np.array(vec1) - np.array(vec2))
-
+from memory_vector_store import MemoryVectorStore
 
 dotenv.load_dotenv()
 
@@ -110,11 +39,31 @@ metadatas = [
 ]
 embedding = OpenAIEmbeddings(model="text-embedding-3-small")
 
-# 2.构建自定义向量数据库
-db = MemoryVectorStore(embedding=embedding)
+# 2.构建自定义向量数据库，storage="matrix"将向量存储在连续矩阵中，storage="dict"为逐条存储的原始实现
+db = MemoryVectorStore(embedding=embedding, storage="matrix")
 
 ids = db.add_texts(texts, metadatas)
 print(ids)
 
 # 3.执行检索
 print(db.similarity_search("笨笨是谁？"))
+
+# 4.使用hnsw图索引+余弦距离执行近似检索，ef_search越大召回率越高、速度越慢，normalize=True写入时预先归一化向量
+hnsw_db = MemoryVectorStore.from_texts(
+    texts, embedding, metadatas, distance_metric="cosine", normalize=True, index="hnsw", m=16, ef_construction=200,
+)
+print(hnsw_db.similarity_search("笨笨是谁？", ef_search=64))
+
+# 5.持久化到本地目录，再通过内存映射加载(多个进程加载同一目录时共享页缓存)
+hnsw_db.save("./memory-vector-store/")
+loaded_db = MemoryVectorStore.load("./memory-vector-store/", embedding, mmap=True)
+print(loaded_db.similarity_search("笨笨是谁？"))
+
+# 6.按id覆盖与删除，删除只标记墓碑，墓碑占比超过compaction_threshold后在后台线程中压缩矩阵
+db.upsert([ids[0]], ["笨笨是一只很喜欢吃鱼的猫咪"], [{"page": 1}])
+db.delete([ids[2]])
+print(db.similarity_search("笨笨是谁？"))
+
+# 7.最大边际相关性搜索，先取fetch_k条候选，再兼顾相关性与多样性选出k条
+print(db.max_marginal_relevance_search("笨笨是谁？", k=2, fetch_k=5, lambda_mult=0.5))
+print(db.as_retriever(search_type="mmr", search_kwargs={"k": 2}).invoke("笨笨是谁？"))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/1 11:05
+@Author  : thezehui@gmail.com
+@File    : 2.向量量化压缩与召回率测试.py
+"""
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from memory_vector_store import MemoryVectorStore
+
+
+class PresetEmbeddings(Embeddings):
+    """按文本编号返回预先生成的向量，不调用任何接口，便于本地测试"""
+
+    def __init__(self, documents: np.ndarray, queries: np.ndarray):
+        self.documents = documents
+        self.queries = queries
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    def _embed(self, text: str) -> List[float]:
+        kind, idx = text.split("-")
+        return (self.documents if kind == "doc" else self.queries)[int(idx)].tolist()
+
+
+# 1.生成带聚类结构的模拟向量(真实的文本嵌入同样是成簇分布的)，bge-large-zh-v1.5的维度为1024
+rng = np.random.default_rng(42)
+dim, n_docs, n_queries, n_clusters = 1024, 10000, 100, 100
+centers = rng.standard_normal((n_clusters, dim))
+documents = (centers[rng.integers(0, n_clusters, n_docs)] + 0.5 * rng.standard_normal((n_docs, dim))).astype(np.float32)
+queries = (centers[rng.integers(0, n_clusters, n_queries)] + 0.5 * rng.standard_normal((n_queries, dim))).astype(np.float32)
+embedding = PresetEmbeddings(documents, queries)
+texts = [f"doc-{i}" for i in range(n_docs)]
+query_texts = [f"query-{i}" for i in range(n_queries)]
+
+# 2.用精确的暴力检索结果作为基准
+k = 10
+flat_db = MemoryVectorStore.from_texts(texts, embedding, distance_metric="cosine")
+ground_truth = [{doc.page_content for doc in flat_db.similarity_search(query, k)} for query in query_texts]
+
+# 3.对比不同量化方式实际常驻内存的大小(量化后原始向量不再常驻内存，精排用的原始向量内存映射在临时文件中)、召回率与耗时
+configs = [
+    {"quantization": "sq8"},
+    {"quantization": "sq8", "rerank_k": 50},
+    {"quantization": "pq"},
+    {"quantization": "pq", "rerank_k": 100},
+]
+flat_bytes = flat_db.resident_bytes()
+print(f"{'模式':<30}{'常驻内存(MB)':>12}{'压缩比':>8}{'recall@10':>12}{'耗时(ms)':>10}")
+print(f"{'flat':<32}{flat_bytes / 2 ** 20:>12.2f}{1:>8.1f}x{1:>12.3f}")
+for config in configs:
+    db = MemoryVectorStore.from_texts(texts, embedding, distance_metric="cosine", **config)
+    db.train_quantizer()
+
+    start = time.perf_counter()
+    recalls = [
+        len(truth & {doc.page_content for doc in db.similarity_search(query, k)}) / k
+        for query, truth in zip(query_texts, ground_truth)
+    ]
+    elapsed = (time.perf_counter() - start) / n_queries * 1000
+
+    resident = db.resident_bytes()
+    name = ",".join(f"{key}={value}" for key, value in config.items())
+    print(f"{name:<32}{resident / 2 ** 20:>12.2f}{flat_bytes / resident:>8.1f}x{np.mean(recalls):>12.3f}{elapsed:>10.2f}")
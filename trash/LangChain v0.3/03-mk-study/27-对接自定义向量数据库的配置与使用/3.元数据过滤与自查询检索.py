@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/1 16:20
+@Author  : thezehui@gmail.com
+@File    : 3.元数据过滤与自查询检索.py
+"""
+import dotenv
+from langchain.chains.query_constructor.schema import AttributeInfo
+from langchain.retrievers import SelfQueryRetriever
+from langchain_core.documents import Document
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from memory_vector_store import MemoryVectorStore
+from metadata_index import MemoryVectorStoreTranslator
+
+dotenv.load_dotenv()
+
+# 1.构建文档列表并添加到自定义向量数据库
+documents = [
+    Document(page_content="肖申克的救赎", metadata={"year": 1994, "rating": 9.7, "director": "弗兰克·德拉邦特"}),
+    Document(page_content="霸王别姬", metadata={"year": 1993, "rating": 9.6, "director": "陈凯歌"}),
+    Document(page_content="阿甘正传", metadata={"year": 1994, "rating": 9.5, "director": "罗伯特·泽米吉斯"}),
+    Document(page_content="泰坦尼克号", metadata={"year": 1997, "rating": 9.5, "director": "詹姆斯·卡梅隆"}),
+    Document(page_content="千与千寻", metadata={"year": 2001, "rating": 9.4, "director": "宫崎骏"}),
+    Document(page_content="星际穿越", metadata={"year": 2014, "rating": 9.4, "director": "克里斯托弗·诺兰"}),
+    Document(page_content="忠犬八公的故事", metadata={"year": 2009, "rating": 9.4, "director": "莱塞·霍尔斯道姆"}),
+    Document(page_content="三傻大闹宝莱坞", metadata={"year": 2009, "rating": 9.2, "director": "拉库马·希拉尼"}),
+    Document(page_content="疯狂动物城", metadata={"year": 2016, "rating": 9.2, "director": "拜伦·霍华德"}),
+    Document(page_content="无间道", metadata={"year": 2002, "rating": 9.3, "director": "刘伟强"}),
+]
+db = MemoryVectorStore(embedding=OpenAIEmbeddings(model="text-embedding-3-small"), distance_metric="cosine")
+db.add_documents(documents)
+
+# 2.直接传递filter执行带过滤的相似性搜索，数值字段走排序数组，类别字段走位图
+print(db.similarity_search("经典电影", k=4, filter={"rating": {"$gt": 9.5}}))
+print(db.similarity_search("经典电影", k=4, filter={"$and": [{"year": 1994}, {"director": {"$ne": "陈凯歌"}}]}))
+print("===================")
+
+# 3.创建自查询检索器，使用自定义的翻译器将结构化查询转换成filter
+metadata_filed_info = [
+    AttributeInfo(name="year", description="电影的年份", type="integer"),
+    AttributeInfo(name="rating", description="电影的评分", type="float"),
+    AttributeInfo(name="director", description="电影的导演", type="string"),
+]
+self_query_retriever = SelfQueryRetriever.from_llm(
+    llm=ChatOpenAI(model="gpt-3.5-turbo-16k", temperature=0),
+    vectorstore=db,
+    document_contents="电影的名字",
+    metadata_field_info=metadata_filed_info,
+    structured_query_translator=MemoryVectorStoreTranslator(),
+    enable_limit=True,
+)
+
+# 4.检索示例
+docs = self_query_retriever.invoke("查找下评分高于9.5分的电影")
+print(docs)
+print(len(docs))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 11:10
+@Author  : thezehui@gmail.com
+@File    : 4.分片向量数据库并行检索.py
+"""
+import os
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from memory_vector_store import MemoryVectorStore
+from sharded_vector_store import ShardedMemoryVectorStore
+
+
+class PresetEmbeddings(Embeddings):
+    """按文本编号返回预先生成的向量，不调用任何接口，便于本地测试"""
+
+    def __init__(self, documents: np.ndarray, queries: np.ndarray):
+        self.documents = documents
+        self.queries = queries
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+    def _embed(self, text: str) -> List[float]:
+        kind, idx = text.split("-")
+        return (self.documents if kind == "doc" else self.queries)[int(idx)].tolist()
+
+
+def average_latency(db, query_texts: List[str], k: int) -> float:
+    start = time.perf_counter()
+    for query in query_texts:
+        db.similarity_search(query, k)
+    return (time.perf_counter() - start) / len(query_texts) * 1000
+
+
+# 使用多进程时(尤其是Windows/macOS默认的spawn启动方式)，入口代码需要放在main保护中
+if __name__ == "__main__":
+    # 1.生成模拟向量，bge-small-zh-v1.5的维度为512
+    rng = np.random.default_rng(42)
+    dim, n_docs, n_queries, k = 512, 50000, 50, 10
+    embedding = PresetEmbeddings(
+        rng.standard_normal((n_docs, dim), dtype=np.float32), rng.standard_normal((n_queries, dim), dtype=np.float32),
+    )
+    texts = [f"doc-{i}" for i in range(n_docs)]
+    query_texts = [f"query-{i}" for i in range(n_queries)]
+
+    # 2.单进程暴力检索作为基准
+    db = MemoryVectorStore.from_texts(texts, embedding)
+    print(f"单进程：{average_latency(db, query_texts, k):.2f}ms/query")
+
+    # 3.按核心数分片，每个分片进程只计算自己那部分向量的距离，父进程归并各分片的top-k
+    n_shards = os.cpu_count()
+    with ShardedMemoryVectorStore.from_texts(texts, embedding, n_shards=n_shards) as sharded_db:
+        print(f"{n_shards}个分片：{average_latency(sharded_db, query_texts, k):.2f}ms/query")
+
+        # 4.结果与单进程检索一致
+        expected = [doc.page_content for doc in db.similarity_search(query_texts[0], k)]
+        actual = [doc.page_content for doc in sharded_db.similarity_search(query_texts[0], k)]
+        print(expected == actual)
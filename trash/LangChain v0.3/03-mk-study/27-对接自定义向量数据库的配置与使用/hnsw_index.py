@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/6/30 15:40
+@Author  : thezehui@gmail.com
+@File    : hnsw_index.py
+"""
+import heapq
+import math
+from typing import List, Optional, Tuple, Dict
+
+import numpy as np
+
+DISTANCE_METRICS = ("euclidean", "cosine", "dot")
+
+
+def raw_distances(metric: str, vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """计算query到一组向量的原始距离，越小越相似
+
+    euclidean返回平方距离(省去开方，不影响排序)，cosine返回1-余弦相似度，dot返回负内积
+    """
+    if metric == "euclidean":
+        diff = vectors - query
+        return np.einsum("ij,ij->i", diff, diff)
+    if metric == "dot":
+        return -(vectors @ query)
+    if metric == "cosine":
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        return 1 - (vectors @ query) / np.maximum(norms, 1e-12)
+    raise ValueError(f"不支持的距离度量：{metric}")
+
+
+def pairwise_raw_distances(metric: str, vectors: np.ndarray) -> np.ndarray:
+    """计算一组向量两两之间的原始距离矩阵，口径与raw_distances一致"""
+    products = vectors @ vectors.T
+    if metric == "euclidean":
+        sq_norms = np.diag(products)
+        return sq_norms[:, None] + sq_norms[None, :] - 2 * products
+    if metric == "dot":
+        return -products
+    if metric == "cosine":
+        norms = np.sqrt(np.diag(products))
+        return 1 - products / np.maximum(np.outer(norms, norms), 1e-12)
+    raise ValueError(f"不支持的距离度量：{metric}")
+
+
+class HNSWIndex:
+    """纯Python+NumPy实现的HNSW近似最近邻图索引
+
+    索引只保存图结构(每一层每个节点的邻居列表)，向量本身由调用方的矩阵提供，
+    节点id即向量在矩阵中的行号，避免向量在内存中存两份。
+    """
+
+    def __init__(
+            self,
+            metric: str = "euclidean",
+            m: int = 16,
+            ef_construction: int = 200,
+            ef_search: int = 50,
+            seed: Optional[int] = None,
+    ):
+        if metric not in DISTANCE_METRICS:
+            raise ValueError(f"不支持的距离度量：{metric}")
+        if m < 2:
+            raise ValueError("m必须大于等于2")
+        self.metric = metric
+        self.m = m
+        self.max_m0 = 2 * m  # 第0层允许的最大邻居数
+        self.ef_construction = max(ef_construction, m)
+        self.ef_search = ef_search
+        self._level_mult = 1 / math.log(m)
+        self._rng = np.random.default_rng(seed)
+
+        self._graph: List[Dict[int, List[int]]] = []  # 第i层：节点 -> 邻居列表
+        self._levels: List[int] = []  # 每个节点的最高层
+        self._entry_point: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self._levels)
+
+    def add(self, data: np.ndarray, start: int, end: int) -> None:
+        """将data[start:end]的向量按顺序插入图中，data为完整的向量矩阵"""
+        if start != len(self._levels):
+            raise ValueError("HNSW索引只支持按行号顺序追加")
+        for node in range(start, end):
+            self._insert(data, node)
+
+    def search(
+            self, data: np.ndarray, query: np.ndarray, k: int, ef: Optional[int] = None, allowed: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """检索与query最相近的k个节点，返回(节点id数组, 原始距离数组)，按距离升序
+
+        allowed为bool掩码时，不满足条件的节点仍然参与图遍历(保证连通性)，但不会出现在结果中
+        """
+        if self._entry_point is None or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # 1.从顶层开始贪心下降，每层只保留1个最近的入口点
+        entry = [self._entry_point]
+        for level in range(self._levels[self._entry_point], 0, -1):
+            entry = [self._search_layer(data, query, entry, 1, level)[0][1]]
+
+        # 2.在第0层用max(ef, k)的候选集做束搜索
+        results = self._search_layer(data, query, entry, max(ef or self.ef_search, k), 0, allowed)[:k]
+        ids = np.fromiter((node for _, node in results), dtype=np.int64, count=len(results))
+        distances = np.fromiter((dist for dist, _ in results), dtype=np.float32, count=len(results))
+        return ids, distances
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """将图结构导出为numpy数组(每层按CSR格式压缩：节点、偏移量、邻居)，便于用np.savez持久化"""
+        arrays = {
+            "levels": np.asarray(self._levels, dtype=np.int32),
+            "entry_point": np.asarray([-1 if self._entry_point is None else self._entry_point], dtype=np.int64),
+        }
+        for level, layer in enumerate(self._graph):
+            nodes = np.fromiter(layer.keys(), dtype=np.int64, count=len(layer))
+            offsets = np.zeros(len(layer) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(links) for links in layer.values()])
+            neighbors = np.fromiter(
+                (neighbor for links in layer.values() for neighbor in links), dtype=np.int64, count=int(offsets[-1]),
+            )
+            arrays[f"nodes_{level}"] = nodes
+            arrays[f"offsets_{level}"] = offsets
+            arrays[f"neighbors_{level}"] = neighbors
+        return arrays
+
+    def from_arrays(self, arrays: Dict[str, np.ndarray]) -> None:
+        """从to_arrays导出的数组还原图结构"""
+        self._levels = arrays["levels"].tolist()
+        entry_point = int(arrays["entry_point"][0])
+        self._entry_point = None if entry_point < 0 else entry_point
+        self._graph = []
+        level = 0
+        while f"nodes_{level}" in arrays:
+            nodes = arrays[f"nodes_{level}"].tolist()
+            offsets = arrays[f"offsets_{level}"].tolist()
+            neighbors = arrays[f"neighbors_{level}"].tolist()
+            self._graph.append({
+                node: neighbors[offsets[pos]:offsets[pos + 1]] for pos, node in enumerate(nodes)
+            })
+            level += 1
+
+    def _insert(self, data: np.ndarray, node: int) -> None:
+        """插入单个节点：随机层数 -> 逐层贪心找入口 -> 在各层选邻居并建立双向连接"""
+        query = data[node]
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+        self._levels.append(level)
+        while len(self._graph) <= level:
+            self._graph.append({})
+        for lc in range(level + 1):
+            self._graph[lc][node] = []
+
+        # 1.第一个节点直接作为入口点
+        if self._entry_point is None:
+            self._entry_point = node
+            return
+
+        # 2.在高于新节点层数的层上贪心下降
+        entry = [self._entry_point]
+        top_level = self._levels[self._entry_point]
+        for lc in range(top_level, level, -1):
+            entry = [self._search_layer(data, query, entry, 1, lc)[0][1]]
+
+        # 3.在新节点所在的每一层选出邻居并连接
+        for lc in range(min(level, top_level), -1, -1):
+            candidates = self._search_layer(data, query, entry, self.ef_construction, lc)
+            max_m = self.max_m0 if lc == 0 else self.m
+            neighbors = self._select_neighbors(data, candidates, self.m)
+            self._graph[lc][node] = neighbors
+            for neighbor in neighbors:
+                links = self._graph[lc][neighbor]
+                links.append(node)
+                if len(links) > max_m:
+                    self._shrink_links(data, neighbor, lc, max_m)
+            entry = [node_id for _, node_id in candidates]
+
+        # 4.新节点层数更高时成为新的入口点
+        if level > top_level:
+            self._entry_point = node
+
+    def _search_layer(
+            self, data: np.ndarray, query: np.ndarray, entry: List[int], ef: int, level: int,
+            allowed: Optional[np.ndarray] = None,
+    ) -> List[Tuple[float, int]]:
+        """在指定层上做束宽为ef的最佳优先搜索，返回[(距离, 节点id)]，按距离升序"""
+        layer = self._graph[level]
+        visited = set(entry)
+        entry_distances = raw_distances(self.metric, data[entry], query).tolist()
+        candidates = list(zip(entry_distances, entry))  # 最小堆：待扩展的节点
+        heapq.heapify(candidates)
+        results = [(-dist, node) for dist, node in candidates if allowed is None or allowed[node]]  # 最大堆：当前最好的ef个结果
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            dist, node = heapq.heappop(candidates)
+            if len(results) >= ef and dist > -results[0][0]:
+                break
+
+            # 一次性计算所有未访问邻居的距离，避免逐个调用numpy
+            neighbors = [neighbor for neighbor in layer[node] if neighbor not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            neighbor_distances = raw_distances(self.metric, data[neighbors], query).tolist()
+            for neighbor_dist, neighbor in zip(neighbor_distances, neighbors):
+                if len(results) < ef or neighbor_dist < -results[0][0]:
+                    heapq.heappush(candidates, (neighbor_dist, neighbor))
+                    if allowed is not None and not allowed[neighbor]:
+                        continue
+                    heapq.heappush(results, (-neighbor_dist, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+
+        return sorted((-dist, node) for dist, node in results)
+
+    def _select_neighbors(self, data: np.ndarray, candidates: List[Tuple[float, int]], m: int) -> List[int]:
+        """启发式选邻居：候选点离新节点比离所有已选邻居都近时才保留，保证图在不同方向上的连通性"""
+        if len(candidates) <= m:
+            return [node for _, node in candidates]
+
+        # 1.一次性算出候选点之间的距离矩阵，循环中只做列表查表
+        nodes = [node for _, node in candidates]
+        pairwise = pairwise_raw_distances(self.metric, data[nodes]).tolist()
+
+        # 2.按距离从近到远贪心选择
+        selected: List[int] = []
+        pruned: List[int] = []
+        for pos, (dist, _) in enumerate(candidates):
+            if len(selected) >= m:
+                break
+            row = pairwise[pos]
+            if all(dist < row[chosen] for chosen in selected):
+                selected.append(pos)
+            else:
+                pruned.append(pos)
+
+        # 3.启发式选出的邻居不足m个时，用被裁剪的候选补齐
+        selected.extend(pruned[:m - len(selected)])
+        return [nodes[pos] for pos in selected]
+
+    def _shrink_links(self, data: np.ndarray, node: int, level: int, max_m: int) -> None:
+        """节点邻居数超过上限时，重新按启发式规则裁剪邻居列表"""
+        links = self._graph[level][node]
+        distances = raw_distances(self.metric, data[links], data[node]).tolist()
+        candidates = sorted(zip(distances, links))
+        self._graph[level][node] = self._select_neighbors(data, candidates, max_m)
@@ -0,0 +1,937 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/6/30 10:05
+@Author  : thezehui@gmail.com
+@File    : memory_vector_store.py
+"""
+import json
+import os
+import tempfile
+import threading
+import uuid
+from typing import List, Optional, Any, Iterable, Type, Callable, BinaryIO, Tuple, Dict
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from hnsw_index import DISTANCE_METRICS, HNSWIndex
+from metadata_index import MetadataIndex, match_metadata
+from quantization import BLOCK_SIZE, create_quantizer
+from vector_math import l2_normalize
+
+
+class _SpilledVectors:
+    """写入匿名临时文件并以只读方式内存映射的float32向量，量化存储用它保存精排所需的原始向量
+
+    数据只存在于磁盘(与操作系统的页缓存)中，不占用进程内存，精排时只读取候选行所在的页，
+    临时文件在对象被回收后由操作系统删除
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.count = 0
+        self.file = tempfile.TemporaryFile()
+        self.array: np.ndarray = np.empty((0, dim), dtype=np.float32)
+
+    def append(self, vectors: np.ndarray) -> None:
+        """分块追加到文件尾部，再重新映射整个文件"""
+        self.file.seek(0, os.SEEK_END)
+        for start in range(0, vectors.shape[0], BLOCK_SIZE):
+            np.asarray(vectors[start:start + BLOCK_SIZE], dtype="<f4").tofile(self.file)
+        self.file.flush()
+        self.count += vectors.shape[0]
+        if self.count > 0:
+            self.array = np.memmap(self.file, dtype="<f4", mode="r", shape=(self.count, self.dim))
+
+    @classmethod
+    def from_rows(cls, matrix: np.ndarray, rows: Optional[np.ndarray] = None) -> "_SpilledVectors":
+        """把matrix的全部行(或rows指定的行)分块写入新的临时文件"""
+        spilled = cls(matrix.shape[1])
+        count = matrix.shape[0] if rows is None else rows.shape[0]
+        for start in range(0, count, BLOCK_SIZE):
+            spilled.append(matrix[start:start + BLOCK_SIZE] if rows is None else matrix[rows[start:start + BLOCK_SIZE]])
+        return spilled
+
+
+class MemoryVectorStore(VectorStore):
+    """基于内存+欧几里得距离的向量数据库
+
+    storage="dict"：每条记录单独存储在字典中，逐条计算距离，便于理解原理
+    storage="matrix"：所有向量存储在一个连续的float32矩阵中，一次矩阵运算算完全部距离，再用部分选择取top-k
+    index="hnsw"：在matrix存储之上构建HNSW图索引，查询只访问图上的少量节点，复杂度为亚线性
+    quantization="sq8"/"pq"：额外保存int8标量量化/乘积量化编码，检索时用非对称距离扫描编码，
+    rerank_k>0时再取rerank_k条候选用原始float32向量精排(load时使用mmap，精排只读取候选行)，
+    向量数量达到量化器的最少训练条数(sq8/pq均为256条)之后的第一次检索才自动训练量化器，之前检索走暴力模式，
+    量化器训练完成后新增的向量在写入时直接编码，原始float32向量不再常驻内存：
+    rerank_k>0时转存到临时文件(或load时的向量文件)中内存映射，rerank_k=0时直接丢弃，
+    此时MMR使用量化还原的近似向量，也不能再调用train_quantizer重新训练
+
+    distance_metric支持euclidean/cosine/dot，返回文档metadata中的score均为距离，越小越相似
+    (cosine为1-余弦相似度，dot为负内积)，normalize=True时写入前先对向量做L2归一化，
+    检索时query只归一化一次，余弦距离退化为一次内积GEMV，不再计算任何范数
+
+    matrix存储可以通过save/load持久化到目录，load时默认使用内存映射打开向量文件
+
+    similarity_search支持filter参数(与Pinecone相同的写法，例如{"rating": {"$gt": 9.5}, "year": 1994})，
+    过滤条件通过元数据索引先算出满足条件的行，只对这些行计算距离
+
+    add_texts/upsert传入已存在的id时覆盖旧数据，delete只在墓碑位图中标记被删除的行(O(1))，检索时跳过这些行，
+    墓碑占比超过compaction_threshold后由后台线程重建连续的矩阵(以及hnsw图、量化编码)，重建期间检索与写入照常进行
+
+    max_marginal_relevance_search先取fetch_k条候选再贪心选择，支持as_retriever(search_type="mmr")
+    """
+    VECTORS_FILE = "vectors.f32"  # 原始float32向量，行优先
+    NORMS_FILE = "norms.f32"  # 每一行向量的平方范数
+    META_FILE = "meta.json"  # 配置+ids+文本+元数据
+    HNSW_FILE = "hnsw.npz"  # hnsw图结构
+    CODES_FILE = "codes.u8"  # 量化编码，行优先
+    CODE_NORMS_FILE = "code_norms.f32"  # 量化还原向量的平方范数
+    QUANTIZER_FILE = "quantizer.npz"  # 量化器参数(码本/取值范围)
+    TOMBSTONES_FILE = "tombstones.bin"  # 墓碑位图，每行1 bit
+    FILTER_BRUTE_FORCE_RATIO = 0.1  # hnsw模式下满足过滤条件的行占比低于该值时，改为对这些行精确检索
+    MASKED_SCAN_RATIO = 0.5  # 可检索的行占比不低于该值时，直接计算全部行的距离再屏蔽其余行，避免按行号拷贝大半个矩阵
+
+    def __init__(
+            self,
+            embedding: Embeddings,
+            storage: str = "matrix",
+            initial_capacity: int = 1024,
+            distance_metric: str = "euclidean",
+            index: str = "flat",
+            m: int = 16,
+            ef_construction: int = 200,
+            ef_search: int = 50,
+            quantization: str = "none",
+            pq_m: Optional[int] = None,
+            rerank_k: int = 0,
+            compaction_threshold: Optional[float] = 0.2,
+            background_compaction: bool = True,
+            normalize: bool = False,
+    ):
+        if storage not in ("dict", "matrix"):
+            raise ValueError("storage只支持dict或matrix")
+        if distance_metric not in DISTANCE_METRICS:
+            raise ValueError(f"distance_metric只支持{'/'.join(DISTANCE_METRICS)}")
+        if index not in ("flat", "hnsw"):
+            raise ValueError("index只支持flat或hnsw")
+        if quantization not in ("none", "sq8", "pq"):
+            raise ValueError("quantization只支持none/sq8/pq")
+        if storage == "dict" and (distance_metric != "euclidean" or index != "flat" or quantization != "none" or normalize):
+            raise ValueError("dict存储只支持欧几里得距离的暴力检索")
+        if quantization != "none" and index != "flat":
+            raise ValueError("量化存储只支持flat索引")
+        self._embedding = embedding
+        self._storage = storage
+        self.store: dict = {}  # 存储向量的临时变量(dict模式)，每个实例独立
+        self._initial_capacity = max(int(initial_capacity), 1)
+        self._distance_metric = distance_metric
+        self._normalize = normalize
+
+        # matrix模式：向量矩阵按容量预分配，_size为实际使用的行数
+        self._matrix: Optional[np.ndarray] = None
+        self._sq_norms: Optional[np.ndarray] = None
+        self._size = 0
+        self._dim = 0
+        self._ids: List[str] = []
+        self._texts: List[str] = []
+        self._metadatas: List[dict] = []
+
+        # hnsw索引只保存图结构，节点id即矩阵中的行号，归一化后的余弦距离与负内积只差常数1，图直接按内积构建
+        self._index: Optional[HNSWIndex] = None
+        if index == "hnsw":
+            self._index = HNSWIndex(
+                metric="dot" if normalize and distance_metric == "cosine" else distance_metric,
+                m=m, ef_construction=ef_construction, ef_search=ef_search,
+            )
+
+        # 量化编码：向量数量达到量化器的最少训练条数后，第一次检索时用已有向量训练量化器(或显式调用train_quantizer)，
+        # 之后新增的向量增量编码；数量不足时检索走暴力模式，原始向量保持常驻
+        self._quantization = quantization
+        self._quantizer = create_quantizer(quantization, pq_m) if quantization != "none" else None
+        self._rerank_k = rerank_k
+        self._codes: Optional[np.ndarray] = None
+        self._code_sq_norms: Optional[np.ndarray] = None
+        self._encoded = 0
+        self._spilled: Optional[_SpilledVectors] = None  # 编码后转存到临时文件的原始向量(rerank_k>0)
+
+        # 元数据索引在第一次带过滤条件的检索时构建，之后增量追加
+        self._metadata_index = MetadataIndex()
+
+        # 删除/覆盖：id -> 存活行号，被删除的行在墓碑数组中置True，compaction_threshold为None时不自动压缩
+        self._id_to_row: Dict[str, int] = {}
+        self._deleted: Optional[np.ndarray] = None
+        self._deleted_count = 0
+        self._compaction_threshold = compaction_threshold
+        self._background_compaction = background_compaction
+        self._compaction_thread: Optional[threading.Thread] = None
+        self._compaction_lock = threading.Lock()  # 保证同一时间只有一个压缩任务
+        self._lock = threading.RLock()  # 保护矩阵、墓碑等共享状态，压缩线程只在拍快照和替换时持有
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        """将数据添加到向量数据库中"""
+        # 1.检测metadata的数据格式
+        texts = list(texts)
+        if metadatas is not None and len(metadatas) != len(texts):
+            raise ValueError("metadatas格式错误")
+        if not texts:
+            return []
+
+        ids = kwargs.get("ids")
+        if ids is not None and len(ids) != len(texts):
+            raise ValueError("ids格式错误")
+
+        # 2.将数据转换成文本嵌入/向量和ids，未传递(或为None)的id自动生成
+        embeddings = self._embedding.embed_documents(texts)
+        ids = [str(uuid.uuid4()) if ids is None or ids[idx] is None else str(ids[idx]) for idx in range(len(texts))]
+
+        # 3.matrix模式将整批向量一次性写入矩阵，并增量插入到hnsw索引中
+        if self._storage == "matrix":
+            with self._lock:
+                start = self._size
+                vectors = np.asarray(embeddings, dtype=np.float32)
+                self._append_vectors(l2_normalize(vectors) if self._normalize else vectors)
+                if self._index is not None:
+                    self._index.add(self._matrix, start, self._size)
+                self._ids.extend(ids)
+                self._texts.extend(texts)
+                self._metadatas.extend(metadatas if metadatas is not None else [{} for _ in texts])
+
+                # 4.id已存在时(包括同一批次内重复)将旧行标记为墓碑，以最后一次写入为准
+                for row, id in enumerate(ids, start):
+                    old_row = self._id_to_row.get(id)
+                    if old_row is not None:
+                        self._deleted[old_row] = True
+                        self._deleted_count += 1
+                    self._id_to_row[id] = row
+                self._maybe_compact()
+            return ids
+
+        # 5.dict模式通过for循环组装数据记录，相同id直接覆盖
+        for idx, text in enumerate(texts):
+            self.store[ids[idx]] = {
+                "id": ids[idx],
+                "text": text,
+                "vector": embeddings[idx],
+                "metadata": metadatas[idx] if metadatas is not None else {},
+            }
+
+        return ids
+
+    def upsert(self, ids: List[str], texts: List[str], metadatas: Optional[List[dict]] = None) -> List[str]:
+        """按id插入或覆盖数据"""
+        return self.add_texts(texts, metadatas, ids=ids)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """按id删除数据，所有id都存在时返回True
+
+        matrix模式只在墓碑数组中标记对应的行，检索时跳过，墓碑占比超过compaction_threshold后触发压缩
+        """
+        if ids is None:
+            raise ValueError("ids不能为空")
+        if self._storage != "matrix":
+            return all([self.store.pop(id, None) is not None for id in ids])
+
+        with self._lock:
+            found = True
+            for id in ids:
+                row = self._id_to_row.pop(id, None)
+                if row is None:
+                    found = False
+                    continue
+                self._deleted[row] = True
+                self._deleted_count += 1
+            self._maybe_compact()
+        return found
+
+    def _maybe_compact(self) -> None:
+        """墓碑占比超过阈值时执行压缩，background_compaction=True时放到后台线程中执行"""
+        if self._compaction_threshold is None or self._deleted_count == 0:
+            return
+        if self._deleted_count < self._compaction_threshold * self._size:
+            return
+        if not self._background_compaction:
+            self.compact()
+        elif self._compaction_thread is None or not self._compaction_thread.is_alive():
+            self._compaction_thread = threading.Thread(target=self.compact, daemon=True)
+            self._compaction_thread.start()
+
+    def compact(self) -> None:
+        """移除墓碑行，重建连续的向量矩阵、hnsw图与量化编码
+
+        耗时的拷贝与hnsw重建不持有锁，最后在锁内补上压缩期间新增/删除的数据并整体替换
+        """
+        if self._storage != "matrix" or not self._compaction_lock.acquire(blocking=False):
+            return
+        try:
+            # 1.拍快照：压缩只处理当前的前size行
+            with self._lock:
+                if self._deleted_count == 0:
+                    return
+                size = self._size
+                deleted = self._deleted[:size].copy()
+                matrix, sq_norms = self._matrix, self._sq_norms
+                encoded = self._quantizer is not None and self._quantizer.trained
+
+            # 2.拷贝存活的行并重建hnsw图(前size行不会再被写入，可以在锁外读取)，
+            # 已编码的量化存储只保留临时文件中的原始向量(或已丢弃)，存活的行写入新的临时文件
+            keep = np.flatnonzero(~deleted)
+            if encoded:
+                spilled = None if matrix is None else _SpilledVectors.from_rows(matrix, keep)
+            else:
+                new_matrix, new_sq_norms = np.asarray(matrix[keep]), np.asarray(sq_norms[keep])
+            index = None
+            if self._index is not None:
+                index = HNSWIndex(
+                    metric=self._index.metric, m=self._index.m,
+                    ef_construction=self._index.ef_construction, ef_search=self._index.ef_search,
+                )
+                index.add(new_matrix, 0, keep.shape[0])
+
+            with self._lock:
+                # 压缩期间量化器完成了训练(原始向量已释放)时放弃本次压缩，下次删除/覆盖时再触发
+                if encoded != (self._quantizer is not None and self._quantizer.trained):
+                    return
+
+                # 3.快照之后被删除的行换算成新行号，快照之后追加的行原样保留
+                remap = np.full(size, -1, dtype=np.int64)
+                remap[keep] = np.arange(keep.shape[0])
+                late_deleted = remap[np.flatnonzero(self._deleted[:size] & ~deleted)]
+                tail_deleted = self._deleted[size:self._size].copy()
+                ids = [self._ids[row] for row in keep] + self._ids[size:]
+                texts = [self._texts[row] for row in keep] + self._texts[size:]
+                metadatas = [self._metadatas[row] for row in keep] + self._metadatas[size:]
+
+                if encoded:
+                    # 4.量化器已训练时快照之后新增的行也已编码，直接挑选编码，原始向量追加到新的临时文件
+                    rows = np.concatenate([keep, np.arange(size, self._size)])
+                    self._codes, self._code_sq_norms = np.asarray(self._codes[rows]), np.asarray(self._code_sq_norms[rows])
+                    if spilled is not None:
+                        spilled.append(self._matrix[size:self._size])
+                        self._matrix, self._sq_norms = spilled.array, np.asarray(self._sq_norms[rows])
+                    self._spilled = spilled
+                    self._size = self._encoded = rows.shape[0]
+                    self._deleted = np.zeros(self._size, dtype=bool)
+                    self._deleted[late_deleted] = True
+                    self._deleted[keep.shape[0]:] = tail_deleted
+                else:
+                    # 4.已编码的行直接挑选编码，其余的行在下次检索时增量编码
+                    tail_vectors = self._matrix[size:self._size]
+                    if self._codes is not None:
+                        encoded_rows = keep[keep < min(self._encoded, size)]
+                        self._codes = np.asarray(self._codes[encoded_rows])
+                        self._code_sq_norms = np.asarray(self._code_sq_norms[encoded_rows])
+                        self._encoded = encoded_rows.shape[0]
+
+                    # 5.整体替换，再追加快照之后新增的行
+                    self._matrix, self._sq_norms, self._size = new_matrix, new_sq_norms, keep.shape[0]
+                    self._deleted = np.zeros(keep.shape[0], dtype=bool)
+                    self._deleted[late_deleted] = True
+                    self._index = index
+                    if tail_vectors.shape[0] > 0:
+                        start = self._size
+                        self._append_vectors(tail_vectors)
+                        self._deleted[start:self._size] = tail_deleted
+                        if self._index is not None:
+                            self._index.add(self._matrix, start, self._size)
+                self._ids, self._texts, self._metadatas = ids, texts, metadatas
+                self._deleted_count = int(np.count_nonzero(self._deleted[:self._size]))
+                self._id_to_row = {id: row for row, id in enumerate(self._ids) if not self._deleted[row]}
+                self._metadata_index = MetadataIndex()
+        finally:
+            self._compaction_lock.release()
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        """传入对应的query执行相似性搜索"""
+        # 1.将query转换成向量
+        embedding = self._embedding.embed_query(query)
+
+        filter = kwargs.get("filter")
+        if self._storage == "matrix":
+            with self._lock:
+                indices, raw = self._search(
+                    np.asarray(embedding, dtype=np.float32), k, filter=filter,
+                    ef_search=kwargs.get("ef_search"), rerank_k=kwargs.get("rerank_k"),
+                )
+                return self._to_documents(indices, raw)
+
+        return self._search_dict(embedding, k, filter)
+
+    def _search_dict(self, embedding: List[float], k: int, filter: Optional[dict] = None) -> List[Document]:
+        """dict存储下的相似性搜索"""
+        # 1.循环和store中的每一个向量进行比较，计算欧几里得距离
+        result = []
+        for key, record in self.store.items():
+            if filter and not match_metadata(filter, record["metadata"]):
+                continue
+            distance = self._euclidean_distance(embedding, record["vector"])
+            result.append({"distance": distance, **record})
+
+        # 2.排序，欧几里得距离越小越靠前
+        sorted_result = sorted(result, key=lambda x: x["distance"])
+
+        # 3.取数据，取k条数据
+        result_k = sorted_result[:k]
+
+        return [
+            Document(page_content=item["text"], metadata={**item["metadata"], "score": item["distance"]})
+            for item in result_k
+        ]
+
+    def similarity_search_batch(self, queries: List[str], k: int = 4, **kwargs: Any) -> List[List[Document]]:
+        """批量执行相似性搜索，返回与queries一一对应的文档列表
+
+        每个query与similarity_search一样使用embed_query嵌入(有些嵌入模型对query和文档使用不同的指令或前缀)，
+        flat索引下只需要一次矩阵乘法即可算出全部query的距离，
+        适用于多查询重写、RAG融合、问题分解等一次需要检索多个query的场景
+        """
+        if not queries:
+            return []
+
+        # 1.逐个嵌入query，组成(查询数, 维度)的矩阵
+        embeddings = np.asarray([self._embedding.embed_query(query) for query in queries], dtype=np.float32)
+        filter = kwargs.get("filter")
+
+        # 2.dict存储逐条检索，matrix存储一次性算出全部query的结果
+        if self._storage != "matrix":
+            return [self._search_dict(embedding.tolist(), k, filter) for embedding in embeddings]
+        with self._lock:
+            return [
+                self._to_documents(indices, raw)
+                for indices, raw in self._search_batch(
+                    embeddings, k, filter=filter, ef_search=kwargs.get("ef_search"), rerank_k=kwargs.get("rerank_k"),
+                )
+            ]
+
+    def _search_batch(
+            self, queries: np.ndarray, k: int, filter: Optional[dict] = None,
+            ef_search: Optional[int] = None, rerank_k: Optional[int] = None,
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """matrix模式下的批量检索，返回与queries一一对应的(行号数组, 原始距离数组)"""
+        # 1.hnsw索引、量化存储沿用单条检索逻辑
+        if self._index is not None or self._quantizer is not None:
+            return [self._search(query, k, filter=filter, ef_search=ef_search, rerank_k=rerank_k) for query in queries]
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self._size == 0 or k <= 0:
+            return [empty for _ in queries]
+
+        # 2.flat索引用一次矩阵乘法算出(查询数, 行数)的距离矩阵，再逐行部分选择top-k
+        queries = self._prepare_query(queries)
+        allowed, rows = self._allowed_rows(filter)
+        if rows is not None and rows.shape[0] == 0:
+            return [empty for _ in queries]
+        masked = self._use_masked_scan(rows)
+        raw = self._raw_distances(queries, None if masked else rows)
+        if masked:
+            raw[:, ~allowed] = np.inf
+        limit = self._size if rows is None else rows.shape[0]
+        results = []
+        for query_raw in raw:
+            order = self._top_k_indices(query_raw, min(k, limit))
+            results.append((order if rows is None or masked else rows[order], query_raw[order]))
+        return results
+
+    def max_marginal_relevance_search(
+            self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any,
+    ) -> List[Document]:
+        """最大边际相关性搜索，在与query相关的前提下让返回的文档之间尽量不重复"""
+        embedding = self._embedding.embed_query(query)
+        return self.max_marginal_relevance_search_by_vector(embedding, k, fetch_k, lambda_mult, **kwargs)
+
+    def max_marginal_relevance_search_by_vector(
+            self, embedding: List[float], k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any,
+    ) -> List[Document]:
+        """先检索fetch_k条候选，再在候选中贪心选出k条，lambda_mult越大越偏向相关性，越小越偏向多样性"""
+        query = np.asarray(embedding, dtype=np.float32)
+        filter = kwargs.get("filter")
+
+        # 1.dict模式逐条计算距离选出候选
+        if self._storage != "matrix":
+            records = [record for record in self.store.values() if not filter or match_metadata(filter, record["metadata"])]
+            if not records or k <= 0:
+                return []
+            distances = np.array([self._euclidean_distance(embedding, record["vector"]) for record in records])
+            candidates = self._top_k_indices(distances, min(max(fetch_k, k), len(records)))
+            vectors = np.asarray([records[idx]["vector"] for idx in candidates], dtype=np.float32)
+            selected = self._mmr_select(query, vectors, k, lambda_mult)
+            return [
+                Document(
+                    page_content=records[candidates[idx]]["text"],
+                    metadata={**records[candidates[idx]]["metadata"], "score": float(distances[candidates[idx]])},
+                )
+                for idx in selected
+            ]
+
+        # 2.matrix模式复用检索逻辑(hnsw/量化/过滤/墓碑)取出候选，再一次性读取候选向量
+        with self._lock:
+            indices, raw = self._search(
+                query, max(fetch_k, k), filter=filter,
+                ef_search=kwargs.get("ef_search"), rerank_k=kwargs.get("rerank_k"),
+            )
+            if indices.shape[0] == 0:
+                return []
+            selected = self._mmr_select(query, self._vectors(indices), k, lambda_mult)
+            return self._to_documents(indices[selected], raw[selected])
+
+    def _vectors(self, rows: np.ndarray) -> np.ndarray:
+        """读取指定行的向量，原始向量已释放时(量化存储且rerank_k=0)使用量化编码还原的近似向量"""
+        if self._matrix is None:
+            return self._quantizer.decode(self._codes[rows])
+        return np.asarray(self._matrix[rows])
+
+    @classmethod
+    def _mmr_select(cls, query: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float) -> np.ndarray:
+        """贪心MMR选择，与LangChain一致使用余弦相似度，返回选中候选的下标(按选中顺序)
+
+        维护每个候选与已选文档的最大相似度向量，每选中一条只需计算它与全部候选的相似度(一次GEMV)并取逐元素最大值，
+        总复杂度为O(fetch_k·k·d)，不需要每轮重新计算候选×已选的相似度矩阵
+        """
+        # 1.候选与query归一化后，内积即余弦相似度
+        k = min(k, vectors.shape[0])
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        vectors, query = l2_normalize(vectors), l2_normalize(query)
+        query_similarity = vectors @ query
+
+        # 2.第一条直接选与query最相似的候选，之后每轮增量更新最大相似度
+        selected = [int(np.argmax(query_similarity))]
+        max_similarity = np.full(vectors.shape[0], -np.inf, dtype=np.float32)
+        is_selected = np.zeros(vectors.shape[0], dtype=bool)
+        is_selected[selected[0]] = True
+        while len(selected) < k:
+            np.maximum(max_similarity, vectors @ vectors[selected[-1]], out=max_similarity)
+            scores = lambda_mult * query_similarity - (1 - lambda_mult) * max_similarity
+            scores[is_selected] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            is_selected[best] = True
+        return np.asarray(selected, dtype=np.int64)
+
+    def _search(
+            self, query: np.ndarray, k: int, filter: Optional[dict] = None,
+            ef_search: Optional[int] = None, rerank_k: Optional[int] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """matrix模式下的检索：hnsw索引近似检索、量化编码扫描，或一次GEMV计算全部距离+部分选择top-k
+
+        返回(行号数组, 原始距离数组)，按距离升序
+        """
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self._size == 0 or k <= 0:
+            return empty
+        query = self._prepare_query(query)
+
+        # 1.先用元数据索引与墓碑计算出可检索的行，后续只对这些行计算距离
+        allowed, rows = self._allowed_rows(filter)
+        if rows is not None and rows.shape[0] == 0:
+            return empty
+
+        if self._index is not None and (rows is None or rows.shape[0] >= self.FILTER_BRUTE_FORCE_RATIO * self._size):
+            # 2.hnsw模式只计算图上被访问节点的距离(按内积构建的图，距离加1换算回余弦距离)
+            indices, raw = self._index.search(self._matrix, query, k, ef=ef_search, allowed=allowed)
+            return indices, (raw + 1 if self._index.metric != self._distance_metric else raw)
+        if self._quantizer_ready():
+            # 3.量化模式扫描编码，按需用原始向量精排(数据量不足以训练量化器时先走暴力检索)
+            return self._quantized_search(query, k, self._rerank_k if rerank_k is None else rerank_k, allowed, rows)
+
+        # 4.暴力模式一次性计算全部距离，部分选择出距离最小的k条，只对这k条排序
+        masked = self._use_masked_scan(rows)
+        raw = self._raw_distances(query, None if masked else rows)
+        if masked:
+            raw[~allowed] = np.inf
+        order = self._top_k_indices(raw, min(k, self._size if rows is None else rows.shape[0]))
+        return (order if rows is None or masked else rows[order]), raw[order]
+
+    def _to_documents(self, indices: np.ndarray, raw: np.ndarray) -> List[Document]:
+        """将检索得到的行号与原始距离组装成文档列表"""
+        distances = self._finalize_distances(raw)
+        return [
+            Document(page_content=self._texts[idx], metadata={**self._metadatas[idx], "score": float(distance)})
+            for idx, distance in zip(indices, distances)
+        ]
+
+    def _allowed_rows(self, filter: Optional[dict]) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """合并过滤条件与墓碑，返回(可检索行的掩码, 可检索的行号)，既没有过滤条件也没有删除时均为None"""
+        allowed = self._filter_mask(filter) if filter else None
+        if self._deleted_count > 0:
+            alive = ~self._deleted[:self._size]
+            allowed = alive if allowed is None else allowed & alive
+        if allowed is None:
+            return None, None
+        return allowed, np.flatnonzero(allowed)
+
+    def _use_masked_scan(self, rows: Optional[np.ndarray]) -> bool:
+        """可检索的行占大多数时(例如只有少量墓碑)，扫描全部行再屏蔽比按行号拷贝更快"""
+        return rows is not None and rows.shape[0] >= self.MASKED_SCAN_RATIO * self._size
+
+    def _filter_mask(self, filter: dict) -> np.ndarray:
+        """补齐元数据索引后计算过滤条件的行掩码"""
+        if len(self._metadata_index) < self._size:
+            self._metadata_index.add(self._metadatas[len(self._metadata_index):self._size])
+        return self._metadata_index.evaluate(filter)
+
+    def _quantized_search(
+            self, query: np.ndarray, k: int, rerank_k: int,
+            allowed: Optional[np.ndarray] = None, rows: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """用非对称距离扫描量化编码选出候选，rerank_k大于0且保留了原始向量时再精确计算候选的距离"""
+        # 1.补齐尚未编码的向量，扫描全部(或过滤后的)编码
+        self._ensure_encoded()
+        masked = self._use_masked_scan(rows)
+        if rows is None or masked:
+            codes, code_sq_norms = self._codes[:self._size], self._code_sq_norms[:self._size]
+        else:
+            codes, code_sq_norms = self._codes[rows], self._code_sq_norms[rows]
+        products = self._quantizer.inner_products(query, codes)
+        raw = self._distances_from_products(products, code_sq_norms, query)
+        limit = self._size if rows is None else rows.shape[0]
+        if masked:
+            raw[~allowed] = np.inf
+            rows = None
+        if rerank_k <= 0 or self._matrix is None:
+            order = self._top_k_indices(raw, min(k, limit))
+            return (order if rows is None else rows[order]), raw[order]
+
+        # 2.候选按行号排序后读取原始向量，mmap时只会读取这些行所在的页
+        candidates = np.sort(self._top_k_indices(raw, min(max(rerank_k, k), limit)))
+        if rows is not None:
+            candidates = rows[candidates]
+        exact = self._raw_distances(query, candidates)
+        order = self._top_k_indices(exact, k)
+        return candidates[order], exact[order]
+
+    def train_quantizer(self) -> None:
+        """用当前全部向量(重新)训练量化器并重新编码，适用于数据分布发生较大变化之后"""
+        if self._quantizer is None:
+            raise ValueError("未开启量化存储")
+        with self._lock:
+            if self._size == 0:
+                raise ValueError("向量数据库为空，无法训练量化器")
+            if self._matrix is None:
+                raise ValueError("rerank_k=0时原始向量在编码后已释放，无法重新训练量化器")
+            self._quantizer.train(self._matrix[:self._size])
+            self._encoded = 0
+            self._ensure_encoded()
+
+    def _quantizer_ready(self) -> bool:
+        """量化器已经训练，或者向量数量已经足够自动训练量化器"""
+        return self._quantizer is not None and (
+                self._quantizer.trained or self._size >= self._quantizer.min_train_size
+        )
+
+    def _ensure_encoded(self) -> None:
+        """对尚未编码的向量执行量化编码，量化器未训练时先用已有向量训练
+
+        自动训练要求向量数量不少于量化器的最少训练条数，否则训练出的编码失真，
+        rerank_k=0时编码后又会释放原始向量，之后无法再重新训练
+        """
+        if self._encoded >= self._size:
+            return
+        if not self._quantizer.trained:
+            if self._size < self._quantizer.min_train_size:
+                raise ValueError(f"至少需要{self._quantizer.min_train_size}条向量才能自动训练量化器，当前只有{self._size}条")
+            self._quantizer.train(self._matrix[:self._size])
+
+        # 1.首次编码时按照编码宽度分配数组，之后按2倍扩容
+        vectors = self._matrix[self._encoded:self._size]
+        codes = self._quantizer.encode(vectors)
+        if self._codes is None:
+            self._codes = np.empty((max(self._initial_capacity, self._size), codes.shape[1]), dtype=np.uint8)
+            self._code_sq_norms = np.empty(self._codes.shape[0], dtype=np.float32)
+        self._codes = self._grow(self._codes, self._encoded, self._size)
+        self._code_sq_norms = self._grow(self._code_sq_norms, self._encoded, self._size)
+
+        # 2.写入编码并缓存还原向量的平方范数，之后原始向量不再常驻内存
+        self._codes[self._encoded:self._size] = codes
+        self._code_sq_norms[self._encoded:self._size] = self._quantizer.reconstructed_sq_norms(codes)
+        self._encoded = self._size
+        self._release_vectors()
+
+    def _prepare_query(self, query: np.ndarray) -> np.ndarray:
+        """normalize=True时对query(或每一行query)做一次L2归一化"""
+        return l2_normalize(query) if self._normalize else query
+
+    def _raw_distances(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """计算query到全部(或rows指定的)向量的原始距离(欧几里得为平方距离)
+
+        query为一维时只需要一次矩阵向量乘法，为(查询数, 维度)的二维矩阵时只需要一次矩阵乘法，返回(查询数, 行数)
+        """
+        matrix = self._matrix[:self._size] if rows is None else self._matrix[rows]
+        if self._normalize and self._distance_metric == "cosine":
+            # 库向量与query都已归一化，余弦距离只需要内积
+            return 1 - query @ matrix.T
+        sq_norms = self._sq_norms[:self._size] if rows is None else self._sq_norms[rows]
+        return self._distances_from_products(query @ matrix.T, sq_norms, query)
+
+    def _distances_from_products(self, products: np.ndarray, sq_norms: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """由内积和库向量的平方范数换算出对应度量的原始距离，支持单条或多条query"""
+        query_sq_norms = np.einsum("...d,...d->...", query, query)
+        if products.ndim == 2:
+            query_sq_norms = query_sq_norms[:, None]
+        if self._distance_metric == "euclidean":
+            # 利用 |x-q|^2 = |x|^2 - 2x·q + |q|^2 展开，复用缓存的平方范数
+            return sq_norms - 2 * products + query_sq_norms
+        if self._distance_metric == "cosine":
+            norms = np.sqrt(sq_norms * query_sq_norms)
+            return 1 - products / np.maximum(norms, 1e-12)
+        return -products
+
+    def _finalize_distances(self, raw: np.ndarray) -> np.ndarray:
+        """将原始距离转换为对外返回的距离，欧几里得距离在这里才开方"""
+        if self._distance_metric == "euclidean":
+            return np.sqrt(np.maximum(raw, 0))
+        return raw
+
+    def _append_vectors(self, vectors: np.ndarray) -> None:
+        """将一批向量追加到矩阵尾部，容量不足时按2倍扩容"""
+        if vectors.ndim != 2:
+            raise ValueError("向量格式错误")
+        count, dim = vectors.shape
+        required = self._size + count
+        if self._dim and self._dim != dim:
+            raise ValueError(f"向量维度不一致，期望{self._dim}，实际{dim}")
+        self._dim = dim
+
+        # 1.首次写入时按照向量维度分配矩阵
+        if self._deleted is None:
+            capacity = max(self._initial_capacity, required)
+            self._matrix = np.empty((capacity, dim), dtype=np.float32)
+            self._sq_norms = np.empty(capacity, dtype=np.float32)
+            self._deleted = np.zeros(capacity, dtype=bool)
+
+        # 2.量化器训练完成后直接编码，原始向量只追加到内存映射的临时文件中(或直接丢弃)
+        if self._quantizer is not None and self._quantizer.trained:
+            self._append_encoded(vectors, required)
+        else:
+            # 3.容量不足时扩容，均摊后每次追加为O(1)，写入向量并缓存每一行的平方范数
+            self._matrix = self._grow(self._matrix, self._size, required)
+            self._sq_norms = self._grow(self._sq_norms, self._size, required)
+            self._matrix[self._size:required] = vectors
+            self._sq_norms[self._size:required] = np.einsum("ij,ij->i", vectors, vectors)
+        self._deleted = self._grow(self._deleted, self._size, required)
+        self._deleted[self._size:required] = False
+        self._size = required
+
+    def _append_encoded(self, vectors: np.ndarray, required: int) -> None:
+        """量化器已训练时追加一批向量：写入量化编码，rerank_k>0时原始向量追加到临时文件"""
+        # 1.编码并写入量化编码与还原向量的平方范数
+        codes = self._quantizer.encode(vectors)
+        self._codes = self._grow(self._codes, self._size, required)
+        self._code_sq_norms = self._grow(self._code_sq_norms, self._size, required)
+        self._codes[self._size:required] = codes
+        self._code_sq_norms[self._size:required] = self._quantizer.reconstructed_sq_norms(codes)
+        self._encoded = required
+        if self._matrix is None:
+            return
+
+        # 2.load打开的向量文件是只读的，第一次追加时先转存到临时文件，不修改磁盘上的文件
+        if self._spilled is None:
+            self._spilled = _SpilledVectors.from_rows(self._matrix[:self._size])
+        self._spilled.append(vectors)
+        self._matrix = self._spilled.array
+        self._sq_norms = self._grow(self._sq_norms, self._size, required)
+        self._sq_norms[self._size:required] = np.einsum("ij,ij->i", vectors, vectors)
+
+    def _release_vectors(self) -> None:
+        """全部向量编码完成后释放常驻内存的原始向量：rerank_k>0时转存到临时文件并内存映射，否则直接丢弃"""
+        if self._rerank_k <= 0:
+            self._matrix = self._sq_norms = None
+            self._spilled = None
+        elif self._matrix is not None and not isinstance(self._matrix, np.memmap):
+            self._spilled = _SpilledVectors.from_rows(self._matrix[:self._size])
+            self._matrix = self._spilled.array
+            self._sq_norms = np.array(self._sq_norms[:self._size])
+
+    def resident_bytes(self) -> int:
+        """向量、平方范数与量化编码实际占用的进程内存字节数，内存映射的数组不计入"""
+        arrays = [self._matrix, self._sq_norms, self._codes, self._code_sq_norms]
+        return sum(array.nbytes for array in arrays if array is not None and not isinstance(array, np.memmap))
+
+    @classmethod
+    def _grow(cls, array: np.ndarray, used: int, required: int) -> np.ndarray:
+        """行数不足required时按2倍扩容并拷贝已使用的前used行，mmap打开的只读数组也会在这里拷贝到内存"""
+        if required <= array.shape[0]:
+            return array
+        grown = np.empty((max(required, array.shape[0] * 2),) + array.shape[1:], dtype=array.dtype)
+        grown[:used] = array[:used]
+        return grown
+
+    @classmethod
+    def _top_k_indices(cls, scores: np.ndarray, k: int) -> np.ndarray:
+        """从scores中选出最小的k个下标(升序)，使用argpartition避免全量排序"""
+        if k >= scores.shape[0]:
+            return np.argsort(scores)
+        candidates = np.argpartition(scores, k - 1)[:k]
+        return candidates[np.argsort(scores[candidates])]
+
+    def save(self, path: str) -> None:
+        """将向量数据库持久化到path目录：向量写成原始float32文件，ids/文本/元数据写入json边车文件"""
+        if self._storage != "matrix":
+            raise ValueError("只有matrix存储支持持久化")
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._save(path)
+
+    def _save(self, path: str) -> None:
+        """在锁内写入全部文件，避免与写入/压缩交错"""
+        # 1.量化存储先补齐编码(rerank_k=0时原始向量随之释放，只保存量化编码)
+        quantized = self._size > 0 and self._quantizer_ready()
+        if quantized:
+            self._ensure_encoded()
+
+        # 2.向量与平方范数直接按小端float32写入，load时可以零拷贝内存映射
+        if self._size > 0:
+            if self._matrix is not None:
+                self._write_atomic(path, self.VECTORS_FILE, self._matrix[:self._size].astype("<f4", copy=False).tofile)
+                self._write_atomic(path, self.NORMS_FILE, self._sq_norms[:self._size].astype("<f4", copy=False).tofile)
+            self._write_atomic(path, self.TOMBSTONES_FILE, np.packbits(self._deleted[:self._size], bitorder="little").tofile)
+
+        # 3.量化编码同样写成原始文件，量化器参数写入npz
+        if quantized:
+            self._write_atomic(path, self.CODES_FILE, self._codes[:self._size].tofile)
+            self._write_atomic(path, self.CODE_NORMS_FILE, self._code_sq_norms[:self._size].astype("<f4", copy=False).tofile)
+            quantizer_arrays = self._quantizer.to_arrays()
+            self._write_atomic(path, self.QUANTIZER_FILE, lambda f: np.savez(f, **quantizer_arrays))
+
+        # 4.配置、ids、文本、元数据写入边车文件
+        meta = {
+            "count": self._size,
+            "dim": self._dim,
+            "vectors": self._matrix is not None,
+            "distance_metric": self._distance_metric,
+            "normalize": self._normalize,
+            "index": "hnsw" if self._index is not None else "flat",
+            "ids": self._ids,
+            "texts": self._texts,
+            "metadatas": self._metadatas,
+            "compaction": {
+                "compaction_threshold": self._compaction_threshold,
+                "background_compaction": self._background_compaction,
+            },
+        }
+        if self._quantizer is not None:
+            meta["quantization"] = {
+                "quantization": self._quantization,
+                "pq_m": getattr(self._quantizer, "m", None),
+                "rerank_k": self._rerank_k,
+            }
+        if self._index is not None:
+            meta["hnsw"] = {
+                "m": self._index.m,
+                "ef_construction": self._index.ef_construction,
+                "ef_search": self._index.ef_search,
+            }
+            arrays = self._index.to_arrays()
+            self._write_atomic(path, self.HNSW_FILE, lambda f: np.savez(f, **arrays))
+        self._write_atomic(
+            path, self.META_FILE, lambda f: f.write(json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8")),
+        )
+
+    @classmethod
+    def _write_atomic(cls, path: str, filename: str, write: Callable[[BinaryIO], Any]) -> None:
+        """先写临时文件再原子替换，避免覆盖正在被(其他进程)内存映射的旧文件"""
+        target = os.path.join(path, filename)
+        tmp = f"{target}.tmp"
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, target)
+
+    @classmethod
+    def load(cls, path: str, embedding: Embeddings, mmap: bool = True) -> "MemoryVectorStore":
+        """从path目录加载向量数据库，mmap=True时向量文件以只读内存映射的方式打开
+
+        内存映射不会把向量读入进程内存，同一台机器上的多个进程通过操作系统页缓存共享同一份数据，
+        加载后继续add_texts时矩阵会被拷贝到进程内存中扩容，不会修改磁盘文件
+        """
+        # 1.读取边车文件并还原配置
+        with open(os.path.join(path, cls.META_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        db = cls(
+            embedding=embedding,
+            storage="matrix",
+            distance_metric=meta["distance_metric"],
+            index=meta["index"],
+            normalize=meta.get("normalize", False),
+            **meta.get("hnsw", {}),
+            **meta.get("quantization", {}),
+            **meta.get("compaction", {}),
+        )
+
+        count, dim = meta["count"], meta["dim"]
+        if count == 0:
+            return db
+
+        # 2.打开向量与范数文件，mmap模式下只建立映射，不读取数据(rerank_k=0的量化存储没有保存原始向量)
+        vectors_path = os.path.join(path, cls.VECTORS_FILE)
+        norms_path = os.path.join(path, cls.NORMS_FILE)
+        has_vectors = meta.get("vectors", True)
+        if has_vectors and mmap:
+            db._matrix = np.memmap(vectors_path, dtype="<f4", mode="r", shape=(count, dim))
+            db._sq_norms = np.memmap(norms_path, dtype="<f4", mode="r", shape=(count,))
+        elif has_vectors:
+            db._matrix = np.fromfile(vectors_path, dtype="<f4").reshape(count, dim)
+            db._sq_norms = np.fromfile(norms_path, dtype="<f4")
+        db._size = count
+        db._dim = dim
+        db._ids = meta["ids"]
+        db._texts = meta["texts"]
+        db._metadatas = meta["metadatas"]
+
+        # 3.还原墓碑，并重建id到存活行号的映射
+        db._deleted = np.zeros(count, dtype=bool)
+        tombstones_path = os.path.join(path, cls.TOMBSTONES_FILE)
+        if os.path.exists(tombstones_path):
+            packed = np.fromfile(tombstones_path, dtype=np.uint8)
+            db._deleted[:] = np.unpackbits(packed, count=count, bitorder="little").astype(bool)
+        db._deleted_count = int(np.count_nonzero(db._deleted))
+        db._id_to_row = {id: row for row, id in enumerate(db._ids) if not db._deleted[row]}
+
+        # 4.还原hnsw图结构
+        if db._index is not None:
+            with np.load(os.path.join(path, cls.HNSW_FILE)) as arrays:
+                db._index.from_arrays(dict(arrays))
+
+        # 5.还原量化器与量化编码
+        if db._quantizer is not None and os.path.exists(os.path.join(path, cls.QUANTIZER_FILE)):
+            with np.load(os.path.join(path, cls.QUANTIZER_FILE)) as arrays:
+                db._quantizer.from_arrays(dict(arrays))
+            codes_path = os.path.join(path, cls.CODES_FILE)
+            code_norms_path = os.path.join(path, cls.CODE_NORMS_FILE)
+            code_size = db._quantizer.code_size(dim)
+            if mmap:
+                db._codes = np.memmap(codes_path, dtype=np.uint8, mode="r", shape=(count, code_size))
+                db._code_sq_norms = np.memmap(code_norms_path, dtype="<f4", mode="r", shape=(count,))
+            else:
+                db._codes = np.fromfile(codes_path, dtype=np.uint8).reshape(count, code_size)
+                db._code_sq_norms = np.fromfile(code_norms_path, dtype="<f4")
+            db._encoded = count
+            db._release_vectors()
+
+        return db
+
+    @classmethod
+    def from_texts(cls: Type["MemoryVectorStore"], texts: List[str], embedding: Embeddings,
+                   metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "MemoryVectorStore":
+        """从文本和元数据中去构建向量数据库"""
+        init_kwargs = {
+            key: kwargs.pop(key)
+            for key in (
+                "storage", "initial_capacity", "distance_metric", "index", "m", "ef_construction", "ef_search",
+                "quantization", "pq_m", "rerank_k", "compaction_threshold", "background_compaction", "normalize",
+            )
+            if key in kwargs
+        }
+        memory_vector_store = cls(embedding=embedding, **init_kwargs)
+        memory_vector_store.add_texts(texts, metadatas, **kwargs)
+        return memory_vector_store
+
+    @classmethod
+    def _euclidean_distance(cls, vec1: list, vec2: list) -> float:
+        """计算两个向量的欧几里得距离"""
+        return np.linalg.norm(np.array(vec1) - np.array(vec2))
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/1 15:30
+@Author  : thezehui@gmail.com
+@File    : metadata_index.py
+"""
+from collections import defaultdict
+from numbers import Number
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.structured_query import (
+    Comparator,
+    Comparison,
+    Operation,
+    Operator,
+    StructuredQuery,
+    Visitor,
+)
+
+COMPARATORS = ("$eq", "$ne", "$gt", "$gte", "$lt", "$lte", "$in", "$nin")
+
+
+def _is_numeric(value: Any) -> bool:
+    """bool是int的子类，但作为类别值处理"""
+    return isinstance(value, Number) and not isinstance(value, bool)
+
+
+def _is_hashable(value: Any) -> bool:
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def match_metadata(filter: dict, metadata: dict) -> bool:
+    """逐条判断metadata是否满足过滤条件，语义与MetadataIndex一致，供dict存储使用"""
+    results = []
+    for key, condition in filter.items():
+        if key == "$and":
+            results.append(all(match_metadata(sub_filter, metadata) for sub_filter in condition))
+        elif key == "$or":
+            results.append(any(match_metadata(sub_filter, metadata) for sub_filter in condition))
+        elif key == "$not":
+            results.append(not match_metadata(condition, metadata))
+        else:
+            conditions = condition if isinstance(condition, dict) else {"$eq": condition}
+            results.append(all(_match_value(key, op, value, metadata) for op, value in conditions.items()))
+    return all(results)
+
+
+def _match_value(field: str, op: str, value: Any, metadata: dict) -> bool:
+    """判断单个字段的单个比较条件"""
+    if op not in COMPARATORS:
+        raise ValueError(f"不支持的比较符：{op}")
+    if field not in metadata:
+        return False
+    actual = metadata[field]
+    if op in ("$gt", "$gte", "$lt", "$lte"):
+        if not _is_numeric(value):
+            raise ValueError(f"{op}只支持数值比较")
+        if not _is_numeric(actual):
+            return False
+        return {"$gt": actual > value, "$gte": actual >= value, "$lt": actual < value, "$lte": actual <= value}[op]
+    if op in ("$in", "$nin"):
+        found = any(_values_equal(actual, item) for item in value)
+        return found if op == "$in" else not found
+    equal = _values_equal(actual, value)
+    return equal if op == "$eq" else not equal
+
+
+def _values_equal(actual: Any, expected: Any) -> bool:
+    """数值按数值比较，其余值按类型+值比较(True不等于1)，列表等不可哈希的值不参与匹配"""
+    if not _is_hashable(actual) or not _is_hashable(expected):
+        return False
+    if _is_numeric(actual) and _is_numeric(expected):
+        return actual == expected
+    return type(actual) is type(expected) and actual == expected
+
+
+class _NumericColumn:
+    """数值字段索引：按值排序的(值, 行号)数组，新增数据先放入待合并区，查询前再统一排序"""
+
+    def __init__(self):
+        self.values = np.empty(0, dtype=np.float64)
+        self.rows = np.empty(0, dtype=np.int64)
+        self._pending_values: List[float] = []
+        self._pending_rows: List[int] = []
+
+    def add(self, value: float, row: int) -> None:
+        self._pending_values.append(value)
+        self._pending_rows.append(row)
+
+    def range(self, low: Optional[float], high: Optional[float], low_inclusive: bool, high_inclusive: bool) -> np.ndarray:
+        """二分查找返回值在区间内的行号"""
+        self._merge()
+        start = 0 if low is None else np.searchsorted(self.values, low, side="left" if low_inclusive else "right")
+        end = len(self.values) if high is None else np.searchsorted(self.values, high, side="right" if high_inclusive else "left")
+        return self.rows[start:end]
+
+    def _merge(self) -> None:
+        """将待合并区并入有序数组，稳定排序保证相同值的行号保持升序"""
+        if not self._pending_values:
+            return
+        values = np.concatenate([self.values, np.asarray(self._pending_values, dtype=np.float64)])
+        rows = np.concatenate([self.rows, np.asarray(self._pending_rows, dtype=np.int64)])
+        order = np.argsort(values, kind="stable")
+        self.values, self.rows = values[order], rows[order]
+        self._pending_values, self._pending_rows = [], []
+
+
+class MetadataIndex:
+    """元数据字段索引，将过滤表达式计算为行号掩码，在计算向量距离之前缩小检索范围
+
+    类别字段(字符串/布尔等)每个取值维护一个压缩位图(每行1 bit)，数值字段维护按值排序的数组，
+    $and/$or/$not直接在压缩位图上做按位运算，每个字节同时处理8行
+    """
+
+    def __init__(self):
+        self._size = 0
+        self._bitmaps: Dict[str, Dict[Any, np.ndarray]] = defaultdict(dict)  # 字段 -> 取值 -> 位图
+        self._present: Dict[str, np.ndarray] = {}  # 字段 -> 拥有该字段的行的位图
+        self._numeric: Dict[str, _NumericColumn] = defaultdict(_NumericColumn)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, metadatas: List[dict]) -> None:
+        """按行号顺序追加一批元数据"""
+        # 1.先按(字段, 取值)把行号分组，再批量写入位图
+        start = self._size
+        categorical: Dict[Tuple[str, Any], List[int]] = defaultdict(list)
+        present: Dict[str, List[int]] = defaultdict(list)
+        for row, metadata in enumerate(metadatas, start):
+            for field, value in metadata.items():
+                present[field].append(row)
+                if _is_numeric(value):
+                    self._numeric[field].add(float(value), row)
+                elif _is_hashable(value):
+                    categorical[(field, value)].append(row)
+        self._size = start + len(metadatas)
+
+        # 2.写入类别位图与字段存在位图
+        for (field, value), rows in categorical.items():
+            self._bitmaps[field][value] = self._set_bits(self._bitmaps[field].get(value), rows)
+        for field, rows in present.items():
+            self._present[field] = self._set_bits(self._present.get(field), rows)
+
+    def evaluate(self, filter: dict) -> np.ndarray:
+        """计算过滤表达式，返回长度为行数的bool掩码"""
+        bitmap = self._evaluate(filter)
+        return np.unpackbits(bitmap, count=self._size, bitorder="little").astype(bool)
+
+    def _evaluate(self, filter: dict) -> np.ndarray:
+        """递归计算过滤表达式，返回压缩位图，多个键之间为$and关系"""
+        result = self._full()
+        for key, condition in filter.items():
+            if key == "$and":
+                bitmap = self._full()
+                for sub_filter in condition:
+                    bitmap &= self._evaluate(sub_filter)
+            elif key == "$or":
+                bitmap = self._empty()
+                for sub_filter in condition:
+                    bitmap |= self._evaluate(sub_filter)
+            elif key == "$not":
+                bitmap = ~self._evaluate(condition)
+            else:
+                conditions = condition if isinstance(condition, dict) else {"$eq": condition}
+                bitmap = self._full()
+                for op, value in conditions.items():
+                    bitmap &= self._compare(key, op, value)
+            result &= bitmap
+        return result
+
+    def _compare(self, field: str, op: str, value: Any) -> np.ndarray:
+        """计算单个字段的单个比较条件"""
+        if op not in COMPARATORS:
+            raise ValueError(f"不支持的比较符：{op}")
+        if op == "$eq":
+            return self._equal(field, value)
+        if op == "$in":
+            bitmap = self._empty()
+            for item in value:
+                bitmap |= self._equal(field, item)
+            return bitmap
+        if op in ("$ne", "$nin"):
+            # 不等于只匹配拥有该字段的行
+            return self._fit(self._present.get(field)) & ~self._compare(field, "$eq" if op == "$ne" else "$in", value)
+
+        # 范围比较只走数值索引
+        if not _is_numeric(value):
+            raise ValueError(f"{op}只支持数值比较")
+        low, high = (value, None) if op in ("$gt", "$gte") else (None, value)
+        column = self._numeric.get(field)
+        rows = column.range(low, high, op == "$gte", op == "$lte") if column is not None else np.empty(0, dtype=np.int64)
+        return self._rows_to_bitmap(rows)
+
+    def _equal(self, field: str, value: Any) -> np.ndarray:
+        if _is_numeric(value):
+            column = self._numeric.get(field)
+            if column is None:
+                return self._empty()
+            return self._rows_to_bitmap(column.range(value, value, True, True))
+        if not _is_hashable(value):
+            return self._empty()
+        return self._fit(self._bitmaps.get(field, {}).get(value))
+
+    def _nbytes(self) -> int:
+        return (self._size + 7) // 8
+
+    def _empty(self) -> np.ndarray:
+        return np.zeros(self._nbytes(), dtype=np.uint8)
+
+    def _full(self) -> np.ndarray:
+        """末尾多出的位在evaluate解压时会被count截掉，不需要清零"""
+        return np.full(self._nbytes(), 0xFF, dtype=np.uint8)
+
+    def _fit(self, bitmap: Optional[np.ndarray]) -> np.ndarray:
+        """位图按当前行数补零对齐，返回新数组，避免按位运算修改索引本身"""
+        result = self._empty()
+        if bitmap is not None:
+            result[:len(bitmap)] = bitmap[:len(result)]
+        return result
+
+    def _rows_to_bitmap(self, rows: np.ndarray) -> np.ndarray:
+        mask = np.zeros(self._nbytes() * 8, dtype=bool)
+        mask[rows] = True
+        return np.packbits(mask, bitorder="little")
+
+    def _set_bits(self, bitmap: Optional[np.ndarray], rows: List[int]) -> np.ndarray:
+        """将rows对应的位置1，容量不足时按2倍扩容"""
+        rows = np.asarray(rows, dtype=np.int64)
+        required = int(rows[-1]) // 8 + 1
+        if bitmap is None:
+            bitmap = np.zeros(max(required, 128), dtype=np.uint8)
+        elif required > len(bitmap):
+            grown = np.zeros(max(required, len(bitmap) * 2), dtype=np.uint8)
+            grown[:len(bitmap)] = bitmap
+            bitmap = grown
+        np.bitwise_or.at(bitmap, rows >> 3, np.left_shift(1, rows & 7).astype(np.uint8))
+        return bitmap
+
+
+class MemoryVectorStoreTranslator(Visitor):
+    """将自查询检索器生成的结构化查询翻译为MemoryVectorStore的filter表达式"""
+    allowed_operators = [Operator.AND, Operator.OR, Operator.NOT]
+    allowed_comparators = [
+        Comparator.EQ, Comparator.NE, Comparator.GT, Comparator.GTE,
+        Comparator.LT, Comparator.LTE, Comparator.IN, Comparator.NIN,
+    ]
+
+    def visit_operation(self, operation: Operation) -> Dict:
+        args = [arg.accept(self) for arg in operation.arguments]
+        if operation.operator == Operator.NOT:
+            return {"$not": args[0] if len(args) == 1 else {"$and": args}}
+        return {f"${operation.operator.value}": args}
+
+    def visit_comparison(self, comparison: Comparison) -> Dict:
+        return {comparison.attribute: {f"${comparison.comparator.value}": comparison.value}}
+
+    def visit_structured_query(self, structured_query: StructuredQuery) -> Tuple[str, dict]:
+        if structured_query.filter is None:
+            kwargs = {}
+        else:
+            kwargs = {"filter": structured_query.filter.accept(self)}
+        return structured_query.query, kwargs
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/1 9:20
+@Author  : thezehui@gmail.com
+@File    : quantization.py
+"""
+from typing import Dict, Optional
+
+import numpy as np
+
+BLOCK_SIZE = 65536  # 分块计算时每块的行数，限制临时float32数组的大小
+
+
+class ScalarQuantizer:
+    """int8标量量化：每个维度按训练数据的[min, max]线性映射到0~255，压缩比4倍
+
+    距离计算采用非对称方式(ADC)：query保持float32，只对库中向量做量化，
+    q·x̂ = q·min + (q*scale)·code，一次矩阵向量乘法即可算完一块数据
+    """
+
+    def __init__(self):
+        self.vmin: Optional[np.ndarray] = None
+        self.scale: Optional[np.ndarray] = None
+        # 每个维度的取值范围需要足够多的向量才能统计稳定，只用少量向量训练时之后写入的向量大多被截断成相同的编码
+        self.min_train_size = 256
+
+    @property
+    def trained(self) -> bool:
+        return self.vmin is not None
+
+    def code_size(self, dim: int) -> int:
+        """每条向量编码后的字节数"""
+        return dim
+
+    def train(self, vectors: np.ndarray) -> None:
+        """统计每个维度的取值范围，训练之后新增的超出范围的值会被截断"""
+        self.vmin = vectors.min(axis=0).astype(np.float32)
+        scale = (vectors.max(axis=0) - self.vmin) / 255
+        self.scale = np.where(scale > 0, scale, 1).astype(np.float32)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """将float32向量编码为uint8"""
+        return np.clip(np.rint((vectors - self.vmin) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """将uint8编码还原为近似的float32向量"""
+        return self.vmin + codes.astype(np.float32) * self.scale
+
+    def reconstructed_sq_norms(self, codes: np.ndarray) -> np.ndarray:
+        """计算编码还原后向量的平方范数，编码时算一次缓存下来，检索时用于欧几里得/余弦距离"""
+        result = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], BLOCK_SIZE):
+            block = self.decode(codes[start:start + BLOCK_SIZE])
+            result[start:start + block.shape[0]] = np.einsum("ij,ij->i", block, block)
+        return result
+
+    def inner_products(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """非对称计算query与每条编码向量的内积"""
+        weights = query * self.scale
+        offset = float(np.dot(query, self.vmin))
+        result = np.empty(codes.shape[0], dtype=np.float32)
+        for start in range(0, codes.shape[0], BLOCK_SIZE):
+            block = codes[start:start + BLOCK_SIZE]
+            result[start:start + block.shape[0]] = block.astype(np.float32) @ weights + offset
+        return result
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"vmin": self.vmin, "scale": self.scale}
+
+    def from_arrays(self, arrays: Dict[str, np.ndarray]) -> None:
+        self.vmin = arrays["vmin"].astype(np.float32)
+        self.scale = arrays["scale"].astype(np.float32)
+
+
+class ProductQuantizer:
+    """乘积量化(PQ)：将向量切成m段子向量，每段用k-means训练256个质心，每段只存1个字节的质心编号
+
+    m默认取dim//8(每8维压缩成1字节，压缩比32倍)，距离计算时先算出query每一段到256个质心的内积表，
+    每条向量的内积即为m次查表求和
+    """
+
+    def __init__(self, m: Optional[int] = None, n_iter: int = 20, max_train_size: int = 65536, seed: Optional[int] = None):
+        self.m = m
+        self.n_centroids = 256
+        self.min_train_size = self.n_centroids
+        self.n_iter = n_iter
+        self.max_train_size = max_train_size
+        self.codebooks: Optional[np.ndarray] = None  # (m, 256, dsub)
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def trained(self) -> bool:
+        return self.codebooks is not None
+
+    def code_size(self, dim: int) -> int:
+        """每条向量编码后的字节数"""
+        return self._resolve_m(dim)
+
+    def train(self, vectors: np.ndarray) -> None:
+        """在每一段子空间上独立执行k-means训练质心"""
+        count, dim = vectors.shape
+        m = self._resolve_m(dim)
+        if count < self.n_centroids:
+            raise ValueError(f"乘积量化至少需要{self.n_centroids}条向量进行训练，当前只有{count}条")
+
+        # 1.数据量过大时随机采样训练，质心质量对采样数量不敏感
+        if count > self.max_train_size:
+            vectors = vectors[np.sort(self._rng.choice(count, self.max_train_size, replace=False))]
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        # 2.逐段训练码本
+        dsub = dim // m
+        self.m = m
+        self.codebooks = np.stack([
+            self._kmeans(np.ascontiguousarray(vectors[:, i * dsub:(i + 1) * dsub]))
+            for i in range(m)
+        ])
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """每一段子向量编码为最近质心的编号"""
+        dsub = self.codebooks.shape[2]
+        codes = np.empty((vectors.shape[0], self.m), dtype=np.uint8)
+        for start in range(0, vectors.shape[0], BLOCK_SIZE):
+            block = np.asarray(vectors[start:start + BLOCK_SIZE], dtype=np.float32)
+            for i in range(self.m):
+                codes[start:start + block.shape[0], i] = self._nearest(block[:, i * dsub:(i + 1) * dsub], self.codebooks[i])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """将质心编号还原为近似的float32向量"""
+        return np.concatenate([self.codebooks[i][codes[:, i]] for i in range(self.m)], axis=1)
+
+    def reconstructed_sq_norms(self, codes: np.ndarray) -> np.ndarray:
+        """计算编码还原后向量的平方范数：每段质心的平方范数查表累加"""
+        table = np.einsum("mcd,mcd->mc", self.codebooks, self.codebooks)
+        result = np.zeros(codes.shape[0], dtype=np.float32)
+        for i in range(self.m):
+            result += table[i][codes[:, i]]
+        return result
+
+    def inner_products(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """非对称计算query与每条编码向量的内积：先建(m, 256)的内积表，再逐段查表累加"""
+        dsub = self.codebooks.shape[2]
+        table = np.einsum("mcd,md->mc", self.codebooks, query.reshape(self.m, dsub))
+        result = np.zeros(codes.shape[0], dtype=np.float32)
+        for i in range(self.m):
+            result += table[i][codes[:, i]]
+        return result
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"codebooks": self.codebooks}
+
+    def from_arrays(self, arrays: Dict[str, np.ndarray]) -> None:
+        self.codebooks = arrays["codebooks"].astype(np.float32)
+        self.m = self.codebooks.shape[0]
+
+    def _resolve_m(self, dim: int) -> int:
+        """计算分段数，并校验维度能否被整除"""
+        m = self.m or max(dim // 8, 1)
+        if dim % m != 0:
+            raise ValueError(f"向量维度{dim}无法被分段数{m}整除")
+        return m
+
+    def _kmeans(self, vectors: np.ndarray) -> np.ndarray:
+        """简单的Lloyd k-means，空簇用随机样本重新初始化"""
+        centroids = vectors[self._rng.choice(vectors.shape[0], self.n_centroids, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assignments = self._nearest(vectors, centroids)
+            counts = np.bincount(assignments, minlength=self.n_centroids)
+            sums = np.stack([
+                np.bincount(assignments, weights=vectors[:, d], minlength=self.n_centroids)
+                for d in range(vectors.shape[1])
+            ], axis=1)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            if empty.any():
+                centroids[empty] = vectors[self._rng.choice(vectors.shape[0], int(empty.sum()), replace=False)]
+        return centroids
+
+    @classmethod
+    def _nearest(cls, vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """返回每个向量最近质心的编号，|x-c|^2中|x|^2对所有质心相同，可以省略"""
+        scores = (centroids * centroids).sum(axis=1) - 2 * (vectors @ centroids.T)
+        return scores.argmin(axis=1)
+
+
+def create_quantizer(quantization: str, pq_m: Optional[int] = None):
+    """根据名称创建量化器"""
+    if quantization == "sq8":
+        return ScalarQuantizer()
+    if quantization == "pq":
+        return ProductQuantizer(m=pq_m)
+    raise ValueError(f"不支持的量化方式：{quantization}")
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 10:20
+@Author  : thezehui@gmail.com
+@File    : sharded_vector_store.py
+"""
+import heapq
+import itertools
+import multiprocessing
+import os
+import threading
+import uuid
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Connection
+from typing import Dict, List, Optional, Any, Iterable, Type, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from threadpoolctl import threadpool_limits
+
+from memory_vector_store import MemoryVectorStore
+from vector_math import l2_normalize
+
+
+class _SharedArray:
+    """命名共享内存上的numpy数组，父进程创建并写入，分片进程按名称映射同一块内存"""
+
+    def __init__(self, shape: Tuple[int, ...], name: Optional[str] = None):
+        nbytes = max(int(np.prod(shape)) * 4, 1)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=nbytes if name is None else 0)
+        self.array = np.ndarray(shape, dtype=np.float32, buffer=self.shm.buf)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def close(self, unlink: bool = False) -> None:
+        """释放映射，unlink=True时同时删除共享内存(只由创建方调用)"""
+        self.array = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class _ShardStore(MemoryVectorStore):
+    """分片进程内的向量数据库，矩阵与平方范数直接使用父进程写入的共享内存，不再拷贝一份"""
+
+    def attach(
+            self, matrix: np.ndarray, sq_norms: np.ndarray, size: int, metadatas: List[dict], deleted_rows: List[int],
+    ) -> None:
+        """映射扩容后的共享内存，登记新增的行(元数据用于过滤，hnsw图在分片进程内增量构建)，并把被覆盖的旧行标记为墓碑"""
+        start = self._size
+        self._matrix, self._sq_norms, self._size = matrix, sq_norms, size
+        self._metadatas.extend(metadatas)
+        self._deleted = self._grow(np.zeros(0, dtype=bool) if self._deleted is None else self._deleted, start, size)
+        self._deleted[start:size] = False
+        self._deleted[deleted_rows] = True
+        self._deleted_count += len(deleted_rows)
+        if self._index is not None:
+            self._index.add(self._matrix, start, size)
+
+    def _release_vectors(self) -> None:
+        """原始向量在父进程管理的共享内存中，编码后不能由分片释放"""
+
+
+def _shard_worker(conn: Connection, store_kwargs: dict) -> None:
+    """分片进程主循环：接收父进程的attach/search/close命令"""
+    # 1.每个分片进程只使用一个BLAS线程，N个进程正好占满N个核心，避免线程超额订阅
+    threadpool_limits(limits=1)
+    # 2.共享内存由父进程管理，分片内不能压缩重建矩阵，被覆盖的行只标记为墓碑；创建失败时把异常发回父进程
+    try:
+        store = _ShardStore(embedding=None, compaction_threshold=None, **store_kwargs)
+    except Exception as e:
+        conn.send(e)
+        return
+    conn.send(None)
+    segments: List[_SharedArray] = []
+
+    while True:
+        command, payload = conn.recv()
+        if command == "attach":
+            # 3.父进程写入新数据(或扩容)后重新映射共享内存，旧的映射在切换之后释放
+            names, capacity, dim, size, metadatas, deleted_rows = payload
+            if not segments or segments[0].name != names[0]:
+                new_segments = [_SharedArray((capacity, dim), names[0]), _SharedArray((capacity,), names[1])]
+            else:
+                new_segments = segments
+            store.attach(new_segments[0].array, new_segments[1].array, size, metadatas, deleted_rows)
+            if new_segments is not segments:
+                for segment in segments:
+                    segment.close()
+                segments = new_segments
+            conn.send(True)
+        elif command == "search":
+            # 4.在本分片内检索，返回每个query的(行号, 距离)，距离已按度量换算，升序排列
+            queries, k, filter, ef_search, rerank_k = payload
+            results = store._search_batch(queries, k, filter=filter, ef_search=ef_search, rerank_k=rerank_k)
+            conn.send([(indices, store._finalize_distances(raw)) for indices, raw in results])
+        elif command == "close":
+            store._matrix = store._sq_norms = None
+            for segment in segments:
+                segment.close()
+            conn.send(True)
+            return
+
+
+class _Shard:
+    """父进程中一个分片的句柄：工作进程、通信管道、共享内存，以及该分片的ids/文本/元数据"""
+
+    def __init__(self, process: multiprocessing.Process, conn: Connection):
+        self.process = process
+        self.conn = conn
+        self.vectors: Optional[_SharedArray] = None
+        self.norms: Optional[_SharedArray] = None
+        self.size = 0
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.id_to_row: Dict[str, int] = {}  # id -> 分片内存活的行号，相同id总是落在同一个分片
+        self.retired: List[_SharedArray] = []  # 扩容后等待分片进程切换映射的旧共享内存
+
+    def append(self, vectors: np.ndarray) -> None:
+        """将向量写入共享内存尾部，容量不足时新建2倍容量的共享内存并拷贝已有数据"""
+        count, dim = vectors.shape
+        required = self.size + count
+        capacity = 0 if self.vectors is None else self.vectors.array.shape[0]
+        if required > capacity:
+            capacity = max(required, capacity * 2, 1024)
+            grown_vectors, grown_norms = _SharedArray((capacity, dim)), _SharedArray((capacity,))
+            if self.vectors is not None:
+                grown_vectors.array[:self.size] = self.vectors.array[:self.size]
+                grown_norms.array[:self.size] = self.norms.array[:self.size]
+                self.retired.extend([self.vectors, self.norms])
+            self.vectors, self.norms = grown_vectors, grown_norms
+        self.vectors.array[self.size:required] = vectors
+        self.norms.array[self.size:required] = np.einsum("ij,ij->i", vectors, vectors)
+        self.size = required
+
+
+class ShardedMemoryVectorStore(VectorStore):
+    """按id哈希分片到多个工作进程的向量数据库
+
+    单个Python进程的距离计算只能用满一个核心，这里把向量按crc32(id) % n_shards分到n_shards个进程，
+    每个分片的向量矩阵放在共享内存中(父进程写入，分片进程直接映射，不经过管道拷贝)，
+    检索时同一批query同时发给所有分片并行计算各自的top-k，父进程再做k路归并得到全局top-k
+
+    除storage与compaction_threshold外，其余参数(distance_metric/index/quantization等)原样传给每个分片的MemoryVectorStore，
+    add_texts/upsert传入已存在的id时覆盖旧数据(旧行在分片内标记为墓碑，共享内存由父进程管理，分片不做压缩)，
+    暂不支持删除，使用完毕后需要调用close()(或使用with语句)结束进程并释放共享内存
+    """
+
+    def __init__(self, embedding: Embeddings, n_shards: Optional[int] = None, **store_kwargs: Any):
+        if store_kwargs.get("storage", "matrix") != "matrix":
+            raise ValueError("分片存储只支持matrix存储")
+        if store_kwargs.get("compaction_threshold") is not None:
+            raise ValueError("分片存储不支持compaction_threshold，覆盖写入的旧行只标记为墓碑")
+        for key in ("storage", "compaction_threshold", "background_compaction"):
+            store_kwargs.pop(key, None)
+        MemoryVectorStore(embedding=embedding, compaction_threshold=None, **store_kwargs)  # 提前在父进程中校验参数
+        self._embedding = embedding
+        self._normalize = store_kwargs.get("normalize", False)
+        self._n_shards = max(int(n_shards or os.cpu_count() or 1), 1)
+        self._lock = threading.Lock()  # 管道上的请求与响应必须成对，多线程调用时串行化
+
+        # 启动分片进程，使用平台默认的启动方式(spawn方式下调用方脚本需要放在if __name__ == "__main__"中)
+        # 先在父进程启动resource_tracker，分片进程继承同一个tracker，映射共享内存时不会再各自登记一份并在退出时误删
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context()
+        self._shards: List[_Shard] = []
+        for _ in range(self._n_shards):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_shard_worker, args=(child_conn, store_kwargs), daemon=True)
+            process.start()
+            child_conn.close()
+            self._shards.append(_Shard(process, parent_conn))
+
+        # 等待所有分片进程创建好各自的向量数据库，任何一个失败时结束全部分片并抛出原始异常
+        with self._lock:
+            errors = [error for error in self._exchange([(shard, None) for shard in self._shards]) if error is not None]
+            if errors:
+                self._close()
+                raise RuntimeError("分片进程启动失败") from errors[0]
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        """将数据添加到向量数据库中，按id哈希写入对应分片的共享内存"""
+        # 1.检测metadata与ids的数据格式
+        texts = list(texts)
+        if metadatas is not None and len(metadatas) != len(texts):
+            raise ValueError("metadatas格式错误")
+        ids = kwargs.get("ids")
+        if ids is not None and len(ids) != len(texts):
+            raise ValueError("ids格式错误")
+        if not texts:
+            return []
+
+        # 2.嵌入并计算每条数据所在的分片，crc32在不同进程/不同次运行之间保持一致(内置hash会随机加盐)
+        embeddings = np.asarray(self._embedding.embed_documents(texts), dtype=np.float32)
+        if self._normalize:
+            embeddings = l2_normalize(embeddings)
+        ids = [str(uuid.uuid4()) if ids is None or ids[idx] is None else str(ids[idx]) for idx in range(len(texts))]
+        metadatas = metadatas if metadatas is not None else [{} for _ in texts]
+        shard_of = np.fromiter(
+            (zlib.crc32(id.encode("utf-8")) % self._n_shards for id in ids), dtype=np.int64, count=len(ids),
+        )
+
+        with self._lock:
+            # 3.逐个分片写入共享内存，id已存在时(包括同一批次内重复)记录被覆盖的旧行，以最后一次写入为准
+            requests = []
+            for shard_id, shard in enumerate(self._shards):
+                positions = np.flatnonzero(shard_of == shard_id)
+                if positions.shape[0] == 0:
+                    continue
+                deleted_rows = []
+                for row, position in enumerate(positions, shard.size):
+                    old_row = shard.id_to_row.get(ids[position])
+                    if old_row is not None:
+                        deleted_rows.append(old_row)
+                    shard.id_to_row[ids[position]] = row
+                shard.append(embeddings[positions])
+                shard.ids.extend(ids[position] for position in positions)
+                shard.texts.extend(texts[position] for position in positions)
+                new_metadatas = [metadatas[position] for position in positions]
+                shard.metadatas.extend(new_metadatas)
+                requests.append((shard, (
+                    "attach",
+                    ((shard.vectors.name, shard.norms.name), shard.vectors.array.shape[0],
+                     embeddings.shape[1], shard.size, new_metadatas, deleted_rows),
+                )))
+
+            # 4.通知分片进程映射新数据(各分片并行构建hnsw等索引)，全部切换完成后再释放扩容前的旧共享内存
+            self._exchange(requests)
+            for shard, _ in requests:
+                for segment in shard.retired:
+                    segment.close(unlink=True)
+                shard.retired = []
+        return ids
+
+    def upsert(self, ids: List[str], texts: List[str], metadatas: Optional[List[dict]] = None) -> List[str]:
+        """按id插入或覆盖数据"""
+        return self.add_texts(texts, metadatas, ids=ids)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        """传入对应的query执行相似性搜索"""
+        embedding = np.asarray([self._embedding.embed_query(query)], dtype=np.float32)
+        return self._search(embedding, k, **kwargs)[0]
+
+    def similarity_search_batch(self, queries: List[str], k: int = 4, **kwargs: Any) -> List[List[Document]]:
+        """批量执行相似性搜索，每个query与similarity_search一样使用embed_query嵌入，再一次分发到各个分片"""
+        if not queries:
+            return []
+        embeddings = np.asarray([self._embedding.embed_query(query) for query in queries], dtype=np.float32)
+        return self._search(embeddings, k, **kwargs)
+
+    def _search(self, queries: np.ndarray, k: int, **kwargs: Any) -> List[List[Document]]:
+        """把query分发到所有分片并行检索，再对每个query做k路归并取全局top-k"""
+        with self._lock:
+            # 1.先把请求发给所有分片，再依次接收结果，各分片的计算互相重叠
+            shards = [shard for shard in self._shards if shard.size > 0]
+            payload = (queries, k, kwargs.get("filter"), kwargs.get("ef_search"), kwargs.get("rerank_k"))
+            replies = self._exchange([(shard, ("search", payload)) for shard in shards])
+
+        # 2.每个分片返回的结果已按距离升序，用堆做k路归并，只取前k条
+        results = []
+        for query_idx in range(queries.shape[0]):
+            streams = []
+            for shard_idx, reply in enumerate(replies):
+                indices, distances = reply[query_idx]
+                streams.append(zip(distances.tolist(), itertools.repeat(shard_idx), indices.tolist()))
+            results.append([
+                Document(
+                    page_content=shards[shard_idx].texts[row],
+                    metadata={**shards[shard_idx].metadatas[row], "score": distance},
+                )
+                for distance, shard_idx, row in itertools.islice(heapq.merge(*streams), k)
+            ])
+        return results
+
+    def _exchange(self, requests: List[Tuple[_Shard, Optional[tuple]]]) -> list:
+        """先把请求发给所有分片(None表示只接收)，再依次接收响应，需要持有self._lock
+
+        某个分片进程异常退出时，结束全部分片并删除共享内存，避免共享内存泄漏
+        """
+        try:
+            for shard, request in requests:
+                if request is not None:
+                    shard.conn.send(request)
+            return [shard.conn.recv() for shard, _ in requests]
+        except (EOFError, OSError) as e:
+            self._close()
+            raise RuntimeError("分片进程异常退出，已结束全部分片并释放共享内存") from e
+
+    def close(self) -> None:
+        """结束所有分片进程并删除共享内存"""
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        """结束所有分片进程并删除共享内存，需要持有self._lock，已经退出的分片进程直接回收"""
+        for shard in self._shards:
+            if shard.process.is_alive():
+                try:
+                    shard.conn.send(("close", None))
+                    shard.conn.recv()
+                except (EOFError, OSError):
+                    shard.process.terminate()
+            shard.process.join()
+            shard.conn.close()
+            for segment in [shard.vectors, shard.norms] + shard.retired:
+                if segment is not None:
+                    segment.close(unlink=True)
+        self._shards = []
+
+    def __enter__(self) -> "ShardedMemoryVectorStore":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    @classmethod
+    def from_texts(cls: Type["ShardedMemoryVectorStore"], texts: List[str], embedding: Embeddings,
+                   metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "ShardedMemoryVectorStore":
+        """从文本和元数据中去构建分片向量数据库"""
+        init_kwargs = {
+            key: kwargs.pop(key)
+            for key in (
+                "n_shards", "initial_capacity", "distance_metric", "index", "m", "ef_construction", "ef_search",
+                "quantization", "pq_m", "rerank_k", "normalize",
+            )
+            if key in kwargs
+        }
+        sharded_vector_store = cls(embedding=embedding, **init_kwargs)
+        sharded_vector_store.add_texts(texts, metadatas, **kwargs)
+        return sharded_vector_store
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 15:30
+@Author  : thezehui@gmail.com
+@File    : vector_math.py
+"""
+import numpy as np
+
+
+def l2_normalize(vectors) -> np.ndarray:
+    """按行做L2归一化(一维向量视为一行)，零向量保持为零"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def cosine_similarity_matrix(x, y, normalized: bool = False) -> np.ndarray:
+    """计算x(m条)与y(n条)两两之间的余弦相似度，返回(m, n)矩阵
+
+    两边各归一化一次，再用一次矩阵乘法算完全部组合，不需要对每一对向量重复计算范数；
+    normalized=True表示输入已经归一化(例如提前归一化好的库向量)，直接做矩阵乘法
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=np.float32))
+    y = np.atleast_2d(np.asarray(y, dtype=np.float32))
+    if not normalized:
+        x, y = l2_normalize(x), l2_normalize(y)
+    return x @ y.T
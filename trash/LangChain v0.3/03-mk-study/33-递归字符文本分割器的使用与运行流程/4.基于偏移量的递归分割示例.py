@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 17:20
+@Author  : thezehui@gmail.com
+@File    : 4.基于偏移量的递归分割示例.py
+"""
+import time
+
+from langchain_community.document_loaders import UnstructuredMarkdownLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from span_text_splitter import SpanRecursiveCharacterTextSplitter
+
+# 1.创建加载器和两个参数相同的文本分割器
+loader = UnstructuredMarkdownLoader("./项目API文档.md")
+separators = [
+    "\n\n",
+    "\n",
+    "。|！|？",
+    "\.\s|\!\s|\?\s",  # 英文标点符号后面通常需要加空格
+    "；|;\s",
+    "，|,\s",
+    " ",
+    ""
+]
+kwargs = dict(separators=separators, is_separator_regex=True, chunk_size=500, chunk_overlap=50)
+text_splitter = RecursiveCharacterTextSplitter(**kwargs)
+span_text_splitter = SpanRecursiveCharacterTextSplitter(**kwargs)
+
+# 2.切分得到每个文本块在原文中的偏移，需要时再截取出文本
+text = loader.load()[0].page_content
+spans = span_text_splitter.split_spans(text)
+for start, end in spans[:5]:
+    print(f"偏移: ({start}, {end}), 块大小: {end - start}")
+
+# 3.两个分割器的结果一致，放大文本后对比耗时
+print(span_text_splitter.split_text(text) == text_splitter.split_text(text))
+large_text = text * 2000
+for name, splitter in [("RecursiveCharacterTextSplitter", text_splitter), ("SpanRecursiveCharacterTextSplitter", span_text_splitter)]:
+    start = time.perf_counter()
+    splitter.split_text(large_text)
+    print(f"{name}: {len(large_text) / 1024 / 1024:.1f}M字符, 耗时{time.perf_counter() - start:.2f}s")
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 19:10
+@Author  : thezehui@gmail.com
+@File    : 5.流式分割大文件示例.py
+"""
+from streaming_text_splitter import StreamingCharacterTextSplitter, StreamingRecursiveCharacterTextSplitter
+
+# 1.创建流式递归字符文本分割器，参数与RecursiveCharacterTextSplitter一致
+text_splitter = StreamingRecursiveCharacterTextSplitter(
+    chunk_size=500,
+    chunk_overlap=50,
+    add_start_index=True,
+    block_size=64 * 1024,  # 每次从文件中读取的字符数
+)
+
+# 2.直接传递文件句柄，边读边切分，大文件不需要一次性读入内存
+with open("./项目API文档.md", encoding="utf-8") as f:
+    for chunk in text_splitter.stream_documents(f, metadata={"source": "./项目API文档.md"}):
+        print(f"块大小: {len(chunk.page_content)}, 元数据: {chunk.metadata}")
+
+# 3.字符文本分割器同样支持流式切分，输入也可以是任意文本迭代器(例如逐行读取的日志)
+char_splitter = StreamingCharacterTextSplitter(separator="\n\n", chunk_size=500, chunk_overlap=50)
+with open("./项目API文档.md", encoding="utf-8") as f:
+    print(sum(1 for _ in char_splitter.split_stream(line for line in f)))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 20:05
+@Author  : thezehui@gmail.com
+@File    : 6.偏移量文本块内存对比.py
+"""
+import tracemalloc
+
+from langchain_community.document_loaders import UnstructuredMarkdownLoader
+from langchain_core.documents import Document
+
+from span_text_splitter import SpanRecursiveCharacterTextSplitter
+
+# 1.加载文档并放大，模拟大批量入库的场景
+loader = UnstructuredMarkdownLoader("./项目API文档.md")
+document = loader.load()[0]
+large_document = Document(page_content=document.page_content * 200, metadata=document.metadata)
+text_splitter = SpanRecursiveCharacterTextSplitter(chunk_size=100, chunk_overlap=10, add_start_index=True)
+
+# 2.TextChunk只保存原文引用和偏移，page_content/metadata在访问时生成
+chunks = text_splitter.split_documents_as_chunks([document])
+print(chunks[1], chunks[1].metadata)
+
+# 3.对比Document与TextChunk占用的内存
+for name, split in [
+    ("Document", text_splitter.split_documents),
+    ("TextChunk", text_splitter.split_documents_as_chunks),
+]:
+    tracemalloc.start()
+    result = split([large_document])
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name}: 文本块数{len(result)}, 占用内存{current / 1024 / 1024:.1f}MB, 峰值{peak / 1024 / 1024:.1f}MB")
+    del result
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 16:40
+@Author  : thezehui@gmail.com
+@File    : span_text_splitter.py
+"""
+import copy
+import operator
+import re
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Any, Iterable, List, Optional, Pattern, Tuple
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+Span = Tuple[int, int]
+
+
+class TextChunk:
+    """基于偏移量的文本块，只保存原文的引用和(start, end)偏移
+
+    每个Document都持有一份拷贝出来的page_content和一份深拷贝的元数据，相邻文本块之间的重叠部分也会被重复保存。
+    TextChunk与同一篇文档的其他文本块共享原文和元数据，page_content、metadata在访问时才生成，
+    start_index就是start本身，具有page_content和metadata属性，可以直接传给VectorStore.add_documents
+    """
+
+    __slots__ = ("text", "start", "end", "source_metadata", "add_start_index")
+
+    def __init__(self, text: str, start: int, end: int, source_metadata: dict, add_start_index: bool = False):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.source_metadata = source_metadata
+        self.add_start_index = add_start_index
+
+    @property
+    def page_content(self) -> str:
+        return self.text[self.start:self.end]
+
+    @property
+    def metadata(self) -> dict:
+        metadata = copy.deepcopy(self.source_metadata)
+        if self.add_start_index:
+            metadata["start_index"] = self.start
+        return metadata
+
+    def to_document(self) -> Document:
+        return Document(page_content=self.page_content, metadata=self.metadata)
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __str__(self) -> str:
+        return self.page_content
+
+    def __repr__(self) -> str:
+        return f"TextChunk(start={self.start}, end={self.end}, page_content={self.page_content[:20]!r})"
+
+
+class SpanRecursiveCharacterTextSplitter(RecursiveCharacterTextSplitter):
+    """基于偏移量的递归字符文本分割器
+
+    RecursiveCharacterTextSplitter在每一层递归中都会对每个分隔符重新re.escape/re.search，
+    再用re.split和列表推导式生成新的子字符串列表，切分大文本时大量时间花在字符串拷贝上。
+    这里在初始化时把分隔符一次性编译好，切分与合并全程只记录(start, end)偏移，不产生中间字符串，
+    每一层只在当前区间内扫描一遍，最后才按偏移截取出文本块，切分结果与RecursiveCharacterTextSplitter一致。
+
+    注意：keep_separator=False时，文本块的划分与RecursiveCharacterTextSplitter相同，但文本块内容直接截取自原文，
+    保留原有的(连续)分隔符，而不是把片段用单个分隔符重新拼接
+    """
+
+    def __init__(self, separators: Optional[List[str]] = None, **kwargs: Any):
+        super().__init__(separators=separators, **kwargs)
+        # 1.预编译分隔符层级，空字符串表示按单个字符切分
+        self._patterns: List[Optional[Pattern]] = [
+            re.compile(s if self._is_separator_regex else re.escape(s)) if s else None
+            for s in self._separators
+        ]
+
+    def split_text(self, text: str) -> List[str]:
+        return [text[start:end] for start, end in self.split_spans(text)]
+
+    def create_chunks(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[TextChunk]:
+        """切分多个文本，返回TextChunk列表，同一个文本的所有文本块共享原文与元数据"""
+        metadatas = metadatas or [{}] * len(texts)
+        return [
+            TextChunk(text, start, end, metadata, self._add_start_index)
+            for text, metadata in zip(texts, metadatas)
+            for start, end in self.split_spans(text)
+        ]
+
+    def split_documents_as_chunks(self, documents: Iterable[Document]) -> List[TextChunk]:
+        """切分文档，返回TextChunk列表"""
+        documents = list(documents)
+        return self.create_chunks([doc.page_content for doc in documents], [doc.metadata for doc in documents])
+
+    def create_documents(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[Document]:
+        """与TextSplitter.create_documents相同，start_index直接取自切分偏移，不需要在原文中重新查找文本块"""
+        return [chunk.to_document() for chunk in self.create_chunks(texts, metadatas)]
+
+    def split_spans(self, text: str) -> List[Span]:
+        """切分文本，返回每个文本块在原文中的(start, end)偏移"""
+        spans: List[Span] = []
+        self._split_spans(text, 0, len(text), 0, spans)
+        return spans
+
+    def _split_spans(self, text: str, start: int, end: int, level: int, spans: List[Span]) -> None:
+        # 1.找到当前区间内存在的第一个分隔符，直接在原文上搜索，不截取子字符串
+        level = next(
+            (i for i in range(level, len(self._patterns))
+             if self._patterns[i] is None or self._patterns[i].search(text, start, end)),
+            len(self._patterns) - 1,
+        )
+        separator = "" if self._keep_separator else self._separators[level]
+        separator_len = self._length_function(separator)
+
+        # 2.切出当前区间的全部片段偏移并计算长度
+        starts, ends = self._piece_offsets(text, start, end, self._patterns[level])
+        if self._length_function is len:
+            lengths = list(map(operator.sub, ends, starts))
+        else:
+            lengths = [self._length_function(text[s:e]) for s, e in zip(starts, ends)]
+
+        # 3.相邻的小片段合并为文本块，过长的片段使用下一级分隔符递归切分
+        run_start = 0
+        for i in [i for i, length in enumerate(lengths) if length >= self._chunk_size] + [len(starts)]:
+            if i > run_start:
+                self._merge_spans(text, starts[run_start:i], ends[run_start:i], lengths[run_start:i], separator_len, spans)
+            if i < len(starts):
+                if level + 1 >= len(self._patterns):
+                    spans.append((starts[i], ends[i]))
+                else:
+                    self._split_spans(text, starts[i], ends[i], level + 1, spans)
+            run_start = i + 1
+
+    def _piece_offsets(self, text: str, start: int, end: int, pattern: Optional[Pattern]) -> Tuple[List[int], List[int]]:
+        """按分隔符切出非空片段的(起始偏移列表, 结束偏移列表)，keep_separator决定分隔符归属于后一个片段、前一个片段或被丢弃"""
+        if pattern is None:
+            return list(range(start, end)), list(range(start + 1, end + 1))
+        if self._keep_separator == "end":
+            cuts = [match.end() for match in pattern.finditer(text, start, end)]
+            starts, ends = [start] + cuts, cuts + [end]
+        elif self._keep_separator:
+            cuts = [match.start() for match in pattern.finditer(text, start, end)]
+            starts, ends = [start] + cuts, cuts + [end]
+        else:
+            matches = [match.span() for match in pattern.finditer(text, start, end)]
+            starts = [start] + [match_end for _, match_end in matches]
+            ends = [match_start for match_start, _ in matches] + [end]
+        if all(map(operator.lt, starts, ends)):
+            return starts, ends
+        pieces = [(s, e) for s, e in zip(starts, ends) if e > s]
+        return [s for s, _ in pieces], [e for _, e in pieces]
+
+    def _merge_spans(
+            self,
+            text: str,
+            starts: List[int],
+            ends: List[int],
+            lengths: List[int],
+            separator_len: int,
+            spans: List[Span],
+    ) -> None:
+        """将连续的小片段合并为不超过chunk_size的文本块，相邻文本块之间保留不超过chunk_overlap的重叠
+
+        与TextSplitter._merge_splits逐个片段累加/弹出的结果相同：prefix[k]为前k个片段的长度加分隔符长度之和，
+        片段first~last合并后的长度为prefix[last + 1] - prefix[first] - separator_len，
+        每个文本块的结尾和下一个文本块的开头都可以在prefix上二分查找得到
+        """
+        n = len(starts)
+        prefix = list(accumulate(lengths, lambda total, length: total + length + separator_len, initial=0)) \
+            if separator_len else list(accumulate(lengths, initial=0))
+        first, last = 0, 0
+        while True:
+            # 1.向后扩展，直到再加入下一个片段就会超过chunk_size
+            limit = bisect_right(prefix, prefix[first] + separator_len + self._chunk_size)
+            last = max(last, min(limit - 2, n - 1))
+            self._append_span(text, starts[first], ends[last], spans)
+            if last == n - 1:
+                return
+
+            # 2.从头部丢弃片段，直到剩余部分不超过chunk_overlap，并且能放下下一个片段
+            budget = min(self._chunk_overlap, max(self._chunk_size - lengths[last + 1] - separator_len, 0))
+            first = max(first, bisect_left(prefix, prefix[last + 1] - separator_len - budget, 0, last + 2))
+            last += 1
+
+    def _append_span(self, text: str, start: int, end: int, spans: List[Span]) -> None:
+        """去除首尾空白后记录文本块偏移，空白文本块直接丢弃"""
+        if self._strip_whitespace:
+            while start < end and text[start].isspace():
+                start += 1
+            while end > start and text[end - 1].isspace():
+                end -= 1
+        if end > start:
+            spans.append((start, end))
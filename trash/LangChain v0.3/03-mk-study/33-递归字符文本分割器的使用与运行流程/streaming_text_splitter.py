@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 18:30
+@Author  : thezehui@gmail.com
+@File    : streaming_text_splitter.py
+"""
+import copy
+import re
+from collections import deque
+from typing import Any, Deque, Iterable, Iterator, Optional, Pattern, Tuple, Union, TextIO
+
+from langchain_core.documents import Document
+from langchain_text_splitters import CharacterTextSplitter, TextSplitter
+
+from span_text_splitter import SpanRecursiveCharacterTextSplitter
+
+TextSource = Union[str, TextIO, Iterable[str]]
+Piece = Tuple[str, int, int]  # (片段文本, 长度, 在原文中的起始偏移)
+
+
+def iter_text_blocks(source: TextSource, block_size: int = 1 << 16) -> Iterator[str]:
+    """把字符串、文件句柄或文本迭代器统一转换为非空文本块迭代器，文件句柄每次读取block_size个字符"""
+    if isinstance(source, str):
+        blocks = (source[i:i + block_size] for i in range(0, len(source), block_size))
+    elif hasattr(source, "read"):
+        blocks = iter(lambda: source.read(block_size), "")
+    else:
+        blocks = iter(source)
+    return (block for block in blocks if block)
+
+
+class _ChunkMerger:
+    """TextSplitter._merge_splits的增量版本：逐个接收小片段，放不下时产出一个文本块，并保留不超过chunk_overlap的重叠片段"""
+
+    def __init__(self, splitter: TextSplitter, separator: str):
+        self.splitter = splitter
+        self.separator = separator
+        self.separator_len = splitter._length_function(separator)
+        self.current: Deque[Piece] = deque()
+        self.total = 0
+
+    def add(self, piece: Piece) -> Iterator[Tuple[str, int]]:
+        chunk_size, separator_len, length = self.splitter._chunk_size, self.separator_len, piece[1]
+        if self.current and self.total + length + separator_len > chunk_size:
+            yield from self.flush(keep_overlap=True)
+            while self.current and (self.total > self.splitter._chunk_overlap or (
+                    self.total + length + separator_len > chunk_size and self.total > 0)):
+                self.total -= self.current.popleft()[1] + (separator_len if self.current else 0)
+        self.current.append(piece)
+        self.total += length + (separator_len if len(self.current) > 1 else 0)
+
+    def flush(self, keep_overlap: bool = False) -> Iterator[Tuple[str, int]]:
+        """产出当前累积的文本块及其起始偏移，keep_overlap=False时清空累积状态"""
+        if self.current:
+            text = self.separator.join(piece[0] for piece in self.current)
+            start = self.current[0][2]
+            if self.splitter._strip_whitespace:
+                stripped = text.lstrip()
+                start += len(text) - len(stripped)
+                text = stripped.rstrip()
+            if text:
+                yield text, start
+        if not keep_overlap:
+            self.current.clear()
+            self.total = 0
+
+
+class _PieceReader:
+    """从文本块迭代器中按分隔符读出片段，只在缓冲区内保留尚未处理完的片段
+
+    分隔符的匹配结果需要看到后面的文本才能确定(例如"\\n\\n"可能被拆在两个文本块之间)，
+    因此只有当匹配位置之后至少还有lookahead个字符(或已读到结尾)时才确认这个匹配，分隔符本身的长度不能超过lookahead
+    """
+
+    def __init__(self, blocks: Iterator[str], pattern: Pattern, keep_separator: Union[bool, str], lookahead: int, offset: int):
+        self.blocks = blocks
+        self.pattern = pattern
+        self.keep_separator = keep_separator
+        self.lookahead = lookahead
+        self.buffer = ""
+        self.base = offset  # buffer[0]在原文中的偏移
+        self.piece_start = 0  # 当前片段在buffer中的起始位置
+        self.search_from = 0  # 下一次搜索分隔符的起始位置
+        self.eof = False
+
+    @property
+    def safe_end(self) -> int:
+        """buffer中该位置之前的文本已经可以确定是否存在分隔符"""
+        return len(self.buffer) if self.eof else max(len(self.buffer) - self.lookahead, 0)
+
+    def fill(self) -> None:
+        """丢弃已经处理完的文本，再读入一个文本块"""
+        if self.piece_start:
+            self.buffer = self.buffer[self.piece_start:]
+            self.base += self.piece_start
+            self.search_from -= self.piece_start
+            self.piece_start = 0
+        block = next(self.blocks, None)
+        if block is None:
+            self.eof = True
+        else:
+            self.buffer += block
+
+    def next_cut(self) -> Optional[Tuple[int, int]]:
+        """查找已确认的下一个分隔符，返回(当前片段的结束位置, 下一个片段的起始位置)，没有时返回None"""
+        match = self.pattern.search(self.buffer, self.search_from)
+        if match is None or match.start() >= self.safe_end:
+            return None
+        self.search_from = match.end() if match.end() > match.start() else match.end() + 1
+        if self.keep_separator == "end":
+            return match.end(), match.end()
+        if self.keep_separator:
+            return match.start(), match.start()
+        return match.start(), match.end()
+
+    def pending_length(self, length_function) -> int:
+        """当前片段中已经确定的部分的长度"""
+        if length_function is len:
+            return self.safe_end - self.piece_start
+        return length_function(self.buffer[self.piece_start:self.safe_end])
+
+    def take(self, end: int, next_start: int) -> Tuple[str, int]:
+        """取出buffer[piece_start:end]及其在原文中的偏移，并将片段起点移动到next_start"""
+        text, start = self.buffer[self.piece_start:end], self.base + self.piece_start
+        self.piece_start = next_start
+        return text, start
+
+    def rest_of_piece(self) -> Iterator[str]:
+        """逐段产出当前(过长)片段的剩余文本，直到遇到下一个分隔符或读到结尾"""
+        while True:
+            cut = self.next_cut()
+            if cut is not None:
+                yield self.take(*cut)[0]
+                return
+            if self.eof:
+                yield self.take(len(self.buffer), len(self.buffer))[0]
+                return
+            safe_end = self.safe_end
+            if safe_end > self.piece_start:
+                yield self.take(safe_end, safe_end)[0]
+                self.search_from = max(self.search_from, safe_end)
+            self.fill()
+
+
+class StreamingRecursiveCharacterTextSplitter(SpanRecursiveCharacterTextSplitter):
+    """支持流式输入的递归字符文本分割器
+
+    split_stream可以接收字符串、文件句柄或文本迭代器，边读边切分边产出文本块，不需要把整个文档读入内存，
+    缓冲区中只保留尚未合并完的片段，内存占用与chunk_size、block_size相关，与输入大小无关。
+    每一级分隔符对应一个流式切分器，过长的片段以文本块流的形式交给下一级分隔符继续切分，
+    文本块之间的chunk_overlap跨越读取边界时同样保留，切分结果与RecursiveCharacterTextSplitter对整个文本调用split_text一致
+    """
+
+    def __init__(self, block_size: int = 1 << 16, lookahead: int = 64, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.block_size = block_size
+        self.lookahead = lookahead
+
+    def split_stream(self, source: TextSource) -> Iterator[str]:
+        """流式切分，逐个产出文本块"""
+        for text, _ in self._split_stream(iter_text_blocks(source, self.block_size), 0, 0):
+            yield text
+
+    def stream_documents(self, source: TextSource, metadata: Optional[dict] = None) -> Iterator[Document]:
+        """流式切分并产出Document，add_start_index=True时直接使用切分过程中记录的偏移"""
+        for text, start in self._split_stream(iter_text_blocks(source, self.block_size), 0, 0):
+            chunk_metadata = copy.deepcopy(metadata or {})
+            if self._add_start_index:
+                chunk_metadata["start_index"] = start
+            yield Document(page_content=text, metadata=chunk_metadata)
+
+    def _split_stream(self, blocks: Iterator[str], level: int, offset: int) -> Iterator[Tuple[str, int]]:
+        """使用第level级分隔符流式切分，产出(文本块, 起始偏移)"""
+        merger = _ChunkMerger(self, "" if self._keep_separator else self._separators[level])
+        for piece, rest in _iter_pieces(self, blocks, self._patterns[level], self.lookahead, offset):
+            if rest is None:
+                yield from merger.add(piece)
+                continue
+            # 过长的片段：先产出已经累积的文本块，再交给下一级分隔符
+            yield from merger.flush()
+            if level + 1 >= len(self._patterns):
+                yield "".join(rest), piece[2]
+            else:
+                yield from self._split_stream(rest, level + 1, piece[2])
+        yield from merger.flush()
+
+
+class StreamingCharacterTextSplitter(CharacterTextSplitter):
+    """支持流式输入的字符文本分割器，用法与StreamingRecursiveCharacterTextSplitter相同
+
+    CharacterTextSplitter不会继续切分过长的片段，因此单个超过chunk_size的片段会被完整读入内存后作为一个文本块产出
+    """
+
+    def __init__(self, block_size: int = 1 << 16, lookahead: int = 64, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.block_size = block_size
+        self.lookahead = lookahead
+        separator = self._separator if self._is_separator_regex else re.escape(self._separator)
+        self._pattern = re.compile(separator) if separator else None
+
+    def split_stream(self, source: TextSource) -> Iterator[str]:
+        """流式切分，逐个产出文本块"""
+        merger = _ChunkMerger(self, "" if self._keep_separator else self._separator)
+        for piece, rest in _iter_pieces(self, iter_text_blocks(source, self.block_size), self._pattern, self.lookahead, 0):
+            if rest is not None:
+                text = "".join(rest)
+                piece = (text, self._length_function(text), piece[2])
+            for text, _ in merger.add(piece):
+                yield text
+        for text, _ in merger.flush():
+            yield text
+
+
+def _iter_pieces(
+        splitter: TextSplitter,
+        blocks: Iterator[str],
+        pattern: Optional[Pattern],
+        lookahead: int,
+        offset: int,
+) -> Iterator[Tuple[Piece, Optional[Iterator[str]]]]:
+    """按分隔符流式切出片段：长度小于chunk_size的片段产出(片段, None)；
+    过长的片段产出((None, None, 起始偏移), 剩余文本迭代器)，调用方需要先消费完该迭代器再继续迭代
+    """
+    length_function, chunk_size = splitter._length_function, splitter._chunk_size
+
+    # 1.空分隔符：每个字符都是一个片段
+    if pattern is None:
+        for block in blocks:
+            for i, char in enumerate(block):
+                length = length_function(char)
+                if length < chunk_size:
+                    yield (char, length, offset + i), None
+                else:
+                    yield (None, None, offset + i), iter([char])
+            offset += len(block)
+        return
+
+    # 2.正则分隔符：确认分隔符后取出完整片段，片段还没结束但已经过长时，剩余部分以迭代器的形式交给调用方
+    reader = _PieceReader(blocks, pattern, splitter._keep_separator, lookahead, offset)
+    while True:
+        cut = reader.next_cut()
+        if cut is None and reader.eof:
+            if reader.piece_start >= len(reader.buffer):
+                return
+            cut = (len(reader.buffer), len(reader.buffer))
+        if cut is not None:
+            text, start = reader.take(*cut)
+            if text:
+                length = length_function(text)
+                yield ((text, length, start), None) if length < chunk_size else ((None, None, start), iter([text]))
+            continue
+        if reader.pending_length(length_function) >= chunk_size:
+            rest = reader.rest_of_piece()
+            yield (None, None, reader.base + reader.piece_start), rest
+            for _ in rest:  # 调用方没有消费完时跳过剩余部分，保证读取位置正确
+                pass
+            continue
+        reader.fill()
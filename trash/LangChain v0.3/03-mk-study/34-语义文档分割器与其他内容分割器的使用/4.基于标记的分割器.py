@@ -5,20 +5,16 @@
 @Author  : thezehui@gmail.com
 @File    : 4.基于标记的分割器.py
 """
-import tiktoken
 from langchain_community.document_loaders import UnstructuredFileLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from token_length import TokenRecursiveCharacterTextSplitter, token_length_function
 
-def calculate_token_count(query: str) -> int:
-    """计算传入文本的token数"""
-    encoding = tiktoken.encoding_for_model("text-embedding-3-large")
-    return len(encoding.encode(query))
+# 计算传入文本的token数，编码器只创建一次，最近计算过的片段长度会被缓存
+calculate_token_count = token_length_function("text-embedding-3-large")
 
-
-# 1.定义加载器和文本分割器
+# 1.定义加载器和文本分割器，每一层切分出的片段会通过encode_batch批量计算token数
 loader = UnstructuredFileLoader("./科幻短篇.txt")
-text_splitter = RecursiveCharacterTextSplitter(
+text_splitter = TokenRecursiveCharacterTextSplitter(
     separators=[
         "\n\n",
         "\n",
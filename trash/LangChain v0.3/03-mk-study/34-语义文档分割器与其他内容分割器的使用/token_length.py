@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/2 23:05
+@Author  : thezehui@gmail.com
+@File    : token_length.py
+"""
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List
+
+import tiktoken
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_text_splitters.character import _split_text_with_regex
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """按模型名获取tiktoken编码器，每个模型只创建一次"""
+    return tiktoken.encoding_for_model(model_name)
+
+
+class TokenLengthFunction:
+    """可作为length_function传递给文本分割器的token计数函数
+
+    文本分割器在切分和合并时会对每个片段、每个分隔符反复调用length_function，同一片段通常会被计算多次，
+    这里复用同一个编码器，并用容量为cache_size的LRU缓存最近计算过的文本长度
+    """
+
+    def __init__(self, model_name: str = "text-embedding-3-large", cache_size: int = 10000):
+        if cache_size <= 0:
+            raise ValueError("cache_size必须大于0")
+        self.encoding = get_encoding(model_name)
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[str, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> int:
+        """计算单条文本的token数"""
+        with self._lock:
+            length = self._cache.get(text)
+            if length is not None:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return length
+        length = len(self.encoding.encode_ordinary(text))
+        with self._lock:
+            self.misses += 1
+            self._put(text, length)
+        return length
+
+    def encode_batch(self, texts: List[str]) -> List[int]:
+        """批量计算token数，缓存中没有的文本去重后一次性交给编码器(多线程)编码"""
+        # 1.先从缓存中取出已知长度
+        with self._lock:
+            known = {text: self._cache[text] for text in texts if text in self._cache}
+            for text in known:
+                self._cache.move_to_end(text)
+
+        # 2.未命中的文本去重后批量编码，再写回缓存
+        missing = list(dict.fromkeys(text for text in texts if text not in known))
+        if missing:
+            known.update(zip(missing, map(len, self.encoding.encode_ordinary_batch(missing))))
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+            for text in missing:
+                self._put(text, known[text])
+        return [known[text] for text in texts]
+
+    def _put(self, text: str, length: int) -> None:
+        self._cache[text] = length
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+def token_length_function(model_name: str = "text-embedding-3-large", cache_size: int = 10000) -> TokenLengthFunction:
+    """创建按模型计算token数的length_function"""
+    return TokenLengthFunction(model_name, cache_size)
+
+
+class TokenRecursiveCharacterTextSplitter(RecursiveCharacterTextSplitter):
+    """使用TokenLengthFunction的递归字符分割器
+
+    与RecursiveCharacterTextSplitter的切分结果一致，区别在于每一层切出的片段先通过encode_batch批量计算长度，
+    之后判断片段大小与合并片段时的长度查询全部命中缓存
+    """
+
+    def __init__(self, length_function: TokenLengthFunction, **kwargs):
+        super().__init__(length_function=length_function, **kwargs)
+
+    def _split_text(self, text: str, separators: List[str]) -> List[str]:
+        # 1.找到文本中存在的第一个分隔符，剩余的分隔符用于继续切分过长的片段
+        separator, new_separators = separators[-1], []
+        for i, _s in enumerate(separators):
+            _separator = _s if self._is_separator_regex else re.escape(_s)
+            if _s == "":
+                separator = _s
+                break
+            if re.search(_separator, text):
+                separator, new_separators = _s, separators[i + 1:]
+                break
+
+        # 2.切分后批量计算所有片段的token数
+        _separator = separator if self._is_separator_regex else re.escape(separator)
+        splits = _split_text_with_regex(text, _separator, self._keep_separator)
+        _separator = "" if self._keep_separator else separator
+        lengths = self._length_function.encode_batch(splits + [_separator])
+
+        # 3.合并小片段，递归切分过长的片段
+        final_chunks, good_splits = [], []
+        for s, length in zip(splits, lengths):
+            if length < self._chunk_size:
+                good_splits.append(s)
+                continue
+            if good_splits:
+                final_chunks.extend(self._merge_splits(good_splits, _separator))
+                good_splits = []
+            if not new_separators:
+                final_chunks.append(s)
+            else:
+                final_chunks.extend(self._split_text(s, new_separators))
+        if good_splits:
+            final_chunks.extend(self._merge_splits(good_splits, _separator))
+        return final_chunks
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/3 23:45
+@Author  : thezehui@gmail.com
+@File    : rag_fusion_retriever.py
+"""
+from typing import List, Tuple
+
+from langchain.load import dumps, loads
+from langchain.retrievers import MultiQueryRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+
+
+class RAGFusionRetriever(MultiQueryRetriever):
+    """RAG多查询结果融合策略检索器"""
+    k: int = 4
+    rrf_k: int = 60  # RRF公式1/(rank+rrf_k)中的平滑常数
+
+    def retrieve_documents(
+            self, queries: List[str], run_manager: CallbackManagerForRetrieverRun
+    ) -> List[List]:
+        """重写检索文档函数，返回值变成一个嵌套的列表"""
+        # 1.向量数据库提供批量检索(例如MemoryVectorStore.similarity_search_batch)时，相似性检索一次完成所有query
+        vectorstore = getattr(self.retriever, "vectorstore", None)
+        if self.retriever.search_type == "similarity" and hasattr(vectorstore, "similarity_search_batch"):
+            return self._retrieve_batch(vectorstore, queries, run_manager)
+
+        # 2.否则逐个query调用检索器，使用各个向量数据库自己的query嵌入与检索逻辑
+        documents = []
+        for query in queries:
+            docs = self.retriever.invoke(
+                query, config={"callbacks": run_manager.get_child()}
+            )
+            documents.append(docs)
+        return documents
+
+    def _retrieve_batch(
+            self, vectorstore, queries: List[str], run_manager: CallbackManagerForRetrieverRun
+    ) -> List[List[Document]]:
+        """批量检索所有query，并为每个query创建子检索回调，与逐个调用检索器时的回调保持一致"""
+        # 1.为每个query开启一个子检索运行
+        child_runs = [
+            run_manager.get_child().on_retriever_start(None, query, name=self.retriever.get_name())
+            for query in queries
+        ]
+
+        # 2.一次完成所有query的检索，出错时通知全部子运行
+        try:
+            documents = vectorstore.similarity_search_batch(queries, **self.retriever.search_kwargs)
+        except Exception as e:
+            for child_run in child_runs:
+                child_run.on_retriever_error(e)
+            raise
+
+        # 3.逐个结束子运行
+        for child_run, docs in zip(child_runs, documents):
+            child_run.on_retriever_end(docs)
+        return documents
+
+    def rrf_fuse(self, documents: List[List[Document]]) -> List[Tuple[Document, float]]:
+        """使用RRF算法融合多个query的检索结果，返回按得分降序排列的(文档, 得分)列表"""
+        # 1.定义一个变量存储每个文档的得分信息
+        fused_result = {}
+
+        # 2.循环两层获取每一个文档信息
+        for docs in documents:
+            for rank, doc in enumerate(docs):
+                # 3.去掉每个query各自的检索得分后再使用dumps函数将文档转换成字符串，
+                # 保证不同query检索到的同一个文档对应同一个键
+                doc = Document(
+                    id=doc.id,
+                    page_content=doc.page_content,
+                    metadata={key: value for key, value in doc.metadata.items() if key != "score"},
+                )
+                doc_str = dumps(doc)
+                # 4.判断下该文档的字符串是否已经计算过得分
+                if doc_str not in fused_result:
+                    fused_result[doc_str] = 0
+                # 5.计算新的分
+                fused_result[doc_str] += 1 / (rank + self.rrf_k)
+
+        # 6.执行排序操作，获取相应的数据，使用的是降序
+        return [
+            (loads(doc), score)
+            for doc, score in sorted(fused_result.items(), key=lambda x: x[1], reverse=True)
+        ]
+
+    def unique_union(self, documents: List[List]) -> List[Document]:
+        """使用RRF算法来去重合并对应的文档，参数为嵌套列表，返回值为文档列表"""
+        return [doc for doc, _ in self.rrf_fuse(documents)[:self.k]]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/7/4 10:12
+@Author  : thezehui@gmail.com
+@File    : test_rag_fusion_retriever.py
+"""
+from typing import Any, Iterable, List, Optional
+
+import pytest
+from langchain_core.callbacks import BaseCallbackHandler, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import FakeListLLM
+from langchain_core.vectorstores import VectorStore
+
+from rag_fusion_retriever import RAGFusionRetriever
+
+DOC_A = Document(page_content="LLMOps应用配置说明", metadata={"source": "a.md"})
+DOC_B = Document(page_content="LLMOps插件列表", metadata={"source": "b.md"})
+DOC_C = Document(page_content="LLMOps知识库管理", metadata={"source": "c.md"})
+
+
+class StubVectorStore(VectorStore):
+    """按query返回固定结果的向量数据库，每个文档附带该query下的检索得分，按向量检索时记录调用次数"""
+
+    def __init__(self, results: dict):
+        self.results = results
+        self.batch_calls = 0
+        self.vector_calls = 0
+        self._embedding = DeterministicFakeEmbedding(size=4)
+        self._queries_by_vector = {
+            tuple(self._embedding.embed_query(query)): query for query in results
+        }
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def _with_scores(self, query: str, k: int) -> List[Document]:
+        return [
+            Document(page_content=doc.page_content, metadata={**doc.metadata, "score": len(query) - rank})
+            for rank, doc in enumerate(self.results[query][:k])
+        ]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        self.vector_calls += 1
+        return self._with_scores(self._queries_by_vector[tuple(embedding)], k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self._with_scores(query, k)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+
+class BatchStubVectorStore(StubVectorStore):
+    """额外支持一次检索多个query的向量数据库"""
+
+    def similarity_search_batch(self, queries: List[str], k: int = 4, **kwargs: Any) -> List[List[Document]]:
+        self.batch_calls += 1
+        return [self._with_scores(query, k) for query in queries]
+
+
+class RetrieverCounter(BaseCallbackHandler):
+    """记录子检索运行的开始与结束"""
+
+    def __init__(self):
+        self.queries = []
+        self.ended = 0
+
+    def on_retriever_start(self, serialized, query, **kwargs):
+        self.queries.append(query)
+
+    def on_retriever_end(self, documents, **kwargs):
+        self.ended += 1
+
+
+def _fusion_retriever(vectorstore: VectorStore) -> RAGFusionRetriever:
+    return RAGFusionRetriever.from_llm(
+        retriever=vectorstore.as_retriever(search_type="similarity"),
+        llm=FakeListLLM(responses=["query1\nquery2"]),
+        include_original=False,
+    )
+
+
+def _run_manager() -> CallbackManagerForRetrieverRun:
+    return CallbackManagerForRetrieverRun.get_noop_manager()
+
+
+def test_same_document_from_two_queries_is_fused():
+    vectorstore = BatchStubVectorStore({"query1": [DOC_A, DOC_B], "query2": [DOC_C, DOC_A]})
+    retriever = _fusion_retriever(vectorstore)
+
+    fused = retriever.rrf_fuse(retriever.retrieve_documents(["query1", "query2"], _run_manager()))
+
+    # DOC_A在query1中排第0、在query2中排第1，两个query的得分不同但只保留一份，RRF得分相加
+    assert [doc.page_content for doc, _ in fused] == [DOC_A.page_content, DOC_C.page_content, DOC_B.page_content]
+    assert [score for _, score in fused] == pytest.approx([1 / 60 + 1 / 61, 1 / 60, 1 / 61])
+    assert all("score" not in doc.metadata for doc, _ in fused)
+    assert fused[0][0].metadata == DOC_A.metadata
+
+
+def test_batch_path_reports_child_retriever_runs():
+    vectorstore = BatchStubVectorStore({"query1": [DOC_A, DOC_B], "query2": [DOC_C, DOC_A]})
+    counter = RetrieverCounter()
+
+    docs = _fusion_retriever(vectorstore).invoke("LLMOps应用配置", config={"callbacks": [counter]})
+
+    assert vectorstore.batch_calls == 1
+    assert [doc.page_content for doc in docs] == [DOC_A.page_content, DOC_C.page_content, DOC_B.page_content]
+    # 外层检索器1次 + 每个改写query各1次子运行
+    assert counter.queries == ["LLMOps应用配置", "query1", "query2"]
+    assert counter.ended == 3
+
+
+def test_store_without_batch_search_uses_its_own_similarity_search():
+    vectorstore = StubVectorStore({"query1": [DOC_A, DOC_B], "query2": [DOC_C, DOC_A]})
+    counter = RetrieverCounter()
+
+    docs = _fusion_retriever(vectorstore).invoke("LLMOps应用配置", config={"callbacks": [counter]})
+
+    # 没有批量检索的向量数据库逐个query走检索器，不会绕过similarity_search自行嵌入query
+    assert vectorstore.vector_calls == 0
+    assert [doc.page_content for doc in docs] == [DOC_A.page_content, DOC_C.page_content, DOC_B.page_content]
+    assert counter.ended == 3
@@ -6,7 +6,7 @@
 @File    : 9.语义路由选择不同的Prompt模板.py
 """
 import dotenv
-from langchain.utils.math import cosine_similarity
+import numpy as np
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableLambda
@@ -31,16 +31,18 @@ math_template = """你是一位非常优秀的数学家。你擅长回答数学
 # 2.创建文本嵌入模型，并执行嵌入
 embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
 prompt_templates = [physics_template, math_template]
-prompt_embeddings = embeddings.embed_documents(prompt_templates)
+prompt_embeddings = np.array(embeddings.embed_documents(prompt_templates))
+# 模板向量提前做L2归一化，之后每次路由只需要归一化query并做一次内积
+prompt_embeddings /= np.linalg.norm(prompt_embeddings, axis=1, keepdims=True)
 
 
 def prompt_router(input) -> ChatPromptTemplate:
     """根据传递的query计算返回不同的提示模板"""
     # 1.计算传入query的嵌入向量
-    query_embedding = embeddings.embed_query(input["query"])
+    query_embedding = np.array(embeddings.embed_query(input["query"]))
 
-    # 2.计算相似性
-    similarity = cosine_similarity([query_embedding], prompt_embeddings)[0]
+    # 2.计算相似性，归一化后的内积即余弦相似度
+    similarity = prompt_embeddings @ (query_embedding / np.linalg.norm(query_embedding))
     most_similar = prompt_templates[similarity.argmax()]
     print("使用数学模板" if most_similar == math_template else "使用物理模板")
 
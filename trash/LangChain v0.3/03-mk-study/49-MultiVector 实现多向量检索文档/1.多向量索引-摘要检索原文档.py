@@ -18,6 +18,8 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from batched_embeddings import BatchedEmbeddings
+
 dotenv.load_dotenv()
 
 # 1.创建加载器、文本分割器并处理文档
@@ -47,7 +49,7 @@ summary_docs = [
 byte_store = LocalFileStore("./multy-vector")
 db = FAISS.from_documents(
     summary_docs,
-    embedding=OpenAIEmbeddings(model="text-embedding-3-small"),
+    embedding=BatchedEmbeddings(OpenAIEmbeddings(model="text-embedding-3-small"), max_concurrency=5),
 )
 
 # 6.构建多向量检索器
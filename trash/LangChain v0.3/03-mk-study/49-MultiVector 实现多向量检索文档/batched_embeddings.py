@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 10:30
+@Author  : thezehui@gmail.com
+@File    : batched_embeddings.py
+"""
+# 51-递归文档树检索课程通过lesson_paths.py把本目录加入导入路径后直接导入本模块，本模块只保留这一份
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+import tiktoken
+from langchain_core.embeddings import Embeddings
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """按模型名获取tiktoken编码器，每个模型只创建一次，未知模型回退到cl100k_base"""
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+class BatchedEmbeddings(Embeddings):
+    """批内去重+按token预算分批+并发请求的文本嵌入包装器
+
+    1.同一批文本中内容完全相同的只嵌入一次(按内容哈希去重)
+    2.去重后的文本按顺序装入子批次，每个子批次的token数不超过max_batch_tokens、条数不超过max_batch_size，
+      token数默认使用缓存的tiktoken编码器一次性批量计算，也可以传递length_function自定义
+    3.子批次通过有界线程池(异步接口为信号量)并发请求，最多同时发出max_concurrency个请求
+    4.结果按原始顺序散回，重复文本共享同一个向量
+
+    作为CacheBackedEmbeddings的底层嵌入模型时，缓存未命中的文本也会按上述方式去重并发补齐
+    """
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            max_batch_tokens: int = 8000,
+            max_batch_size: int = 512,
+            max_concurrency: int = 4,
+            length_function: Optional[Callable[[str], int]] = None,
+            model_name: str = "text-embedding-3-small",
+    ):
+        if max_batch_tokens <= 0 or max_batch_size <= 0 or max_concurrency <= 0:
+            raise ValueError("max_batch_tokens、max_batch_size、max_concurrency必须大于0")
+        self.embeddings = embeddings
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.length_function = length_function
+        self.model_name = model_name  # 未传递length_function时，用该模型的tiktoken编码器计算token数
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """去重、分批并发嵌入，返回与texts一一对应的向量"""
+        unique_texts, positions = self._deduplicate(texts)
+        batches = self._split_batches(unique_texts)
+
+        # 1.只有一个子批次时直接请求，否则通过线程池并发请求
+        if len(batches) <= 1:
+            results = [self.embeddings.embed_documents(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                results = list(executor.map(self.embeddings.embed_documents, batches))
+
+        # 2.按原始顺序散回
+        vectors = [vector for result in results for vector in result]
+        return [vectors[position] for position in positions]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """异步版本，使用信号量限制同时进行的请求数"""
+        unique_texts, positions = self._deduplicate(texts)
+        batches = self._split_batches(unique_texts)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            async with semaphore:
+                return await self.embeddings.aembed_documents(batch)
+
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        vectors = [vector for result in results for vector in result]
+        return [vectors[position] for position in positions]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
+
+    @classmethod
+    def _deduplicate(cls, texts: List[str]) -> Tuple[List[str], List[int]]:
+        """返回(去重后的文本, 每条原始文本在去重列表中的下标)"""
+        index_of: Dict[str, int] = {}
+        positions = [index_of.setdefault(text, len(index_of)) for text in texts]
+        return list(index_of), positions
+
+    def _split_batches(self, texts: List[str]) -> List[List[str]]:
+        """按顺序装箱：当前子批次放不下下一条文本(token数或条数超限)时另起一个子批次，超长文本单独成批"""
+        batches: List[List[str]] = []
+        batch: List[str] = []
+        batch_tokens = 0
+        for text, tokens in zip(texts, self._count_tokens(texts)):
+            if batch and (batch_tokens + tokens > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _count_tokens(self, texts: List[str]) -> List[int]:
+        """计算每条文本的token数，默认编码器会在多个线程中批量编码"""
+        if self.length_function is not None:
+            return [self.length_function(text) for text in texts]
+        encoding = get_encoding(self.model_name)
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
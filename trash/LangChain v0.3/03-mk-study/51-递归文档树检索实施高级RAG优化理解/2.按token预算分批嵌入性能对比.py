@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 11:20
+@Author  : thezehui@gmail.com
+@File    : 2.按token预算分批嵌入性能对比.py
+"""
+import threading
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+import lesson_paths  # noqa: F401  把49-课程目录加入导入路径，batched_embeddings只在49-中保留一份
+from batched_embeddings import BatchedEmbeddings, get_encoding
+
+MAX_REQUEST_TOKENS = 8192  # 单次请求的token上限
+MODEL_NAME = "text-embedding-3-small"
+
+
+class FakeAPIEmbeddings(Embeddings):
+    """模拟嵌入接口：每次请求有固定延迟+按token数增长的耗时，超过单次请求token上限时报错，并统计请求次数"""
+
+    def __init__(self, request_latency: float = 0.05, token_latency: float = 2e-6):
+        self.request_latency = request_latency
+        self.token_latency = token_latency
+        self.encoding = get_encoding(MODEL_NAME)
+        self.requests = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        tokens = sum(len(t) for t in self.encoding.encode_ordinary_batch(texts))
+        with self._lock:
+            self.requests += 1
+            if tokens > MAX_REQUEST_TOKENS:
+                self.failed += 1
+        time.sleep(self.request_latency + tokens * self.token_latency)
+        return [[float(len(text)), 0.0] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def embed_by_count(embeddings: Embeddings, texts: List[str], chunk_size: int) -> None:
+    """按条数分批，与OpenAIEmbeddings的chunk_size参数行为一致"""
+    for start in range(0, len(texts), chunk_size):
+        embeddings.embed_documents(texts[start:start + chunk_size])
+
+
+def report(name: str, embeddings: FakeAPIEmbeddings, elapsed: float) -> None:
+    print(f"{name}: 请求数{embeddings.requests}, 超限请求数{embeddings.failed}, 耗时{elapsed:.2f}s")
+
+
+# 1.构造长短不一的文本块：大多数是几十到几百token的短块，少数是接近上限的长块
+with open("./流浪地球.txt", encoding="utf-8") as f:
+    content = f.read()
+rng = np.random.default_rng(42)
+lengths = np.where(rng.random(1000) < 0.02, rng.integers(1500, 2500, 1000), rng.integers(30, 300, 1000))
+texts = [content[start:start + length] for start, length in zip(rng.integers(0, len(content) - 2500, 1000), lengths)]
+token_counts = [len(t) for t in get_encoding(MODEL_NAME).encode_ordinary_batch(texts)]
+print(f"文本块数{len(texts)}, 总token数{sum(token_counts)}, 最长文本块{max(token_counts)}token")
+
+# 2.按条数分批：条数设大了会有请求超过token上限，设小到不会超限时请求数又太多
+embeddings = FakeAPIEmbeddings()
+start = time.perf_counter()
+embed_by_count(embeddings, texts, chunk_size=32)
+report("按条数分批(32条/批)", embeddings, time.perf_counter() - start)
+
+safe_chunk_size = max(1, MAX_REQUEST_TOKENS // max(token_counts))
+embeddings = FakeAPIEmbeddings()
+start = time.perf_counter()
+embed_by_count(embeddings, texts, chunk_size=safe_chunk_size)
+report(f"按条数分批({safe_chunk_size}条/批，不超限)", embeddings, time.perf_counter() - start)
+
+# 3.按token预算分批：每个请求尽量装满token预算，且不会超过上限
+for max_concurrency in [1, 4]:
+    embeddings = FakeAPIEmbeddings()
+    batched = BatchedEmbeddings(
+        embeddings, max_batch_tokens=MAX_REQUEST_TOKENS, max_concurrency=max_concurrency, model_name=MODEL_NAME,
+    )
+    start = time.perf_counter()
+    batched.embed_documents(texts)
+    report(f"按token预算分批(并发{max_concurrency})", embeddings, time.perf_counter() - start)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 11:50
+@Author  : thezehui@gmail.com
+@File    : 3.RAPTOR逐层嵌入聚类与总结过程.py
+"""
+from functools import partial
+
+import dotenv
+from langchain_community.document_loaders import UnstructuredFileLoader
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_openai import ChatOpenAI
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from raptor_pipeline import recursive_embed_cluster_summarize
+from raptor_summary import summarize_clusters
+
+dotenv.load_dotenv()
+
+# 1.定义文本嵌入模型、大语言模型与总结链
+embd = HuggingFaceEmbeddings(
+    model_name="thenlper/gte-small",
+    cache_folder="./embeddings/",
+    encode_kwargs={"normalize_embeddings": True},
+)
+model = ChatOpenAI(model="gpt-3.5-turbo-16k", temperature=0)
+summary_prompt = ChatPromptTemplate.from_template("""Here is a sub-set of LangChain Expression Language doc.
+
+LangChain Expression Language provides a way to compose chain in LangChain.
+
+Give a detailed summary of the documentation provided.
+
+Documentation:
+{context}
+""")
+summary_chain = summary_prompt | model | StrOutputParser()
+
+# 2.加载并分割文本
+docs = UnstructuredFileLoader("./流浪地球.txt").load()
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=500,
+    chunk_overlap=0,
+    separators=["\n\n", "\n", "。|！|？", "\.\s|\!\s|\?\s", "；|;\s", "，|,\s", " ", ""],
+    is_separator_regex=True,
+)
+leaf_texts = [doc.page_content for doc in text_splitter.split_documents(docs)]
+
+# 3.逐层执行嵌入、降维、聚类、总结，摘要作为下一层的输入，最多3层
+results = recursive_embed_cluster_summarize(embd, partial(summarize_clusters, summary_chain), leaf_texts, level=1, n_levels=3)
+
+# 4.查看每一层的聚类与摘要，叶子文本+全部摘要即为折叠树检索时的全部节点
+all_texts = leaf_texts.copy()
+for level in sorted(results.keys()):
+    df_clusters, df_summary = results[level]
+    print(f"第{level}层：{len(df_clusters)}条文本，{len(df_summary)}个聚类")
+    print(df_summary[["cluster", "summaries"]])
+    all_texts.extend(df_summary["summaries"].tolist())
+print(f"文档树共{len(all_texts)}个节点")
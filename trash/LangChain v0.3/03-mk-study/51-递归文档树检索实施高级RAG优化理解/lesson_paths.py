@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 10:40
+@Author  : thezehui@gmail.com
+@File    : lesson_paths.py
+"""
+import os
+import sys
+
+MK_STUDY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 之前课程中实现的模块只保留一份，导入本模块后把这些课程目录加入导入路径，直接导入使用
+# 27-：vector_math.py(L2归一化等向量运算)
+# 49-：batched_embeddings.py(按内容去重、按token预算分批并发嵌入)
+LESSON_DIRS = [
+    "27-对接自定义向量数据库的配置与使用",
+    "49-MultiVector 实现多向量检索文档",
+]
+
+for lesson_dir in LESSON_DIRS:
+    path = os.path.join(MK_STUDY_DIR, lesson_dir)
+    if path not in sys.path:
+        sys.path.append(path)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 14:10
+@Author  : thezehui@gmail.com
+@File    : parallel_splitter.py
+"""
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_text_splitters import TextSplitter
+
+_splitter: Optional[TextSplitter] = None
+
+
+def _init_worker(text_splitter: TextSplitter) -> None:
+    """子进程初始化时保存文本分割器，避免每个任务都重复序列化"""
+    global _splitter
+    _splitter = text_splitter
+
+
+def _split_batch(documents: List[Document]) -> List[List[Document]]:
+    """在子进程中逐个分割一批文档，返回每个文档对应的文本块列表"""
+    return [_splitter.split_documents([document]) for document in documents]
+
+
+def balance_batches(sizes: Sequence[int], n_batches: int) -> List[List[int]]:
+    """按文本长度把文档下标分成n_batches批，从长到短依次放入当前总长度最小的一批(LPT贪心)，批内保持原始顺序"""
+    heap = [(0, i) for i in range(n_batches)]
+    batches: List[List[int]] = [[] for _ in range(n_batches)]
+    for index in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        total, batch_id = heapq.heappop(heap)
+        batches[batch_id].append(index)
+        heapq.heappush(heap, (total + sizes[index], batch_id))
+    return [sorted(batch) for batch in batches if batch]
+
+
+def split_documents_parallel(
+        text_splitter: TextSplitter,
+        documents: Sequence[Document],
+        workers: Optional[int] = None,
+        batches_per_worker: int = 4,
+        min_total_length: int = 1 << 20,
+) -> List[Document]:
+    """使用多进程并行执行text_splitter.split_documents(documents)，返回的文本块顺序与串行分割完全一致
+
+    文本分割是纯CPU计算，受GIL限制无法用线程加速，这里把文档按长度均衡地分成workers * batches_per_worker批，
+    交给进程池分割后再按原始文档顺序拼接。单个文档只能在一个进程内分割，因此文档越多、长度越均匀，加速越接近线性。
+    文档总长度小于min_total_length时启动进程池的开销大于收益，直接串行分割。
+    在Windows/macOS(spawn启动方式)下调用时，入口代码需要放在if __name__ == "__main__"中
+    """
+    workers = workers or os.cpu_count() or 1
+    sizes = [len(doc.page_content) for doc in documents]
+    if workers <= 1 or len(documents) <= 1 or sum(sizes) < min_total_length:
+        return text_splitter.split_documents(documents)
+
+    # 1.按长度均衡分批
+    batches = balance_batches(sizes, workers * batches_per_worker)
+
+    # 2.进程池并行分割，文本分割器只在每个子进程初始化时传递一次
+    results: List[Optional[List[Document]]] = [None] * len(documents)
+    with ProcessPoolExecutor(max_workers=min(workers, len(batches)), initializer=_init_worker,
+                             initargs=(text_splitter,)) as executor:
+        futures = [executor.submit(_split_batch, [documents[i] for i in batch]) for batch in batches]
+        for batch, future in zip(batches, futures):
+            for index, chunks in zip(batch, future.result()):
+                results[index] = chunks
+
+    # 3.按原始文档顺序拼接
+    return [chunk for chunks in results for chunk in chunks]
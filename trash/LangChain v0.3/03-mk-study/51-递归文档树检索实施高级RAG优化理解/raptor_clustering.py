@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 15:30
+@Author  : thezehui@gmail.com
+@File    : raptor_clustering.py
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import umap
+from scipy import sparse
+from sklearn.mixture import GaussianMixture
+from threadpoolctl import threadpool_limits
+
+RANDOM_SEED = 224
+GMMParams = Tuple[np.ndarray, np.ndarray, np.ndarray]  # (权重, 均值, 精度矩阵)
+
+
+def global_cluster_embeddings(
+        embeddings: np.ndarray, dim: int, n_neighbors: Optional[int] = None, metric: str = "cosine",
+) -> np.ndarray:
+    """
+    使用UMAP对传递嵌入向量进行全局降维
+
+    :param embeddings: 需要降维的嵌入向量
+    :param dim: 降低后的维度
+    :param n_neighbors: 每个向量需要考虑的邻居数量，如果没有提供默认为嵌入数量的开方
+    :param metric: 用于UMAP的距离度量，默认为余弦相似性
+    :return: 一个降维到指定维度的numpy嵌入数组
+    """
+    if n_neighbors is None:
+        n_neighbors = int((len(embeddings) - 1) ** 0.5)
+    return umap.UMAP(n_neighbors=n_neighbors, n_components=dim, metric=metric).fit_transform(embeddings)
+
+
+def local_cluster_embeddings(
+        embeddings: np.ndarray, dim: int, n_neighbors: int = 10, metric: str = "cosine",
+) -> np.ndarray:
+    """
+    使用UMAP对嵌入进行局部降维处理，通常在全局聚类之后进行。
+
+    :param embeddings: 需要降维的嵌入向量
+    :param dim: 降低后的维度
+    :param n_neighbors: 每个向量需要考虑的邻居数量
+    :param metric: 用于UMAP的距离度量，默认为余弦相似性
+    :return: 一个降维到指定维度的numpy嵌入数组
+    """
+    return umap.UMAP(
+        n_neighbors=n_neighbors, n_components=dim, metric=metric,
+    ).fit_transform(embeddings)
+
+
+def get_optimal_clusters(
+        embeddings: np.ndarray, max_clusters: int = 50, random_state: int = RANDOM_SEED,
+) -> int:
+    """
+    使用高斯混合模型结合贝叶斯信息准则（BIC）确定最佳的聚类数目。
+
+    :param embeddings: 需要聚类的嵌入向量
+    :param max_clusters: 最大聚类数
+    :param random_state: 随机数
+    :return: 返回最优聚类数
+    """
+    # 1.获取最大聚类树，最大聚类数不能超过嵌入向量的数量
+    max_clusters = min(max_clusters, len(embeddings))
+    n_clusters = np.arange(1, max_clusters)
+
+    # 2.逐个设置聚类树并找出最优聚类数
+    bics = []
+    for n in n_clusters:
+        # 3.创建高斯混合模型，并计算聚类结果
+        gm = GaussianMixture(n_components=n, random_state=random_state)
+        gm.fit(embeddings)
+        bics.append(gm.bic(embeddings))
+
+    return n_clusters[np.argmin(bics)]
+
+
+def _init_worker() -> None:
+    """子进程中把BLAS/OpenMP线程数限制为1，避免多个进程同时拟合时线程过度订阅"""
+    threadpool_limits(limits=1)
+
+
+def _fit_gmm(
+        embeddings: np.ndarray, n_components: int, random_state: int, init: Optional[GMMParams] = None,
+) -> Tuple[float, GMMParams]:
+    """拟合n_components阶高斯混合模型，返回BIC与拟合得到的参数，init不为空时跳过KMeans初始化直接从给定参数开始迭代
+
+    热启动参数来自其他阶数的拟合结果，样本很少的分量精度矩阵可能接近奇异，初始化失败时退回普通拟合
+    """
+    if init is not None:
+        weights, means, precisions = init
+        gm = GaussianMixture(
+            n_components=n_components, random_state=random_state, init_params="random_from_data",
+            weights_init=weights, means_init=means, precisions_init=precisions,
+        )
+        try:
+            gm.fit(embeddings)
+            return gm.bic(embeddings), (gm.weights_, gm.means_, gm.precisions_)
+        except (ValueError, np.linalg.LinAlgError):
+            pass
+    gm = GaussianMixture(n_components=n_components, random_state=random_state)
+    gm.fit(embeddings)
+    return gm.bic(embeddings), (gm.weights_, gm.means_, gm.precisions_)
+
+
+def _resize_params(params: GMMParams, n_components: int) -> GMMParams:
+    """把相邻阶数的拟合参数调整为n_components阶作为热启动参数：阶数减少时保留权重最大的分量，阶数增加时沿主轴分裂权重最大的分量"""
+    weights, means, precisions = (np.array(p, copy=True) for p in params)
+    if n_components < len(weights):
+        keep = np.sort(np.argsort(weights)[::-1][:n_components])
+        weights, means, precisions = weights[keep], means[keep], precisions[keep]
+    while len(weights) < n_components:
+        k = int(np.argmax(weights))
+        eigenvalues, eigenvectors = np.linalg.eigh(np.linalg.inv(precisions[k]))
+        offset = 0.5 * np.sqrt(eigenvalues[-1]) * eigenvectors[:, -1]
+        weights[k] /= 2
+        weights = np.append(weights, weights[k])
+        means = np.vstack([means, means[k] + offset])
+        means[k] -= offset
+        precisions = np.concatenate([precisions, precisions[k:k + 1]])
+    return weights / weights.sum(), means, (precisions + precisions.transpose(0, 2, 1)) / 2
+
+
+class ClusterCountSearch:
+    """
+    使用进程池并行搜索最佳聚类数，可以传递给gmm_cluster/perform_clustering替代逐个拟合的get_optimal_clusters。
+
+    默认参数(coarse_step=1、patience=None、warm_start=False)下与get_optimal_clusters拟合完全相同的候选模型，
+    只是分散到多个进程中执行，结果一致；coarse_step>1时先按步长拟合粗网格，再拟合最优粗网格点两侧的候选阶数；
+    patience不为空时粗网格按进程数分批拟合，最优阶数之后已有patience个网格点的BIC没有改善就提前停止；
+    warm_start=True时细搜索阶段从最近的粗网格拟合结果热启动，省去KMeans初始化并减少EM迭代次数。
+    进程池在第一次使用时创建并在多次调用之间复用，使用完毕后调用close或放在with语句中
+    """
+
+    def __init__(
+            self,
+            max_clusters: int = 50,
+            random_state: int = RANDOM_SEED,
+            workers: Optional[int] = None,
+            coarse_step: int = 1,
+            patience: Optional[int] = None,
+            warm_start: bool = False,
+            min_parallel_samples: int = 1000,
+    ):
+        if coarse_step < 1:
+            raise ValueError("coarse_step必须大于等于1")
+        if patience is not None and patience < 1:
+            raise ValueError("patience必须大于等于1")
+        self.max_clusters = max_clusters
+        self.random_state = random_state
+        self.workers = workers or os.cpu_count() or 1
+        self.coarse_step = coarse_step
+        self.patience = patience
+        self.warm_start = warm_start
+        self.min_parallel_samples = min_parallel_samples
+        self.n_fits = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def __call__(self, embeddings: np.ndarray) -> int:
+        """返回BIC最小的聚类数，BIC相同时取较小的聚类数"""
+        # 1.获取候选聚类数，与get_optimal_clusters相同，最大聚类数不能超过嵌入向量的数量
+        candidates = list(range(1, min(self.max_clusters, len(embeddings))))
+        parallel = self.workers > 1 and len(embeddings) >= self.min_parallel_samples
+        bics: Dict[int, float] = {}
+        params: Dict[int, GMMParams] = {}
+
+        # 2.粗搜索：按步长取网格点，需要提前停止时按进程数分批拟合
+        coarse = candidates[::self.coarse_step]
+        wave = len(coarse) if self.patience is None else (self.workers if parallel else 1)
+        for start in range(0, len(coarse), wave):
+            self._evaluate(embeddings, coarse[start:start + wave], {}, parallel, bics, params)
+            best = min(bics, key=lambda n: (bics[n], n))
+            if self.patience is not None and sum(n > best for n in bics) >= self.patience:
+                break
+
+        # 3.细搜索：拟合最优网格点两侧尚未拟合的候选阶数，可选从最近的已拟合阶数热启动
+        best = min(bics, key=lambda n: (bics[n], n))
+        fine = [n for n in range(best - self.coarse_step + 1, best + self.coarse_step)
+                if n in candidates and n not in bics]
+        inits = {}
+        if self.warm_start:
+            for n in fine:
+                nearest = min(params, key=lambda m: (abs(m - n), m))
+                inits[n] = _resize_params(params[nearest], n)
+        self._evaluate(embeddings, fine, inits, parallel, bics, params)
+
+        return min(bics, key=lambda n: (bics[n], n))
+
+    def _evaluate(
+            self,
+            embeddings: np.ndarray,
+            candidates: Sequence[int],
+            inits: Dict[int, GMMParams],
+            parallel: bool,
+            bics: Dict[int, float],
+            params: Dict[int, GMMParams],
+    ) -> None:
+        """拟合一组候选阶数，结果写入bics与params"""
+        if not candidates:
+            return
+        if parallel and len(candidates) > 1:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+            futures = [
+                self._executor.submit(_fit_gmm, embeddings, n, self.random_state, inits.get(n)) for n in candidates
+            ]
+            results = [future.result() for future in futures]
+        else:
+            results = [_fit_gmm(embeddings, n, self.random_state, inits.get(n)) for n in candidates]
+        for n, (bic, fitted) in zip(candidates, results):
+            bics[n], params[n] = bic, fitted
+        self.n_fits += len(candidates)
+
+    def close(self) -> None:
+        """关闭进程池"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "ClusterCountSearch":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def assignment_matrix(rows: np.ndarray, cols: np.ndarray, shape: Tuple[int, int]) -> sparse.csr_matrix:
+    """由(嵌入下标, 聚类ID)对构建稀疏成员矩阵，第i行第j列为True表示第i个嵌入属于第j个聚类"""
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.bool_), (rows, cols)), shape=shape)
+
+
+def cluster_members(assignment: sparse.spmatrix) -> List[np.ndarray]:
+    """按列拆分成员矩阵，返回每个聚类包含的嵌入下标(升序)"""
+    csc = sparse.csc_matrix(assignment)
+    csc.sort_indices()
+    return np.split(csc.indices, csc.indptr[1:-1])
+
+
+def cluster_labels(assignment: sparse.spmatrix) -> List[np.ndarray]:
+    """按行拆分成员矩阵，返回每个嵌入所属的聚类ID(升序)"""
+    csr = sparse.csr_matrix(assignment)
+    csr.sort_indices()
+    return np.split(csr.indices, csr.indptr[1:-1])
+
+
+def gmm_cluster(
+        embeddings: np.ndarray, threshold: float, random_state: int = 0, search: Optional[ClusterCountSearch] = None,
+) -> Tuple[sparse.csr_matrix, int]:
+    """
+    使用基于概率阈值的高斯混合模型（GMM）对嵌入进行聚类。
+
+    :param embeddings: 需要聚类的嵌入向量（降维）
+    :param threshold: 概率阈值
+    :param random_state: 用于可重现的随机性种子
+    :param search: 聚类数搜索器，为空时使用get_optimal_clusters逐个拟合
+    :return: 包含稀疏成员矩阵(嵌入数量×聚类数目)和确定聚类数目的元组
+    """
+    # 1.获取最优聚类数
+    n_clusters = search(embeddings) if search is not None else get_optimal_clusters(embeddings)
+
+    # 2.创建高斯混合模型对象并嵌入数据
+    gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
+    gm.fit(embeddings)
+
+    # 3.预测每个样本属于各个聚类的概率
+    probs = gm.predict_proba(embeddings)
+
+    # 4.概率超过阈值的(嵌入下标, 聚类ID)对即为成员关系
+    rows, cols = np.nonzero(probs > threshold)
+    return assignment_matrix(rows, cols, (len(embeddings), n_clusters)), n_clusters
+
+
+def perform_clustering(
+        embeddings: np.ndarray, dim: int, threshold: float, search: Optional[ClusterCountSearch] = None,
+) -> sparse.csr_matrix:
+    """
+    对嵌入进行聚类，首先全局降维，然后使用高斯混合模型进行聚类，最后在每个全局聚类中进行局部聚类。
+
+    全局聚类与局部聚类之间只传递整数下标数组：局部聚类的结果通过members[local_rows]直接映射回全局下标，
+    不需要再用嵌入向量逐个比较去反查下标，内存占用与(嵌入数量×所属聚类数)成正比，内容完全相同的嵌入也不会被错误合并
+
+    :param embeddings: 需要执行操作的嵌入向量列表
+    :param dim: 指定的降维维度
+    :param threshold: 概率阈值
+    :param search: 聚类数搜索器，全局聚类与局部聚类共用，为空时使用get_optimal_clusters
+    :return: 稀疏成员矩阵(嵌入数量×聚类总数)，可以使用cluster_labels/cluster_members按嵌入或按聚类取出结果
+    """
+    n = len(embeddings)
+
+    # 1.检测传入的嵌入向量，当数据量不足时不进行聚类，全部分配到0号聚类
+    if n <= dim + 1:
+        return assignment_matrix(np.arange(n), np.zeros(n, dtype=np.int64), (n, 1))
+
+    # 2.全局降维并聚类
+    reduced_embeddings_global = global_cluster_embeddings(embeddings, dim)
+    global_assignment, _ = gmm_cluster(reduced_embeddings_global, threshold, search=search)
+
+    # 3.遍历每个全局聚类执行局部聚类，members为该全局聚类包含的嵌入下标
+    all_rows, all_cols = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+    total_clusters = 0
+    for members in cluster_members(global_assignment):
+        # 4.如果当前全局聚类中没有嵌入向量则跳过
+        if len(members) == 0:
+            continue
+
+        # 5.如果当前全局聚类中的嵌入量很少，直接将它们分配到一个聚类中
+        if len(members) <= dim + 1:
+            local_rows, local_cols = np.arange(len(members)), np.zeros(len(members), dtype=np.int64)
+            n_local_clusters = 1
+        else:
+            # 6.执行局部降维和聚类，得到的是members内部的下标
+            reduced_embeddings_local = local_cluster_embeddings(embeddings[members], dim)
+            local_assignment, n_local_clusters = gmm_cluster(reduced_embeddings_local, threshold, search=search)
+            local_rows, local_cols = local_assignment.nonzero()
+
+        # 7.局部下标映射回全局下标，局部聚类ID加上已处理的聚类总数
+        all_rows.append(members[local_rows])
+        all_cols.append(local_cols + total_clusters)
+        total_clusters += n_local_clusters
+
+    return assignment_matrix(np.concatenate(all_rows), np.concatenate(all_cols), (n, max(total_clusters, 1)))
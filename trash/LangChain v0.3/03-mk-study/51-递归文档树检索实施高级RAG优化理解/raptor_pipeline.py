@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 11:40
+@Author  : thezehui@gmail.com
+@File    : raptor_pipeline.py
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from langchain_core.embeddings import Embeddings
+from scipy import sparse
+
+from raptor_clustering import ClusterCountSearch, cluster_labels, cluster_members, perform_clustering
+
+# RAPTOR逐步实现(一次性构建，便于理解原理)，可持久化、可增量更新的实现见raptor_tree.RaptorTree，两者每一层的处理流程一致：
+# 1.embed：嵌入当前层的全部文本
+# 2.perform_clustering(raptor_clustering.py)：global_cluster_embeddings全局降维 -> gmm_cluster(get_optimal_clusters确定聚类数)
+#   全局聚类 -> 每个全局聚类内local_cluster_embeddings局部降维 -> gmm_cluster局部聚类
+# 3.fmt_txt + summarize：拼接每个聚类中的文本并生成摘要
+# 4.recursive_embed_cluster_summarize：摘要作为下一层的输入文本，递归直到达到最大层级或只剩一个聚类
+
+SummarizeFunction = Callable[[List[str], int], List[str]]  # (每个聚类格式化后的文本, 层级) -> 摘要列表
+
+
+def embed(embedding: Embeddings, texts: List[str]) -> np.ndarray:
+    """
+    将传递的的文本列表转换成嵌入向量列表
+
+    :param embedding: 文本嵌入模型
+    :param texts: 需要转换的文本列表
+    :return: 生成的嵌入向量列表并转换成numpy数组
+    """
+    text_embeddings = embedding.embed_documents(texts)
+    return np.array(text_embeddings)
+
+
+def embed_cluster_texts(
+        embedding: Embeddings, texts: List[str], search: Optional[ClusterCountSearch] = None,
+) -> Tuple[pd.DataFrame, sparse.csr_matrix]:
+    """
+    对文本列表进行嵌入和聚类,并返回一个包含文本、嵌入和聚类标签的数据框。
+    该函数将嵌入生成和聚类结合成一个步骤。
+
+    :param embedding: 文本嵌入模型
+    :param texts: 需要处理的文本列表
+    :param search: 聚类数搜索器，为空时使用get_optimal_clusters逐个拟合
+    :return: 返回包含文本、嵌入和聚类标签的数据框，以及稀疏成员矩阵(文本数量×聚类数目)
+    """
+    text_embeddings_np = embed(embedding, texts)
+    assignment = perform_clustering(text_embeddings_np, 10, 0.1, search=search)
+    df = pd.DataFrame()
+    df["text"] = texts
+    df["embd"] = list(text_embeddings_np)
+    df["cluster"] = cluster_labels(assignment)
+    return df, assignment
+
+
+def fmt_txt(df: pd.DataFrame) -> str:
+    """
+    将数据框中的文本格式化成单个字符串
+
+    :param df: 需要处理的数据框，内部涵盖text、embd、cluster三个字段
+    :return: 返回合并格式化后的字符串
+    """
+    unique_txt = df["text"].tolist()
+    return "--- --- \n --- ---".join(unique_txt)
+
+
+def embed_cluster_summarize_texts(
+        embedding: Embeddings,
+        summarize: SummarizeFunction,
+        texts: List[str],
+        level: int,
+        search: Optional[ClusterCountSearch] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    对传入的文本列表进行嵌入、聚类和总结。
+    该函数首先问文本生成嵌入，基于相似性对他们进行聚类，按稀疏成员矩阵取出每个聚类的文本，然后总结每个聚类中的内容。
+
+    :param embedding: 文本嵌入模型
+    :param summarize: 总结函数，对每个聚类格式化后的文本生成摘要(例如raptor_summary.summarize_clusters)
+    :param texts: 需要处理的文本列表
+    :param level: 一个整数，可以定义处理的深度
+    :param search: 聚类数搜索器
+    :return: 包含两个数据框的元组
+    - 第一个 DataFrame (df_clusters) 包括原始文本、它们的嵌入以及聚类分配。
+    - 第二个 DataFrame (df_summary) 包含每个聚类的摘要信息、指定的处理级别以及聚类标识符。
+    """
+    # 1.嵌入和聚类文本，生成包含text、embd、cluster的数据框与稀疏成员矩阵
+    df_clusters, assignment = embed_cluster_texts(embedding, texts, search)
+
+    # 2.按列取出每个聚类包含的文本下标，跳过空聚类
+    members = cluster_members(assignment)
+    all_clusters = [i for i, indices in enumerate(members) if len(indices) > 0]
+
+    # 3.格式化每个聚类中的文本并批量总结
+    contexts = [fmt_txt(df_clusters.iloc[members[i]]) for i in all_clusters]
+    summaries = summarize(contexts, level)
+
+    # 4.创建一个DataFrame来存储总结及其对应的聚类和级别
+    df_summary = pd.DataFrame(
+        {
+            "summaries": summaries,
+            "level": [level] * len(summaries),
+            "cluster": list(all_clusters),
+        }
+    )
+
+    return df_clusters, df_summary
+
+
+def recursive_embed_cluster_summarize(
+        embedding: Embeddings,
+        summarize: SummarizeFunction,
+        texts: List[str],
+        level: int = 1,
+        n_levels: int = 3,
+        search: Optional[ClusterCountSearch] = None,
+) -> Dict[int, Tuple[pd.DataFrame, pd.DataFrame]]:
+    """
+    递归地嵌入、聚类和总结文本，直到达到指定的级别或唯一聚类数变为1，将结果存储在每个级别处。
+
+    :param embedding: 文本嵌入模型
+    :param summarize: 总结函数
+    :param texts: 要处理的文本列表
+    :param level: 当前递归级别（从1开始）
+    :param n_levels: 递归地最大深度（默认为3）
+    :param search: 聚类数搜索器
+    :return: 一个字典，其中键是递归级别，值是包含该级别处聚类DataFrame和总结DataFrame的元组。
+    """
+    # 1.定义字典用于存储每个级别处的结果
+    results = {}
+
+    # 2.对当前级别执行嵌入、聚类和总结
+    df_clusters, df_summary = embed_cluster_summarize_texts(embedding, summarize, texts, level, search)
+
+    # 3.存储当前级别的结果
+    results[level] = (df_clusters, df_summary)
+
+    # 4.确定是否可以继续递归并且有意义
+    unique_clusters = df_summary["cluster"].nunique()
+    if level < n_levels and unique_clusters > 1:
+        # 5.使用总结作为下一级递归的输入文本
+        new_texts = df_summary["summaries"].tolist()
+        next_level_results = recursive_embed_cluster_summarize(
+            embedding, summarize, new_texts, level + 1, n_levels, search
+        )
+
+        # 6.将下一级的结果合并到当前结果字典中
+        results.update(next_level_results)
+
+    return results
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 19:05
+@Author  : thezehui@gmail.com
+@File    : raptor_retriever.py
+"""
+from typing import List, Literal, Optional, Tuple
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import lesson_paths  # noqa: F401  把49-课程目录加入导入路径，batched_embeddings只在49-中保留一份
+from batched_embeddings import get_encoding
+from raptor_tree import RaptorTree
+
+
+def cosine_scores(vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """计算query与一组向量的余弦相似度，越大越相似"""
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+    return (vectors @ query) / np.maximum(norms, 1e-12)
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """从scores中选出最大的k个下标(降序)，使用argpartition避免全量排序"""
+    if k >= len(scores):
+        return np.argsort(-scores, kind="stable")
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+class RaptorRetriever(BaseRetriever):
+    """
+    基于本地RaptorTree的RAPTOR检索器，返回的Document.metadata中附带level与score(余弦相似度)。
+
+    mode="collapsed"：折叠树检索，把所有层级的节点视为同一个集合，按相似度从高到低选取，
+    直到达到k条或再加入下一个节点就会超过max_tokens个token为止，需要计算全部节点的相似度。
+    mode="tree_traversal"：自顶向下的束搜索，从根节点开始每层只保留相似度最高的beam_width个节点，
+    下一层只计算这些节点的子节点的相似度，返回每一层选中的节点(从上到下)，
+    每次检索访问的向量数约为 根节点数 + 层数×beam_width×平均子节点数，与叶子总数无关
+    """
+    tree: RaptorTree
+    mode: Literal["collapsed", "tree_traversal"] = "collapsed"
+    k: int = 10
+    max_tokens: Optional[int] = 2000
+    beam_width: int = 3
+    model_name: str = "gpt-3.5-turbo-16k"  # 计算token预算使用的编码器
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        """根据传入的query在文档树中检索"""
+        if len(self.tree) == 0:
+            return []
+        query_embedding = np.asarray(self.tree.embedding.embed_query(query), dtype=np.float32)
+        if self.mode == "collapsed":
+            selected = self._collapsed_search(query_embedding)
+        else:
+            selected = self._traversal_search(query_embedding)
+        return [self._to_document(row, score) for row, score in selected]
+
+    def _collapsed_search(self, query_embedding: np.ndarray) -> List[Tuple[int, float]]:
+        """折叠树检索：计算全部节点的相似度，按相似度顺序在token预算内选取前k个节点"""
+        # 1.计算全部节点的相似度并选出前k个候选
+        scores = cosine_scores(self.tree.embeddings, query_embedding)
+        candidates = top_k_indices(scores, self.k)
+        if self.max_tokens is None:
+            return [(int(row), float(scores[row])) for row in candidates]
+
+        # 2.只对候选节点批量计算token数，按相似度顺序累加，超出预算时停止
+        token_counts = map(len, get_encoding(self.model_name).encode_ordinary_batch(
+            [self.tree.texts[row] for row in candidates]
+        ))
+        selected, used = [], 0
+        for row, tokens in zip(candidates, token_counts):
+            if used + tokens > self.max_tokens:
+                break
+            selected.append((int(row), float(scores[row])))
+            used += tokens
+        return selected
+
+    def _traversal_search(self, query_embedding: np.ndarray) -> List[Tuple[int, float]]:
+        """树遍历检索：自顶向下，每层只计算上一层选中节点的子节点的相似度"""
+        selected = []
+        frontier = self.tree.roots()
+        while frontier:
+            # 1.计算当前候选节点的相似度，保留beam_width个
+            rows = np.array(frontier)
+            scores = cosine_scores(self.tree.embeddings[rows], query_embedding)
+            top = top_k_indices(scores, self.beam_width)
+            selected.extend((int(rows[i]), float(scores[i])) for i in top)
+
+            # 2.下一层的候选为选中节点的子节点(软聚类下可能重复，去重并保持顺序)
+            frontier = list(dict.fromkeys(child for i in top for child in self.tree.children[rows[i]]))
+        return selected
+
+    def _to_document(self, row: int, score: float) -> Document:
+        document = self.tree.to_document(row)
+        document.metadata["score"] = score
+        return document
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 16:40
+@Author  : thezehui@gmail.com
+@File    : raptor_summary.py
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from langchain_core.runnables import Runnable
+from tqdm import tqdm
+
+from raptor_tree import ClusterSummaryError
+
+
+def summarize_clusters(
+        chain: Runnable, contexts: List[str], level: int, max_concurrency: int = 8, max_attempts: int = 3,
+) -> List[str]:
+    """
+    以有限并发批量总结每个聚类的文本，并显示当前层级的进度。
+    每个聚类的调用单独重试，某个聚类重试后仍然失败时，其他聚类的摘要照常完成，
+    最后抛出ClusterSummaryError，其中带有全部成功的摘要(失败的聚类为None)，调用方只需要重新总结失败的聚类。
+
+    :param chain: 汇总链，输入为{"context": 格式化后的聚类文本}
+    :param contexts: 每个聚类格式化后的文本
+    :param level: 当前处理的层级，用于显示进度
+    :param max_concurrency: 同时进行的最大请求数
+    :param max_attempts: 每个聚类最多尝试的次数(指数退避)
+    :return: 与contexts顺序一致的摘要列表
+    """
+    # 1.为单个聚类的调用添加重试，失败的聚类只重试自己
+    # (with_retry返回的是绑定对象，它的batch_as_completed会直接转发给原链而跳过重试，因此这里逐个调用invoke)
+    retry_chain = chain.with_retry(stop_after_attempt=max_attempts)
+
+    # 2.使用线程池以有限并发执行，按完成顺序更新进度，单个聚类的异常不中断其他聚类
+    summaries: List[Optional[str]] = [None] * len(contexts)
+    errors: Dict[int, Exception] = {}
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor, \
+            tqdm(total=len(contexts), desc=f"第{level}层聚类摘要") as progress:
+        futures = {executor.submit(retry_chain.invoke, {"context": context}): i for i, context in enumerate(contexts)}
+        for future in as_completed(futures):
+            try:
+                summaries[futures[future]] = future.result()
+            except Exception as e:
+                errors[futures[future]] = e
+            progress.update(1)
+
+    # 3.重试后仍然失败的聚类连同成功的摘要一起抛出
+    if errors:
+        raise ClusterSummaryError(level, summaries, errors) from errors[min(errors)]
+    return summaries
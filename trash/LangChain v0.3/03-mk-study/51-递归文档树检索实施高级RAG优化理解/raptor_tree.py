@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 17:20
+@Author  : thezehui@gmail.com
+@File    : raptor_tree.py
+"""
+import json
+import os
+import uuid
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+import lesson_paths  # noqa: F401  把27-课程目录加入导入路径，复用vector_math中的l2_normalize
+from raptor_clustering import ClusterCountSearch, cluster_members, perform_clustering
+from vector_math import l2_normalize
+
+SummarizeFunction = Callable[[List[str], int], List[str]]  # (每个聚类格式化后的文本, 层级) -> 摘要列表
+
+
+class ClusterSummaryError(RuntimeError):
+    """部分聚类总结失败，summaries与输入的聚类一一对应，失败的聚类为None，errors为失败聚类的序号与异常"""
+
+    def __init__(self, level: int, summaries: List[Optional[str]], errors: Dict[int, Exception]):
+        self.level = level
+        self.summaries = summaries
+        self.errors = errors
+        first = min(errors)
+        super().__init__(
+            f"第{level}层共{len(summaries)}个聚类中有{len(errors)}个摘要失败，"
+            f"失败聚类序号: {sorted(errors)}，第一个错误: {errors[first]!r}"
+        )
+
+
+class RaptorTree:
+    """
+    可持久化、可增量更新的RAPTOR文档树。
+
+    第0层为叶子节点(原始文本块)，第1~n_levels层为摘要节点，每个摘要节点记录子节点、聚类质心(子节点嵌入的均值)与摘要文本，
+    每个节点记录父节点(软聚类下一个节点可能属于多个聚类)，节点id为uuid字符串，可以直接作为向量数据库中的id使用。
+    新增或内容变化的节点记录在unsynced_ids中并随文档树一起持久化，写入向量数据库成功后调用mark_synced清除，
+    写入失败时下次加载文档树仍然可以继续同步。
+
+    build对全部叶子逐层执行降维、聚类、总结；
+    add_leaves只处理尚未出现过的叶子：新叶子按余弦相似度分配到最近的第1层聚类，受影响的聚类更新质心、重新总结并重新嵌入，
+    摘要变化后再以同样的方式影响上一层，其余分支保持不变，因此增量更新的成本只与受影响的分支数量相关。
+    summarize抛出ClusterSummaryError(或其他异常)时，已经成功的摘要会保留在续做状态中，调用resume()只重新总结失败的聚类。
+    resummarize_ratio>0时，聚类中新增/变化的子节点占比达到该值才重新总结，否则只更新质心并累计待更新计数。
+    新叶子不会触发重新聚类，聚类结构会随增量数据逐渐偏离最优，累计变化较大时应重新build
+    """
+    NODES_FILE = "nodes.json"  # 配置+节点id/层级/文本/元数据/父子关系
+    EMBEDDINGS_FILE = "embeddings.f32"  # 全部节点的嵌入，行优先
+    CENTROIDS_FILE = "centroids.npz"  # 摘要节点的行号与聚类质心
+    SEPARATOR = "--- --- \n --- ---"  # 拼接聚类内文本的分隔符
+    INITIAL_CAPACITY = 1024  # 嵌入矩阵首次分配的行数，之后按2倍扩容
+
+    def __init__(
+            self,
+            embedding: Embeddings,
+            summarize: SummarizeFunction,
+            n_levels: int = 3,
+            dim: int = 10,
+            threshold: float = 0.1,
+            search: Optional[ClusterCountSearch] = None,
+    ):
+        if n_levels < 1:
+            raise ValueError("n_levels必须大于等于1")
+        self.embedding = embedding
+        self.summarize = summarize
+        self.n_levels = n_levels
+        self.dim = dim
+        self.threshold = threshold
+        self.search = search
+        self._reset()
+
+    def _reset(self) -> None:
+        """清空全部节点，节点按行号存储，ids[row]为节点id"""
+        self.ids: List[str] = []
+        self.levels: List[int] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.children: List[List[int]] = []
+        self.parents: List[List[int]] = []
+        self._embeddings: np.ndarray = np.empty((0, 0), dtype=np.float32)  # 按容量预分配，前len(ids)行有效
+        self.centroids: Dict[int, np.ndarray] = {}  # 摘要节点行号 -> 聚类质心
+        self.stale: Dict[int, int] = {}  # 摘要节点行号 -> 上次总结之后新增/变化的子节点数
+        self.unsynced_ids: List[str] = []  # 尚未写入向量数据库的新增/变化节点id(保持顺序、不重复)
+        self._id_to_row: Dict[str, int] = {}
+        self._roots: Optional[List[int]] = None  # 根节点缓存，节点或父子关系变化时失效
+        self._resume_state: Optional[dict] = None  # 聚类总结失败时中断的层级、聚类与已经成功的摘要
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """全部节点的嵌入，第row行对应ids[row]，返回的是视图，按行修改会直接写入文档树"""
+        return self._embeddings[:len(self.ids)]
+
+    @property
+    def top_level(self) -> int:
+        """当前最高的层级，只有叶子时为0"""
+        return max(self.levels, default=0)
+
+    def level_rows(self, level: int) -> List[int]:
+        """指定层级的全部节点行号"""
+        return [row for row, node_level in enumerate(self.levels) if node_level == level]
+
+    def roots(self) -> List[int]:
+        """没有父节点的节点行号，即各层聚类的最顶端"""
+        if self._roots is None:
+            self._roots = [row for row, parents in enumerate(self.parents) if not parents]
+        return self._roots
+
+    def rows(self, ids: Iterable[str]) -> List[int]:
+        """节点id转换为行号"""
+        return [self._id_to_row[id] for id in ids]
+
+    def get_documents(self, ids: Iterable[str]) -> List[Document]:
+        """按节点id返回Document，Document.id为节点id，metadata中附带层级"""
+        return [self.to_document(row) for row in self.rows(ids)]
+
+    def mark_synced(self, ids: Iterable[str]) -> None:
+        """ids已经写入向量数据库，从待同步列表中移除"""
+        synced = set(ids)
+        self.unsynced_ids = [id for id in self.unsynced_ids if id not in synced]
+
+    def _mark_unsynced(self, ids: Iterable[str]) -> None:
+        known = set(self.unsynced_ids)
+        for id in ids:
+            if id not in known:
+                known.add(id)
+                self.unsynced_ids.append(id)
+
+    def to_document(self, row: int) -> Document:
+        return Document(id=self.ids[row], page_content=self.texts[row], metadata={**self.metadatas[row], "level": self.levels[row]})
+
+    def build(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[str]:
+        """
+        使用全部叶子文本重新构建文档树，返回全部节点id。
+
+        :param texts: 叶子文本列表
+        :param metadatas: 叶子元数据列表
+        :return: 新树中全部节点的id
+        """
+        self._reset()
+        if not texts:
+            return []
+
+        # 1.嵌入全部叶子
+        rows = self._append_nodes(texts, 0, self.embedding.embed_documents(texts), metadatas)
+        self._mark_unsynced(self.ids)
+
+        # 2.逐层聚类并总结
+        self._build_levels(1, rows)
+        return list(self.ids)
+
+    def _build_levels(self, start_level: int, rows: List[int]) -> None:
+        """从start_level开始逐层聚类并总结，直到达到最大层级或只剩一个聚类"""
+        for level in range(start_level, self.n_levels + 1):
+            rows = np.array(rows)
+            assignment = perform_clustering(self.embeddings[rows], self.dim, self.threshold, search=self.search)
+            groups = [rows[members].tolist() for members in cluster_members(assignment) if len(members) > 0]
+            summaries = self._summarize_groups({"kind": "build"}, level, groups, [None] * len(groups))
+            rows = self._append_level(level, groups, summaries)
+            if len(groups) <= 1:
+                break
+
+    def _append_level(self, level: int, groups: List[List[int]], summaries: List[str]) -> List[int]:
+        """为每个聚类追加一个摘要节点并建立父子关系，返回新节点的行号"""
+        parent_rows = self._append_nodes(summaries, level, self.embedding.embed_documents(summaries))
+        for parent, children in zip(parent_rows, groups):
+            self._link(parent, children)
+            self.centroids[parent] = self.embeddings[children].mean(axis=0)
+            self.stale[parent] = 0
+        self._mark_unsynced(self.ids[row] for row in parent_rows)
+        return parent_rows
+
+    def add_leaves(
+            self, texts: List[str], metadatas: Optional[List[dict]] = None, resummarize_ratio: float = 0.0,
+    ) -> List[str]:
+        """
+        增量添加叶子文本，只更新受影响的分支，返回新增或内容发生变化的节点id(用于同步到向量数据库)。
+
+        :param texts: 叶子文本列表，已经存在于树中的文本会被跳过
+        :param metadatas: 叶子元数据列表
+        :param resummarize_ratio: 聚类中新增/变化的子节点占比达到该值时才重新总结，0表示每次都重新总结
+        :return: 新增叶子与重新总结的摘要节点的id
+        """
+        if self.interrupted:
+            raise ValueError("上一次构建/更新中有聚类总结失败，请先调用resume()完成剩余的聚类")
+        if not self.ids:
+            return self.build(texts, metadatas)
+
+        # 1.跳过树中已有的叶子与本批次内重复的文本
+        known = {self.texts[row] for row in self.level_rows(0)}
+        metadatas = metadatas if metadatas is not None else [{} for _ in texts]
+        new = {}
+        for text, metadata in zip(texts, metadatas):
+            if text not in known and text not in new:
+                new[text] = metadata
+        if not new:
+            return []
+        new_texts = list(new)
+        pending = self._append_nodes(new_texts, 0, self.embedding.embed_documents(new_texts), list(new.values()))
+        self._mark_unsynced(self.ids[row] for row in pending)
+
+        # 2.逐层向上更新受影响的分支
+        changed_rows = list(pending) + self._update_levels(1, pending, [], resummarize_ratio)
+        return [self.ids[row] for row in changed_rows]
+
+    def _update_levels(self, start_level: int, pending: List[int], changed: List[int], resummarize_ratio: float) -> List[int]:
+        """
+        从start_level开始逐层向上：新节点分配到最近的聚类，受影响的聚类更新质心，按需重新总结，返回重新总结的摘要节点行号。
+
+        :param pending: 需要分配到start_level层聚类的新节点
+        :param changed: start_level-1层中摘要发生变化的节点
+        """
+        changed_rows = []
+        for level in range(start_level, self.top_level + 1):
+            clusters = self.level_rows(level)
+            affected = set()
+
+            # 3.新节点按余弦相似度分配到质心最近的聚类
+            if pending:
+                centroids = l2_normalize(np.stack([self.centroids[row] for row in clusters]))
+                nearest = np.argmax(l2_normalize(self.embeddings[pending]) @ centroids.T, axis=1)
+                for child, index in zip(pending, nearest):
+                    self._link(clusters[index], [child])
+                    self.stale[clusters[index]] += 1
+                    affected.add(clusters[index])
+
+            # 4.子节点摘要发生变化的聚类同样受影响
+            for child in changed:
+                for parent in self.parents[child]:
+                    self.stale[parent] += 1
+                    affected.add(parent)
+
+            # 5.受影响的聚类重新计算质心，变化的子节点占比达到阈值的聚类重新总结并重新嵌入
+            for parent in affected:
+                self.centroids[parent] = self.embeddings[self.children[parent]].mean(axis=0)
+            changed = [
+                parent for parent in sorted(affected)
+                if self.stale[parent] >= resummarize_ratio * len(self.children[parent])
+            ]
+            if changed:
+                groups = [self.children[parent] for parent in changed]
+                state = {"kind": "update", "parents": changed, "resummarize_ratio": resummarize_ratio}
+                summaries = self._summarize_groups(state, level, groups, [None] * len(groups))
+                self._replace_summaries(changed, summaries)
+                changed_rows.extend(changed)
+            pending = []
+            if not changed:
+                break
+        return changed_rows
+
+    def _replace_summaries(self, parents: List[int], summaries: List[str]) -> None:
+        """用新的摘要替换摘要节点的文本与嵌入"""
+        vectors = np.asarray(self.embedding.embed_documents(summaries), dtype=np.float32)
+        for parent, summary, vector in zip(parents, summaries, vectors):
+            self.texts[parent] = summary
+            self.embeddings[parent] = vector
+            self.stale[parent] = 0
+        self._mark_unsynced(self.ids[parent] for parent in parents)
+
+    def _summarize_groups(
+            self, state: dict, level: int, groups: List[List[int]], summaries: List[Optional[str]],
+    ) -> List[str]:
+        """
+        总结groups中还没有摘要的聚类。部分聚类失败时，已经成功的摘要与失败的聚类记录到续做状态中(随save一起持久化)，
+        再抛出异常，之后调用resume()只需要重新总结失败的聚类。
+        """
+        todo = [i for i, summary in enumerate(summaries) if summary is None]
+        try:
+            results = self.summarize([self._format(groups[i]) for i in todo], level)
+        except Exception as e:
+            partial = e.summaries if isinstance(e, ClusterSummaryError) else [None] * len(todo)
+            for i, summary in zip(todo, partial):
+                summaries[i] = summary
+            self._resume_state = {**state, "level": level, "groups": groups, "summaries": summaries}
+            raise
+        for i, summary in zip(todo, results):
+            summaries[i] = summary
+        self._resume_state = None
+        return summaries
+
+    @property
+    def interrupted(self) -> bool:
+        """上一次build/add_leaves是否因为聚类总结失败而中断"""
+        return self._resume_state is not None
+
+    def resume(self) -> List[str]:
+        """
+        继续被中断的build/add_leaves：只重新总结上次失败的聚类，再继续向上构建/更新，返回本次新增或内容发生变化的节点id。
+        仍然有聚类失败时同样保留成功的摘要并再次抛出异常。
+        """
+        state = self._resume_state
+        if state is None:
+            return []
+        level, groups = state["level"], state["groups"]
+        summaries = self._summarize_groups(state, level, groups, list(state["summaries"]))
+
+        # 1.构建中断：追加该层的摘要节点，聚类数大于1时继续构建上一层
+        if state["kind"] == "build":
+            start = len(self.ids)
+            parent_rows = self._append_level(level, groups, summaries)
+            if len(groups) > 1:
+                self._build_levels(level + 1, parent_rows)
+            return self.ids[start:]
+
+        # 2.增量更新中断：替换该层的摘要，再从上一层继续向上传播
+        parents = state["parents"]
+        self._replace_summaries(parents, summaries)
+        changed_rows = parents + self._update_levels(level + 1, [], parents, state["resummarize_ratio"])
+        return [self.ids[row] for row in changed_rows]
+
+    def _format(self, rows: Iterable[int]) -> str:
+        return self.SEPARATOR.join(self.texts[row] for row in rows)
+
+    def _append_nodes(
+            self, texts: List[str], level: int, vectors: Any, metadatas: Optional[List[dict]] = None,
+    ) -> List[int]:
+        """追加一批同层节点，返回它们的行号"""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        start = len(self.ids)
+
+        # 1.首次追加时按照嵌入维度分配矩阵，容量不足时按2倍扩容，均摊后每次追加只拷贝新增的行
+        if start == 0:
+            self._embeddings = np.empty((max(self.INITIAL_CAPACITY, len(texts)), vectors.shape[1]), dtype=np.float32)
+        self._embeddings = self._grow(self._embeddings, start, start + len(texts))
+        self._embeddings[start:start + len(texts)] = vectors
+
+        # 2.追加节点信息
+        ids = [str(uuid.uuid4()) for _ in texts]
+        self.ids.extend(ids)
+        self.levels.extend([level] * len(texts))
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas if metadatas is not None else [{} for _ in texts])
+        self.children.extend([] for _ in texts)
+        self.parents.extend([] for _ in texts)
+        self._id_to_row.update((id, row) for row, id in enumerate(ids, start))
+        self._roots = None
+        return list(range(start, len(self.ids)))
+
+    @classmethod
+    def _grow(cls, array: np.ndarray, used: int, required: int) -> np.ndarray:
+        """行数不足required时按2倍扩容并拷贝已使用的前used行"""
+        if required <= array.shape[0]:
+            return array
+        grown = np.empty((max(required, array.shape[0] * 2),) + array.shape[1:], dtype=array.dtype)
+        grown[:used] = array[:used]
+        return grown
+
+    def _link(self, parent: int, children: List[int]) -> None:
+        self.children[parent].extend(children)
+        for child in children:
+            self.parents[child].append(parent)
+        self._roots = None
+
+    def save(self, path: str) -> None:
+        """将文档树持久化到path目录：嵌入写成原始float32文件，质心写入npz，节点信息写入json边车文件"""
+        os.makedirs(path, exist_ok=True)
+
+        # 1.节点嵌入与聚类质心
+        self._write_atomic(path, self.EMBEDDINGS_FILE, self.embeddings.astype("<f4", copy=False).tofile)
+        rows = np.array(sorted(self.centroids), dtype=np.int64)
+        centroids = np.stack([self.centroids[row] for row in rows]) if len(rows) else np.empty((0, 0), dtype=np.float32)
+        self._write_atomic(path, self.CENTROIDS_FILE, lambda f: np.savez(f, rows=rows, centroids=centroids))
+
+        # 2.配置与节点信息
+        meta = {
+            "n_levels": self.n_levels,
+            "dim": self.dim,
+            "threshold": self.threshold,
+            "embedding_dim": int(self.embeddings.shape[1]) if len(self.ids) else 0,
+            "ids": self.ids,
+            "levels": self.levels,
+            "texts": self.texts,
+            "metadatas": self.metadatas,
+            "children": self.children,
+            "stale": {str(row): count for row, count in self.stale.items()},
+            "unsynced_ids": self.unsynced_ids,
+            "resume_state": self._resume_state,
+        }
+        self._write_atomic(
+            path, self.NODES_FILE, lambda f: f.write(json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8")),
+        )
+
+    @classmethod
+    def _write_atomic(cls, path: str, filename: str, write: Callable[[BinaryIO], Any]) -> None:
+        """先写临时文件再原子替换，中途失败时不会破坏已有的文件"""
+        target = os.path.join(path, filename)
+        tmp = f"{target}.tmp"
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, target)
+
+    @classmethod
+    def load(
+            cls,
+            path: str,
+            embedding: Embeddings,
+            summarize: SummarizeFunction,
+            search: Optional[ClusterCountSearch] = None,
+    ) -> "RaptorTree":
+        """从path目录加载文档树"""
+        # 1.读取边车文件并还原配置
+        with open(os.path.join(path, cls.NODES_FILE), encoding="utf-8") as f:
+            meta = json.load(f)
+        tree = cls(embedding, summarize, meta["n_levels"], meta["dim"], meta["threshold"], search)
+
+        # 2.还原节点与父子关系，父节点列表由子节点列表推导
+        tree.ids = meta["ids"]
+        tree.levels = meta["levels"]
+        tree.texts = meta["texts"]
+        tree.metadatas = meta["metadatas"]
+        tree.children = meta["children"]
+        tree.parents = [[] for _ in tree.ids]
+        for parent, children in enumerate(tree.children):
+            for child in children:
+                tree.parents[child].append(parent)
+        tree.stale = {int(row): count for row, count in meta["stale"].items()}
+        tree.unsynced_ids = meta.get("unsynced_ids", [])
+        tree._resume_state = meta.get("resume_state")
+        tree._id_to_row = {id: row for row, id in enumerate(tree.ids)}
+
+        # 3.还原嵌入与质心
+        tree._embeddings = np.fromfile(os.path.join(path, cls.EMBEDDINGS_FILE), dtype="<f4").reshape(
+            len(tree.ids), meta["embedding_dim"],
+        )
+        with np.load(os.path.join(path, cls.CENTROIDS_FILE)) as arrays:
+            tree.centroids = {int(row): centroid for row, centroid in zip(arrays["rows"], arrays["centroids"])}
+        return tree
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@Time    : 2024/8/7 21:10
+@Author  : thezehui@gmail.com
+@File    : test_raptor_summary.py
+"""
+from collections import Counter
+from typing import List
+
+import numpy as np
+import pytest
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables import RunnableLambda
+
+from raptor_summary import summarize_clusters
+from raptor_tree import ClusterSummaryError, RaptorTree
+
+
+class GroupEmbeddings(Embeddings):
+    """文本"g{组号}-{编号}"嵌入到组中心附近，其余文本(摘要)按内容生成固定的随机向量"""
+
+    def __init__(self, n_groups: int = 3, dim: int = 16):
+        self.centers = np.random.default_rng(0).standard_normal((n_groups, dim)) * 10
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        rng = np.random.default_rng(sum(text.encode("utf-8")))
+        if text.startswith("g") and "-" in text:
+            return (self.centers[int(text[1:text.index("-")])] + rng.standard_normal(self.dim) * 0.1).tolist()
+        return rng.standard_normal(self.dim).tolist()
+
+
+class FlakySummarizer:
+    """第level层中包含fail_token的聚类在前fail_times次调用中失败，其余聚类正常总结，并记录每个聚类成功总结的次数"""
+
+    def __init__(self, fail_token: str, level: int = 1, fail_times: int = 1):
+        self.fail_token = fail_token
+        self.level = level
+        self.fail_times = fail_times
+        self.calls = 0
+        self.summarized = Counter()
+        self.requested: List[List[str]] = []
+
+    def __call__(self, contexts: List[str], level: int) -> List[str]:
+        self.requested.append(list(contexts))
+        failing = level == self.level and self.calls < self.fail_times
+        if level == self.level:
+            self.calls += 1
+        summaries, errors = [], {}
+        for i, context in enumerate(contexts):
+            if failing and self.fail_token in context:
+                summaries.append(None)
+                errors[i] = RuntimeError("rate limited")
+            else:
+                summaries.append(f"summary {level}: {context[:20]}")
+                self.summarized[context] += 1
+        if errors:
+            raise ClusterSummaryError(level, summaries, errors)
+        return summaries
+
+
+def test_summarize_clusters_keeps_successful_summaries():
+    attempts = Counter()
+
+    def summarize(inputs: dict) -> str:
+        attempts[inputs["context"]] += 1
+        if inputs["context"] == "bad":
+            raise ValueError("bad cluster")
+        return f"summary of {inputs['context']}"
+
+    with pytest.raises(ClusterSummaryError) as info:
+        summarize_clusters(RunnableLambda(summarize), ["a", "bad", "c"], level=1, max_attempts=2)
+
+    # 失败的聚类只重试自己，成功的摘要保留在异常中
+    assert info.value.summaries == ["summary of a", None, "summary of c"]
+    assert list(info.value.errors) == [1]
+    assert attempts == {"a": 1, "bad": 2, "c": 1}
+
+
+def test_summarize_clusters_retries_flaky_cluster():
+    attempts = Counter()
+
+    def summarize(inputs: dict) -> str:
+        attempts[inputs["context"]] += 1
+        if inputs["context"] == "flaky" and attempts["flaky"] == 1:
+            raise ValueError("timeout")
+        return f"summary of {inputs['context']}"
+
+    summaries = summarize_clusters(RunnableLambda(summarize), ["a", "flaky"], level=1, max_attempts=2)
+
+    assert summaries == ["summary of a", "summary of flaky"]
+    assert attempts == {"a": 1, "flaky": 2}
+
+
+def test_tree_build_resumes_only_failed_clusters(tmp_path):
+    embedding = GroupEmbeddings()
+    summarizer = FlakySummarizer(fail_token="g0-")
+    tree = RaptorTree(embedding, summarizer, n_levels=2, dim=2)
+    leaves = [f"g{group}-{i}" for group in range(3) for i in range(8)]
+
+    # 1.第1层包含g0的聚类失败，构建中断，已经成功的摘要没有丢失
+    with pytest.raises(ClusterSummaryError):
+        tree.build(leaves)
+    assert tree.interrupted
+    assert tree.top_level == 0
+    failed = [context for context in summarizer.requested[0] if "g0-" in context]
+    succeeded = [context for context in summarizer.requested[0] if "g0-" not in context]
+    assert failed and succeeded
+
+    # 2.持久化后加载，续做时只重新总结失败的聚类，再继续构建上一层
+    tree.save(str(tmp_path))
+    tree = RaptorTree.load(str(tmp_path), embedding, summarizer)
+    assert tree.interrupted
+    resumed_ids = tree.resume()
+    assert summarizer.requested[1] == failed
+    assert all(summarizer.summarized[context] == 1 for context in failed + succeeded)
+
+    # 3.续做完成后文档树完整，新节点都在待同步列表中
+    assert not tree.interrupted
+    level_one = tree.level_rows(1)
+    assert len(level_one) == len(summarizer.requested[0])
+    assert set(tree.level_rows(0)) <= {child for row in level_one for child in tree.children[row]}
+    assert set(resumed_ids) <= set(tree.unsynced_ids)
+    assert len(tree.unsynced_ids) == len(tree)
+
+
+def test_tree_update_resumes_only_failed_clusters():
+    embedding = GroupEmbeddings()
+    tree = RaptorTree(embedding, FlakySummarizer(fail_token="", fail_times=0), n_levels=1, dim=2)
+    tree.build([f"g{group}-{i}" for group in range(3) for i in range(8)])
+    tree.mark_synced(tree.ids)
+
+    # 1.新叶子所在聚类重新总结失败，其他受影响的聚类已经成功的摘要保留在续做状态中
+    summarizer = FlakySummarizer(fail_token="g1-new")
+    tree.summarize = summarizer
+    with pytest.raises(ClusterSummaryError):
+        tree.add_leaves(["g0-new", "g1-new"])
+    with pytest.raises(ValueError):
+        tree.add_leaves(["g2-new"])
+
+    # 2.续做只重新总结失败的聚类
+    changed_ids = tree.resume()
+    assert summarizer.requested[1] == [context for context in summarizer.requested[0] if "g1-new" in context]
+    assert len(changed_ids) == len(summarizer.requested[0])
+    assert not tree.interrupted
+    assert all(tree.texts[row].startswith("summary 1") for row in tree.rows(changed_ids))
@@ -1,10 +1,19 @@
 # 导入正则表达式模块，用于模式匹配
 import re
 # 导入类型提示模块：任意类型和列表类型
-from typing import Any, List
+from typing import Any, Iterator, List, Optional
 # 导入LangChain的文本分割器基类
 from langchain.text_splitter import TextSplitter
 
+# 导入正则表达式解析器，用于读取每个模式的分组与反向引用(Python 3.11起sre_parse改名为re._parser)
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# 模式开头的全局内联标记，例如(?i)、(?im)
+_GLOBAL_FLAGS = re.compile(r"\(\?([aiLmsux]+)\)")
+
 
 # 定义测试文本，包含章节结构，用于演示自定义文本分割器
 text = """
@@ -28,6 +37,42 @@ text = """
 
 """
 
+def _has_group_reference(node) -> bool:
+    """递归检查正则语法树中是否有反向引用(\\1、(?P=name))或条件分组((?(1)...))"""
+    if isinstance(node, sre_parse.SubPattern):
+        return any(op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS) or _has_group_reference(av) for op, av in node)
+    if isinstance(node, (list, tuple)):
+        return any(_has_group_reference(item) for item in node)
+    return False
+
+
+def combine_patterns(patterns: List[str], flags: int = re.MULTILINE) -> Optional[re.Pattern]:
+    """把多个正则合并成一个"或"正则，不能等价合并时返回None，由调用方退回逐个模式扫描"""
+    parts = []
+    groups = 0  # 前面所有模式的分组总数，合并后当前模式的分组序号都要加上它
+    for pattern in patterns:
+        # 1.合并后分组序号会顺延，前面有分组时，引用分组的模式会引用到别的分组
+        parsed = sre_parse.parse(pattern, flags)
+        if groups and _has_group_reference(parsed):
+            return None
+        groups += parsed.state.groups - 1
+
+        # 2.开头的全局内联标记改写成只作用于该模式的局部标记，例如(?i)chapter \d -> (?i:chapter \d)
+        inline_flags = ""
+        match = _GLOBAL_FLAGS.match(pattern)
+        while match:
+            inline_flags += match.group(1)
+            pattern = pattern[match.end():]
+            match = _GLOBAL_FLAGS.match(pattern)
+        parts.append(f"(?{inline_flags}:{pattern})")
+
+    # 3.分组重名等情况下合并后无法编译，同样退回逐个模式扫描
+    try:
+        return re.compile("|".join(parts), flags)
+    except re.error:
+        return None
+
+
 # 自定义章节文本分割器类，继承自TextSplitter
 class ChapterTextSplitter(TextSplitter):
     """基于章节标题的文本分割器，将文档按章节结构分割"""
@@ -35,6 +80,7 @@ class ChapterTextSplitter(TextSplitter):
     def __init__(self, 
                  chapter_patterns: List[str] = None,    # 章节标题的正则表达式模式列表
                  keep_separator: bool = True,           # 是否保留章节标题
+                 single_pass: bool = False,             # 是否把所有模式合并成一个正则，只扫描一遍文本
                  **kwargs: Any,                         # 其他关键字参数
     ):
         # 调用父类初始化方法
@@ -59,8 +105,19 @@ class ChapterTextSplitter(TextSplitter):
         # 编译所有正则表达式模式，提高匹配效率
         # re.MULTILINE: 多行模式，允许^和$匹配每行的开始和结束
         self.chapter_regexes = [re.compile(pattern, re.MULTILINE) for pattern in chapter_patterns]
+
+        # 单次扫描模式：把所有模式合并成一个"或"正则，每个模式外层加非捕获分组，开头的全局内联标记改为局部标记
+        # 同一位置多个模式都能匹配时，排在前面的模式优先；finditer返回的匹配互不重叠，
+        # 因此不同模式在同一标题上的重复匹配只会保留一个，不会再产生重复或空的分块
+        # 模式中引用了分组而合并后分组序号会变化、或者合并后无法编译时，combined_regex为None，退回逐个模式扫描
+        self.single_pass = single_pass
+        self.combined_regex = combine_patterns(chapter_patterns) if single_pass else None
         
     def split_text(self, text)-> List[str]:
+        # 单次扫描模式直接收集惰性生成的分块
+        if self.combined_regex is not None:
+            return list(self.iter_chunks(text))
+
         # 找到所有章节标题的位置信息
         chapter_positions = []
         for regex in self.chapter_regexes:
@@ -88,10 +145,33 @@ class ChapterTextSplitter(TextSplitter):
             chunks.append(text[chunk_start:next_start])
         
         return chunks
-    
+
+    def iter_chunks(self, text: str) -> Iterator[str]:
+        """单次线性扫描文本，边匹配章节标题边产出分块，不需要收集和排序全部匹配位置"""
+        if self.combined_regex is None:
+            # 模式无法合并时逐个模式扫描
+            yield from self.split_text(text)
+            return
+
+        previous = None  # 上一个章节标题的(起始位置, 结束位置)
+        for match in self.combined_regex.finditer(text):
+            if previous is None:
+                # 第一个章节前的内容（如果有）
+                if match.start() > 0:
+                    yield text[:match.start()]
+            else:
+                # 上一个章节的内容到当前章节标题开始为止
+                yield text[previous[0] if self.keep_separator else previous[1]:match.start()]
+            previous = match.span()
+
+        # 最后一个章节到文本末尾；没有任何章节标题时与原有模式一致，不产出分块
+        if previous is not None:
+            yield text[previous[0] if self.keep_separator else previous[1]:]
+
 
 # 创建自定义章节文本分割器实例
-text_splitter = ChapterTextSplitter()
+# single_pass=True: 使用合并后的正则单次扫描，适合批量处理大量书籍
+text_splitter = ChapterTextSplitter(single_pass=True)
 
 # 分割文本
 chunks = text_splitter.split_text(text)
@@ -70,4 +70,16 @@ def cosine_similarity_manual(vec1, vec2):
 
 # 使用自定义函数计算余弦相似性
 similarity4 = cosine_similarity_manual(text1_vector, text2_vector)
-print(f"自定义的余弦相似性: {similarity4}")
\ No newline at end of file
+print(f"自定义的余弦相似性: {similarity4}")
+
+print("=======================================向量化=========================================")
+
+# 方法4：向量化批量计算余弦相似性
+# 一次性嵌入全部文本，得到(文本数, 维度)的矩阵
+vectors = np.array(embedings.embed_documents([text1, text2, text3]))
+# 每个向量只计算一次L2范数并归一化，之后的余弦相似性就是归一化向量的点积
+normalized_vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+# 一次矩阵乘法算出全部两两组合的余弦相似性，similarity_matrix[i][j]为第i句与第j句的相似性
+similarity_matrix = normalized_vectors @ normalized_vectors.T
+print(f"1-2句子的余弦相似性: {similarity_matrix[0][1]}")
+print(f"1-3句子的余弦相似性: {similarity_matrix[0][2]}")